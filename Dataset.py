@@ -1,15 +1,29 @@
 from torch.utils.data import Dataset
 from transformers import PreTrainedTokenizerFast
 import cv2
-import imagesize
-import tqdm
 import numpy as np
 from torch.nn.utils.rnn import pad_sequence
 import torch
+import os
 import logging
 import torch.nn.functional as F
+
+from manifest import build_manifest
+from shards import ShardReader
+from bucketing import scaled_sizes, aspect_buckets, budget_batches
+
+DEFAULT_DATA_ROOT = 'D:/projectDAT/image-computer/new_process/Data/'
+
+
+def manifest_kwargs(args):
+    """CustomDataset data root / manifest arguments from the config."""
+    return dict(data_root=args.data_root, manifest_path=args.manifest_path or os.path.join(args.data_root, 'manifest.parquet'),
+                manifest_workers=args.manifest_workers, rescan=args.manifest_rescan, shard_dir=args.shard_dir)
+
+
 class CustomDataset(Dataset):
-    def __init__(self, data, tokenizer: PreTrainedTokenizerFast, max_seq_len: int,max_height:int=64, max_width:int=256,test:bool=False, transform=None):
+    def __init__(self, data, tokenizer: PreTrainedTokenizerFast, max_seq_len: int,max_height:int=64, max_width:int=256,test:bool=False, transform=None,
+                 data_root: str = DEFAULT_DATA_ROOT, manifest_path: str = None, manifest_workers: int = 16, rescan: bool = True, shard_dir: str = None):
         self.data = data
         self.tokenizer = tokenizer
         self.max_seq_len = max_seq_len
@@ -18,64 +32,100 @@ class CustomDataset(Dataset):
         self.Data = dict()
         self.pad = False
         self.test = test
+        self.transform = transform
 
-        try:
-            for i, im in tqdm.tqdm(enumerate(data['name']), total=len(data['name'])):
-                try:
-                    width, height = imagesize.get("D:/projectDAT/image-computer/new_process/Data/"+im.strip('.inkml')+".png")
-                    if (width, height) not in self.Data:
-                        self.Data[(width, height)] = []
-                    self.Data[(width, height)].append((data['Latex'][i],"D:/projectDAT/image-computer/new_process/Data/"+im.strip('.inkml')+".png"))
-                except FileNotFoundError:
-                    pass
-        except KeyboardInterrupt:
-            pass
+        # image sizes, file stats and label lengths come from the cached manifest (see manifest.py);
+        # only images that are new or changed since the last run are opened
+        self.manifest = build_manifest(data, data_root, tokenizer, path=manifest_path, workers=manifest_workers, rescan=rescan)
+        found = self.manifest[self.manifest['width'] >= 0]
+        for (width, height), group in found.groupby(['width', 'height'], sort=False):
+            self.Data[(int(width), int(height))] = list(zip(group['latex'], group['path']))
+        self.items = list(zip(found['latex'], found['path']))
+        # pre-decoded pixels from shards.py when packed, PNG decoding otherwise
+        self.shards = ShardReader(shard_dir) if shard_dir else None
+
+    def load_image(self, path):
+        if self.shards is not None and path in self.shards:
+            return self.shards[path]
+        im = cv2.imread(path)
+        return cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
 
     def __len__(self):
-        return len(self.data)
-    def get_batch(self, batch_size):
+        return len(self.items)
+    def batches(self, batch_size, rng=None):
+        # batch plan of get_batch: (consecutive (latex, path) rows of one exact (width, height) group, no padding size);
+        # `rng` (numpy Generator) shuffles the rows within each group first
+        plan = []
         for key in self.Data:
-            data = np.array(self.Data[key])
-            for i in range(0, len(data), batch_size):
-                d = data[i:i + batch_size]
-                tok = self.tokenizer(d[:, 0].tolist(),return_token_type_ids=False)
-                for k, p in zip(tok, [[1,2], [1, 1]]):
-                    tok[k] = pad_sequence([torch.LongTensor([p[0]]+x+[p[1]]) for x in tok[k]], batch_first=True, padding_value=0)
-                images = []
-                for path in list(d[:, 1]):
-                    im = cv2.imread(path)
-                    im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-                    if not self.test:
-                        # sometimes convert to bitmask
-                        if np.random.random() < .04:
-                            im[im != 255] = 0
-                    if self.transform is not None:
-                        images.append(self.transform(image=im)['image'][:1])
-                try:
-                    images = torch.cat(images).float().unsqueeze(1)
-                except RuntimeError:
-                    logging.critical('Images not working: %s' % (' '.join(list(d[:, 1]))))
-                    yield None, None
-                if self.pad:
-                    h, w = images.shape[2:]
-                    images = F.pad(images, (0, self.max_dimensions[0]-w, 0, self.max_dimensions[1]-h), value=1)
-                yield tok, images
+            rows = self.Data[key] if rng is None else [self.Data[key][i] for i in rng.permutation(len(self.Data[key]))]
+            plan.extend((rows[i:i + batch_size], None) for i in range(0, len(rows), batch_size))
+        return plan
+
+    def bucket_batches(self, num_buckets, max_pixels, max_tokens=None, max_size=None, multiple=1, max_batch=None, rng=None):
+        """Batch plan over `num_buckets` aspect-ratio buckets (bucketing.py) instead of exact sizes:
+        (items, (height, width)) batches filled to the pixel / token budget, padded to their bucket.
+        `max_size` is the transform's LongestMaxSize and `multiple` the encoder's patch stride;
+        `rng` shuffles the images within each bucket."""
+        found = self.manifest[self.manifest['width'] >= 0]
+        heights, widths = scaled_sizes(found['height'], found['width'], max_size)
+        buckets, bounds = aspect_buckets(heights, widths, num_buckets, multiple)
+        # + bos / eos; labels without a tokenizer count as empty
+        num_tokens = np.maximum(found['num_tokens'].to_numpy(), 0) + 2
+        return [([self.items[i] for i in idx], tuple(int(v) for v in bounds[bucket]))
+                for idx, bucket in budget_batches(buckets, bounds, num_tokens, max_pixels, max_tokens, max_batch, rng)]
+
+    def make_batch(self, items, size=None):
+        """(tok, images) of one planned batch, or (None, None) when its images cannot be stacked.
+        With `size` (height, width) images are padded white to it (or to the largest image, if larger)."""
+        d = np.array(items)
+        tok = self.tokenizer(d[:, 0].tolist(),return_token_type_ids=False)
+        for k, p in zip(tok, [[1,2], [1, 1]]):
+            tok[k] = pad_sequence([torch.LongTensor([p[0]]+x+[p[1]]) for x in tok[k]], batch_first=True, padding_value=0)
+        images = []
+        for path in list(d[:, 1]):
+            im = self.load_image(path)
+            if not self.test:
+                # sometimes convert to bitmask (not in place: shard views are read-only)
+                if np.random.random() < .04:
+                    im = np.where(im == 255, im, 0)
+            if self.transform is not None:
+                images.append(self.transform(image=im)['image'][:1])
+        if size is not None and images:
+            h = max([size[0]] + [im.shape[-2] for im in images])
+            w = max([size[1]] + [im.shape[-1] for im in images])
+            images = [F.pad(im, (0, w - im.shape[-1], 0, h - im.shape[-2]), value=1) for im in images]
+        try:
+            images = torch.cat(images).float().unsqueeze(1)
+        except RuntimeError:
+            logging.critical('Images not working: %s' % (' '.join(list(d[:, 1]))))
+            return None, None
+        if self.pad:
+            h, w = images.shape[2:]
+            images = F.pad(images, (0, self.max_dimensions[0]-w, 0, self.max_dimensions[1]-h), value=1)
+        return tok, images
+
+    def get_batch(self, batch_size, plan=None):
+        for items, size in (plan if plan is not None else self.batches(batch_size)):
+            yield self.make_batch(items, size)
+
     def __getitem__(self, idx):
-        item = self.data[idx]
-        image = cv2.imread(item['Latex'], cv2.IMREAD_GRAYSCALE)
-        label = item['Latex']
-        tokenized_label = self.tokenizer(label, padding='max_length', truncation=True, max_length=self.max_seq_len, return_tensors='pt')
-        input_ids = tokenized_label.input_ids.squeeze(0)  # Remove batch dimension
-        attention_mask = tokenized_label.attention_mask.squeeze(0)  # Remove batch dimension
-        return {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask
-        }
+        # (tokens, image) in the layout of get_batch, for DataLoader + train.collate_fn
+        label, path = self.items[idx]
+        ids = self.tokenizer(label, truncation=True, max_length=self.max_seq_len - 2, return_token_type_ids=False)['input_ids']
+        input_ids = torch.LongTensor([1] + ids + [2])
+        im = self.load_image(path)
+        if self.transform is not None:
+            image = self.transform(image=im)['image'][:1].float()
+        else:
+            image = torch.from_numpy(np.array(im[..., 0] if im.ndim == 3 else im))[None].float()
+        return {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}, image
 if __name__ == "__main__":
     from transformers import PreTrainedTokenizerFast
     import pandas as pd
-    tokenizer = PreTrainedTokenizerFast(tokenizer_file="D:/projectDAT/image-computer/new_process/Data/tokenizer.json", unk_token="[UNK]", pad_token="[PAD]", cls_token="[CLS]", sep_token="[SEP]", mask_token="[MASK]")
-    df = pd.read_csv("D:/projectDAT/image-computer/new_process/Data/dataCombined_with_crohme.csv")
+    from config import get_args
+    args = get_args()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(args.data_root, "tokenizer.json"), unk_token="[UNK]", pad_token="[PAD]", cls_token="[CLS]", sep_token="[SEP]", mask_token="[MASK]")
+    df = pd.read_csv(os.path.join(args.data_root, args.data_csv))
     df = df[df["data_source"] == "CROHME"].reset_index()
     df = df[df["tags"] == "train"].reset_index()
-    dataset = CustomDataset(df, tokenizer, max_seq_len=150)
\ No newline at end of file
+    dataset = CustomDataset(df, tokenizer, max_seq_len=150, **manifest_kwargs(args))
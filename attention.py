@@ -0,0 +1,104 @@
+import logging
+import torch
+import torch.nn.functional as F
+
+from x_transformers.attend import Attend, Intermediates
+from timm.models.vision_transformer import Attention as TimmAttention
+
+
+def chunked_sdpa(q, k, v, attn_mask=None, dropout_p=0., scale=None, chunk_size=1024):
+    """Non-causal scaled_dot_product_attention over chunks of queries.
+
+    Peak attention memory is chunk_size x keys per head instead of queries x keys.
+    """
+    outs = []
+    for i in range(0, q.shape[-2], chunk_size):
+        mask = attn_mask
+        if mask is not None and mask.shape[-2] != 1:
+            mask = mask[..., i:i + chunk_size, :]
+        outs.append(F.scaled_dot_product_attention(q[..., i:i + chunk_size, :], k, v, attn_mask=mask, dropout_p=dropout_p, scale=scale))
+    return torch.cat(outs, dim=-2)
+
+
+class ChunkedAttend(Attend):
+    """x_transformers Attend that runs plain (non-causal) attention through chunked_sdpa.
+
+    Causal self-attention and the features chunking does not cover (attention bias,
+    residual attention, grouped kv heads, attn_delta, packed sequences) go through Attend's
+    flash path; the latter two log a warning once per layer.
+    """
+    chunk_size = 1024
+    _warned_fallback = False
+
+    def forward(self, q, k, v, mask=None, attn_bias=None, prev_attn=None, causal=None, **kwargs):
+        causal = self.causal if causal is None else causal
+        # Attention always passes its key mask again as row_mask; Attend only reads it for
+        # inverted attention, the padding itself is already in `mask`
+        if not getattr(self, 'inverted_attention', False):
+            kwargs.pop('row_mask', None)
+        unsupported = sorted(name for name, arg in kwargs.items() if arg is not None)
+        if unsupported and q.shape[-2] > self.chunk_size and not self._warned_fallback:
+            logging.warning('ChunkedAttend: %s not supported by chunked attention, using unchunked attention' % ', '.join(unsupported))
+            self._warned_fallback = True
+        if (causal and q.shape[-2] > 1) or attn_bias is not None or prev_attn is not None or k.shape[1] != q.shape[1] \
+                or unsupported or q.shape[-2] <= self.chunk_size:
+            return super().forward(q, k, v, mask=mask, attn_bias=attn_bias, prev_attn=prev_attn, causal=causal, **kwargs)
+        if mask is not None and mask.ndim == 2:
+            mask = mask[:, None, None, :]
+        out = chunked_sdpa(q, k, v, attn_mask=mask, dropout_p=self.dropout if self.training else 0., scale=self.scale, chunk_size=self.chunk_size)
+        return out, Intermediates()
+
+
+class ChunkedTimmAttention(TimmAttention):
+    """timm Attention whose non-causal path goes through chunked_sdpa."""
+    chunk_size = 1024
+
+    def forward(self, x, **kwargs):
+        # older timm releases call forward(x) only, newer ones add attn_mask / is_causal
+        attn_mask = kwargs.get('attn_mask')
+        if kwargs.get('is_causal', False) or x.shape[1] <= self.chunk_size:
+            return super().forward(x, **kwargs)
+        B, N, C = x.shape
+        head_dim = getattr(self, 'head_dim', C // self.num_heads)
+        gate = self.gate(x).sigmoid() if getattr(self, 'gate', None) is not None else None
+        q, k, v = self.qkv(x).reshape(B, N, 3, self.num_heads, head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+        if hasattr(self, 'q_norm'):
+            q, k = self.q_norm(q), self.k_norm(k)
+        x = chunked_sdpa(q, k, v, attn_mask=attn_mask, dropout_p=self.attn_drop.p if self.training else 0., scale=self.scale, chunk_size=self.chunk_size)
+        x = x.transpose(1, 2).reshape(B, N, self.num_heads * head_dim)
+        if hasattr(self, 'norm'):
+            x = self.norm(x)
+        if gate is not None:
+            x = x * gate
+        return self.proj_drop(self.proj(x))
+
+
+def attn_layer_kwargs(attn_impl=None):
+    """Constructor kwargs for x_transformers Encoder/Decoder; the flash path is set up at init."""
+    if attn_impl is None:
+        return {}
+    return {'attn_flash': attn_impl != 'math'}
+
+
+def set_attn_impl(module, attn_impl=None, chunk_size=1024):
+    """Selects the attention kernel of every x_transformers / timm attention in `module`.
+
+    'math' materializes the full attention matrix, 'sdpa' uses the fused
+    scaled_dot_product_attention kernels (flash / memory-efficient where available) and
+    'chunked' bounds peak memory by processing chunk_size queries at a time.
+    None keeps each library's default. Parameters and state_dict keys are unchanged.
+    x_transformers layers must also be built with attn_layer_kwargs(attn_impl).
+    """
+    if attn_impl is None:
+        return module
+    assert attn_impl in ('math', 'sdpa', 'chunked'), 'unknown attn_impl %s' % attn_impl
+    for m in module.modules():
+        if isinstance(m, Attend) and attn_impl == 'chunked':
+            m.__class__ = ChunkedAttend
+            m.chunk_size = chunk_size
+        elif isinstance(m, TimmAttention):
+            m.fused_attn = attn_impl != 'math'
+            if attn_impl == 'chunked':
+                m.__class__ = ChunkedTimmAttention
+                m.chunk_size = chunk_size
+    return module
@@ -0,0 +1,68 @@
+import logging
+import numpy as np
+
+
+class ResumableBatchSampler:
+    """Seeded, shardable and resumable order over a batch plan.
+
+    Each epoch the plan is rebuilt by `make_plan(rng)` (CustomDataset.batches / bucket_batches,
+    which shuffle within every bucket) with a generator seeded by (seed, epoch), and its batches
+    are permuted across buckets with the same generator; without `shuffle` rng is None and the
+    plan keeps get_batch's order. Rank `rank` of `world_size` takes every world_size-th batch,
+    the tail dropped so that all ranks take the same number of steps. Iterating yields the
+    (items, size) plan entries, so the sampler plugs into get_batch(plan=...) and, as a
+    DataLoader sampler, into prefetch.batch_loader, whose workers split a rank's batches.
+
+    `position` counts the batches of this epoch handed to training (advance()). state_dict()
+    holds seed, epoch and position; after load_state_dict the next iteration starts at the
+    first unseen batch. Only the plan is rebuilt from metadata: skipped batches are never loaded.
+    """
+    def __init__(self, make_plan, seed=0, shuffle=True, rank=0, world_size=1):
+        assert 0 <= rank < world_size, 'rank %d outside world_size %d' % (rank, world_size)
+        self.make_plan = make_plan
+        self.seed = seed
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.position = 0
+        self._cache = None
+
+    def batches(self):
+        """This rank's (items, size) batches of the current epoch, in order."""
+        if self._cache is None or self._cache[0] != self.epoch:
+            rng = np.random.default_rng([self.seed, self.epoch]) if self.shuffle else None
+            plan = self.make_plan(rng)
+            order = rng.permutation(len(plan)) if rng is not None else np.arange(len(plan))
+            order = order[:len(order) // self.world_size * self.world_size][self.rank::self.world_size]
+            self._cache = (self.epoch, [plan[i] for i in order])
+        return self._cache[1]
+
+    def __len__(self):
+        # batches left in this epoch
+        return len(self.batches()) - self.position
+
+    def __iter__(self):
+        batches = self.batches()
+        for i in range(self.position, len(batches)):
+            yield batches[i]
+
+    def advance(self, n=1):
+        self.position += n
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.position = 0
+
+    def state_dict(self):
+        return {'seed': self.seed, 'shuffle': self.shuffle, 'epoch': self.epoch, 'position': self.position,
+                'rank': self.rank, 'world_size': self.world_size, 'num_batches': len(self.batches())}
+
+    def load_state_dict(self, state):
+        assert state['world_size'] == self.world_size, \
+            'checkpoint sampler was sharded over %d ranks, now %d' % (state['world_size'], self.world_size)
+        self.seed, self.shuffle, self.epoch, self.position = state['seed'], state['shuffle'], state['epoch'], state['position']
+        self._cache = None
+        if len(self.batches()) != state['num_batches']:
+            logging.warning('Batch plan changed since the checkpoint (%d -> %d batches); resuming at batch %d anyway'
+                            % (state['num_batches'], len(self.batches()), self.position))
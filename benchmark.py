@@ -0,0 +1,985 @@
+import os
+import time
+import argparse
+import logging
+
+import torch
+from einops import rearrange
+
+import transformer
+from model import get_model
+from config import get_args
+
+
+def get_bench_args(**overrides):
+    """Small CPU configuration so the benchmarks finish in seconds with random weights."""
+    args = get_args()
+    args.device = 'cpu'
+    args.max_height = 64
+    args.max_width = 128
+    args.patch_size = 4
+    args.dim = 256
+    args.num_layers = 6
+    args.encoder_depth = 4
+    args.max_seq_len = 256
+    args.decoder_args = {'cross_attend': True}
+    for k, v in overrides.items():
+        setattr(args, k, v)
+    return args
+
+
+def bench_decode(seq_lens=(16, 32, 64, 128, 256), batch_size=1, seed=0):
+    """Tokens/s of `CustomARWrapper.generate` with and without the KV cache."""
+    args = get_bench_args()
+    model = get_model(args).eval()
+    images = torch.rand(batch_size, args.channels, args.max_height, args.max_width)
+    with torch.no_grad():
+        ctx = model.encoder(images)
+    start = torch.LongTensor([args.bos_token] * batch_size)[:, None]
+
+    results = []
+    for seq_len in seq_lens:
+        row = {'seq_len': seq_len}
+        outs = {}
+        for cache_kv in (False, True):
+            torch.manual_seed(seed)
+            t0 = time.perf_counter()
+            # no eos_token: always decode exactly seq_len tokens
+            outs[cache_kv] = model.decoder.generate(start, seq_len, context=ctx, temperature=0.25, cache_kv=cache_kv)
+            dt = time.perf_counter() - t0
+            row['tok/s cache=%s' % cache_kv] = batch_size * seq_len / dt
+        row['identical'] = bool(torch.equal(outs[False], outs[True]))
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_compaction(batch_size=8, max_len=256, seed=0):
+    """Batch-8 decode where rows stop at random lengths: compacted loop vs running every row to the longest."""
+    args = get_bench_args()
+    model = get_model(args).eval()
+    images = torch.rand(batch_size, args.channels, args.max_height, args.max_width)
+    with torch.no_grad():
+        ctx = model.encoder(images)
+    start = torch.LongTensor([args.bos_token] * batch_size)[:, None]
+    lengths = torch.randint(8, max_len + 1, (batch_size,), generator=torch.Generator().manual_seed(seed))
+    useful = lengths.sum().item()
+
+    t0 = time.perf_counter()
+    model.decoder.generate(start, int(lengths.max()), context=ctx, temperature=0.25)
+    padded = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    model.decoder.generate(start, max_len, context=ctx, temperature=0.25, stop_criteria=[transformer.MaxNewTokens(lengths)])
+    compacted = time.perf_counter() - t0
+
+    row = {'mean_len': lengths.float().mean().item(), 'max_len': lengths.max().item(),
+           'useful tok/s padded': useful / padded, 'useful tok/s compacted': useful / compacted}
+    logging.info(row)
+    return row
+
+
+def _legacy_sample(logits, filter_logits_fn, thres, temperature):
+    # the pre-LogitSampler step: filter into a fresh vocabulary tensor, softmax, multinomial
+    probs = torch.nn.functional.softmax(filter_logits_fn(logits, thres=thres) / temperature, dim=-1)
+    return torch.multinomial(probs, 1)
+
+
+def bench_sampling(batch_sizes=(1, 32), num_tokens=512, steps=2000):
+    """Per-step overhead (us) of turning logits into the next token."""
+    results = []
+    for b in batch_sizes:
+        logits = torch.randn(b, num_tokens)
+        row = {'batch': b}
+        for fn in (transformer.top_k, transformer.top_p):
+            sampler = transformer.LogitSampler(fn, 0.9, 0.25)
+            for name, step in (('legacy', lambda: _legacy_sample(logits.clone(), fn, 0.9, 0.25)),
+                               ('fused', lambda: sampler(logits))):
+                t0 = time.perf_counter()
+                for _ in range(steps):
+                    step()
+                row['%s %s us' % (fn.__name__, name)] = (time.perf_counter() - t0) / steps * 1e6
+        greedy = transformer.LogitSampler(temperature=0)
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            greedy(logits)
+        row['greedy us'] = (time.perf_counter() - t0) / steps * 1e6
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def _legacy_generate(decoder, start_tokens, seq_len, temperature=1., filter_thres=0.9, **kwargs):
+    # the pre-buffer decode loop: torch.cat on the tokens and F.pad on the mask every step (no eos)
+    out = start_tokens
+    mask = torch.ones_like(out, dtype=torch.bool)
+    use_cache = getattr(decoder.net, 'can_cache_kv', False)
+    cache = None
+    sampler = transformer.LogitSampler(transformer.top_k, filter_thres, temperature)
+    for _ in range(seq_len):
+        mask = mask[:, -decoder.max_seq_len:]
+        logits, cache, use_cache = decoder._next_logits(out, mask, cache, use_cache, **kwargs)
+        sample = sampler(logits)
+        out = torch.cat((out, sample), dim=-1)
+        mask = torch.nn.functional.pad(mask, (0, 1), value=True)
+    return out[:, start_tokens.shape[1]:]
+
+
+def bench_allocations(batch_size=8, seq_len=64):
+    """torch.profiler allocation counts and wall time of one generate call (no eos, so exactly
+    seq_len steps), the preallocated-buffer loop against the legacy torch.cat-per-step loop."""
+    from torch.profiler import profile, ProfilerActivity
+
+    args = get_bench_args()
+    model = get_model(args).eval()
+    images = torch.rand(batch_size, args.channels, args.max_height, args.max_width)
+    with torch.no_grad():
+        ctx = model.encoder(images)
+    start = torch.LongTensor([args.bos_token] * batch_size)[:, None]
+
+    results = []
+    for label, decode in (('legacy cat loop', lambda: _legacy_generate(model.decoder, start, seq_len, context=ctx, temperature=0.25)),
+                          ('preallocated buffers', lambda: model.decoder.generate(start, seq_len, context=ctx, temperature=0.25))):
+        with torch.no_grad():
+            decode()
+            t0 = time.perf_counter()
+            decode()
+            seconds = time.perf_counter() - t0
+            with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                decode()
+        events = prof.events()
+        row = {'loop': label, 'steps': seq_len, 'ms': seconds * 1e3,
+               'allocating ops': sum(1 for e in events if e.name != '[memory]' and e.self_cpu_memory_usage > 0),
+               'aten::cat': sum(1 for e in events if e.name == 'aten::cat'),
+               'aten::constant_pad_nd': sum(1 for e in events if e.name == 'aten::constant_pad_nd')}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def _ink_images(batch_size, height, width, ink_fraction, seed=0):
+    # white canvas with a random horizontal band of strokes covering ink_fraction of the area
+    g = torch.Generator().manual_seed(seed)
+    images = torch.ones(batch_size, 1, height, width)
+    band = max(1, int(height * ink_fraction))
+    top = (height - band) // 2
+    images[:, :, top:top + band] = (torch.rand(batch_size, 1, band, width, generator=g) > 0.5).float()
+    return images
+
+
+def bench_prune(ink_fractions=(0.05, 0.2, 0.5, 1.0), batch_size=1, repeats=3):
+    """Encoder latency on a 400x528 canvas (patch 8) with and without blank-patch pruning."""
+    import gc_module
+
+    args = get_bench_args(max_height=400, max_width=528, patch_size=8)
+    encoder = gc_module.get_encoder(args).eval()
+    results = []
+    for ink_fraction in ink_fractions:
+        images = _ink_images(batch_size, args.max_height, args.max_width, ink_fraction)
+        row = {'ink_fraction': ink_fraction}
+        for prune in (False, True):
+            encoder.prune_blank = prune
+            with torch.no_grad():
+                x, mask = encoder(images, return_mask=True)
+                t0 = time.perf_counter()
+                for _ in range(repeats):
+                    encoder(images)
+            row['tokens prune=%s' % prune] = x.shape[1]
+            row['ms prune=%s' % prune] = (time.perf_counter() - t0) / repeats * 1e3
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_posemb():
+    """Parameter count, checkpoint size and load time of the shipped ViT encoder per positional embedding."""
+    import os
+    import tempfile
+    import gc_module
+
+    results = []
+    for pos_embedding_type in ('full', 'factorized', 'sinusoidal'):
+        args = get_args()
+        args.pos_embedding_type = pos_embedding_type
+        encoder = gc_module.get_encoder(args)
+        params = sum(p.numel() for p in encoder.parameters())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'encoder.pt')
+            torch.save(encoder.state_dict(), path)
+            size = os.path.getsize(path)
+            del encoder
+            t0 = time.perf_counter()
+            gc_module.get_encoder(args).load_state_dict(torch.load(path, map_location='cpu'))
+            load = time.perf_counter() - t0
+        row = {'pos_embedding_type': pos_embedding_type, 'params': params,
+               'checkpoint MB': size / 2 ** 20, 'build+load s': load}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def _encoder_worker(height, width, repeats, **overrides):
+    # runs in a fresh process so ru_maxrss is the peak of this configuration only
+    import resource
+
+    args = get_bench_args(max_height=height, max_width=width, patch_size=8, **overrides)
+    encoder = get_model(args).encoder.eval()
+    images = torch.rand(1, args.channels, height, width)
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            encoder(images)
+    latency = (time.perf_counter() - t0) / repeats
+    return latency, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 1024
+
+
+def bench_attention(sizes=((128, 256), (256, 384), (400, 528)), repeats=2):
+    """Encoder latency and peak RSS growth (MB) per attn_impl across image sizes (patch 8)."""
+    import multiprocessing
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for height, width in sizes:
+        row = {'size': '%dx%d' % (height, width), 'tokens': height * width // 64 + 1}
+        for attn_impl in ('math', 'sdpa', 'chunked'):
+            with ctx.Pool(1) as pool:
+                latency, peak = pool.apply(_encoder_worker, (height, width, repeats), dict(attn_impl=attn_impl, attn_chunk_size=512))
+            row['%s ms' % attn_impl] = latency * 1e3
+            row['%s peak MB' % attn_impl] = peak
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_window(sizes=((128, 256), (256, 512), (400, 528), (512, 1024)), repeats=2):
+    """Global 'vit' vs shifted-window 'swin' encoder latency and peak RSS growth (MB) on growing canvases (patch 8)."""
+    import multiprocessing
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for height, width in sizes:
+        row = {'size': '%dx%d' % (height, width), 'patches': height * width // 64}
+        for structure in ('vit', 'swin'):
+            with ctx.Pool(1) as pool:
+                latency, peak = pool.apply(_encoder_worker, (height, width, repeats), dict(encoder_structure=structure, attn_impl='sdpa'))
+            row['%s ms' % structure] = latency * 1e3
+            row['%s peak MB' % structure] = peak
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def _glyph_batches(num_batches, batch_size, num_glyphs=12, glyph=8, height=16, seed=0):
+    # synthetic reading task: each token 3..18 is a fixed random glyph, drawn left to right on a white canvas
+    g = torch.Generator().manual_seed(0)
+    glyphs = (torch.rand(16, glyph, glyph, generator=g) > 0.5).float()
+    g.manual_seed(seed)
+    top = (height - glyph) // 2
+    for _ in range(num_batches):
+        tokens = torch.randint(0, 16, (batch_size, num_glyphs), generator=g)
+        images = torch.ones(batch_size, 1, height, num_glyphs * glyph)
+        images[:, 0, top:top + glyph] = 1 - rearrange(glyphs[tokens], 'b n h w -> b h (n w)')
+        input_ids = torch.cat((torch.ones(batch_size, 1, dtype=torch.long), tokens + 3, torch.full((batch_size, 1), 2)), dim=1)
+        yield {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}, images
+
+
+def bench_stem(strides=(4, 8, 16), steps=100, batch_size=8, repeats=5):
+    """Conv stem vs linear patch_size=1 embedding: encoder latency, tokens and held-out teacher-forced loss
+    after `steps` training steps of the 12-glyph reading task (16x96 canvas)."""
+    from train import train_epoch
+
+    results = []
+    for stride in (0,) + tuple(strides):
+        torch.manual_seed(0)
+        args = get_bench_args(max_height=16, max_width=96, patch_size=1, conv_stem_stride=stride, dim=128,
+                              num_layers=2, encoder_depth=2, max_seq_len=32, attn_impl='sdpa')
+        model = get_model(args)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        criterion = torch.nn.CrossEntropyLoss(ignore_index=args.pad_token)
+        t0 = time.perf_counter()
+        train_epoch(model, _glyph_batches(steps, batch_size), optimizer, criterion, torch.device('cpu'))
+        train_time = time.perf_counter() - t0
+
+        model.eval()
+        toks, images = next(_glyph_batches(1, 64, seed=1))
+        with torch.no_grad():
+            logits = model(images, toks['input_ids'], return_logits=True)
+            loss = criterion(logits.reshape(-1, logits.shape[-1]), toks['input_ids'][:, 1:].reshape(-1)).item()
+            x = model.encoder(images[:batch_size])
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                model.encoder(images[:batch_size])
+        row = {'stem stride': stride or 'off (patch_size=1)', 'tokens': x.shape[1],
+               'encoder ms': (time.perf_counter() - t0) / repeats * 1e3,
+               'train s/step': train_time / steps, 'held-out loss': loss}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def _train_step_worker(height, width, batch_size, steps, **overrides):
+    # fresh process per configuration so ru_maxrss is the peak of this training run only
+    import resource
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=height, max_width=width, patch_size=8, attn_impl='sdpa', **overrides)
+    model = get_model(args).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    images = torch.rand(batch_size, args.channels, height, width)
+    tgt = torch.randint(3, args.num_tokens, (batch_size, 128))
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(steps):
+        t0 = time.perf_counter()
+        model(images, tgt, return_logits=True).float().logsumexp(-1).mean().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        times.append(time.perf_counter() - t0)
+    # the first step also allocates the optimizer state
+    return min(times[1:] or times), (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) / 1024
+
+
+def bench_checkpoint(height=400, width=528, batch_size=4, steps=3):
+    """Training step time and peak RSS growth (MB) with activation checkpointing / offload (patch 8, 128 target tokens)."""
+    import multiprocessing
+
+    configs = (('off', {}),
+               ('every 2', dict(encoder_checkpoint_every=2, decoder_checkpoint_every=2)),
+               ('every 1', dict(encoder_checkpoint_every=1, decoder_checkpoint_every=1)),
+               ('every 1 + offload', dict(encoder_checkpoint_every=1, decoder_checkpoint_every=1, checkpoint_offload=True)))
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for name, overrides in configs:
+        with ctx.Pool(1) as pool:
+            step, peak = pool.apply(_train_step_worker, (height, width, batch_size, steps), overrides)
+        row = {'checkpointing': name, 'step s': step, 'peak MB': peak}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_patch_dropout(rates=(0., 0.25, 0.5, 0.75), batch_size=4, repeats=3):
+    """Encoder forward + backward time in training mode per patch_dropout rate (400x528 canvas, patch 8)."""
+    results = []
+    for rate in rates:
+        args = get_bench_args(max_height=400, max_width=528, patch_size=8, attn_impl='sdpa', patch_dropout=rate, patch_dropout_ink_bias=1.)
+        encoder = get_model(args).encoder.train()
+        images = _ink_images(batch_size, args.max_height, args.max_width, 0.3)
+        x = encoder(images)
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            encoder(images).mean().backward()
+        row = {'patch_dropout': rate, 'tokens': x.shape[1], 'fwd+bwd ms': (time.perf_counter() - t0) / repeats * 1e3}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_cross_attention(context_lens=(64, 256, 1024, 4096), seq_len=64, beam_width=4, samples=4, repeats=3):
+    """Decode ms/step (best of `repeats`) vs encoder token count, and how many context tokens the
+    cross-attention key projections process per decode (the cached decoder projects each image once)."""
+    args = get_bench_args()
+    decoder = get_model(args).decoder.eval()
+    attn_layers = decoder.net.attn_layers
+    projected = [0]
+    for layer_type, (_, block, _) in zip(attn_layers.layer_types, attn_layers.layers):
+        if layer_type == 'c':
+            block.to_k.register_forward_hook(lambda module, inputs, output: projected.__setitem__(0, projected[0] + inputs[0].shape[:-1].numel()))
+    start = torch.LongTensor([[args.bos_token]])
+    results = []
+    for n in context_lens:
+        ctx = torch.randn(1, n, args.dim)
+        row = {'context tokens': n}
+        for name, decode in (('uncached', lambda: decoder.generate(start, seq_len, context=ctx, cache_kv=False)),
+                             ('cached', lambda: decoder.generate(start, seq_len, context=ctx)),
+                             ('%d samples' % samples, lambda: decoder.generate(start, seq_len, context=ctx, num_samples=samples)),
+                             ('beam %d' % beam_width, lambda: decoder.beam_search(start, seq_len, beam_width=beam_width, context=ctx))):
+            timings = []
+            for _ in range(repeats):
+                projected[0] = 0
+                t0 = time.perf_counter()
+                decode()
+                timings.append(time.perf_counter() - t0)
+            row['%s ms/step' % name] = min(timings) / seq_len * 1e3
+            row['%s projected / layer' % name] = projected[0] // attn_layers.layer_types.count('c')
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_speculative(num_drafts=(2, 4, 6), steps=800, draft_steps=800, num_glyphs=24, images=32):
+    """Speculative vs plain greedy decoding after training a 6-layer decoder and a 1-layer draft
+    (train.train_draft_epoch, frozen encoder) on the glyph reading task; batch 1 per image."""
+    from train import train_epoch, train_draft_epoch
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=16, max_width=8 * num_glyphs, patch_size=1, conv_stem_stride=8, dim=128,
+                          max_seq_len=num_glyphs + 2, draft_layers=1, attn_impl='sdpa', emb_dropout=0., patch_dropout=0.)
+    model = get_model(args)
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=args.pad_token)
+    device = torch.device('cpu')
+    train_epoch(model, _glyph_batches(steps, 16, num_glyphs), torch.optim.Adam(model.parameters(), lr=3e-4), criterion, device)
+    model.requires_grad_(False)
+    model.draft.requires_grad_(True)
+    train_draft_epoch(model, _glyph_batches(draft_steps, 16, num_glyphs, seed=2), torch.optim.Adam(model.draft.parameters(), lr=3e-4), criterion, device)
+    model.eval()
+
+    toks, batch = next(_glyph_batches(1, images, num_glyphs, seed=1))
+    targets = toks['input_ids'][:, 1:]
+
+    def run(**kwargs):
+        t0 = time.perf_counter()
+        preds = [model.generate(batch[i:i + 1], temperature=0, **kwargs)[0] for i in range(images)]
+        latency = (time.perf_counter() - t0) / images * 1e3
+        exact = sum(len(p) == len(y) and torch.equal(p, y) for p, y in zip(preds, targets))
+        return latency, exact / images, preds
+
+    plain_ms, plain_em, plain = run(speculative=False)
+    results = []
+    for num_draft in num_drafts:
+        args.num_draft_tokens = num_draft
+        stats = {}
+        ms, em, preds = run(stats=stats)
+        row = {'num_draft': num_draft, 'accept rate': stats['accepted'] / max(1, stats['proposed']),
+               'tokens / decoder step': sum(len(p) for p in preds) / stats['steps'],
+               'plain ms': plain_ms, 'speculative ms': ms, 'speedup': plain_ms / ms, 'EM': em, 'plain EM': plain_em,
+               'identical to greedy': all(torch.equal(a, b) for a, b in zip(plain, preds))}
+        results.append(row)
+        logging.info(row)
+    return results
+
+LATEX_VOCAB = ['[PAD]', '[BOS]', '[EOS]', 'x', 'y', 'n', '2', '+', '-', '=', '{', '}', '^', '_', '\\frac', '\\sqrt']
+
+
+def _latex_expression(rng, budget, depth=0):
+    # random well-formed expression over LATEX_VOCAB with at most `budget` tokens
+    out = []
+    while True:
+        rem = budget - len(out)
+        r = rng.random()
+        if r < 0.15 and rem >= 7 and depth < 3:
+            a = _latex_expression(rng, (rem - 5) // 2, depth + 1)
+            b = _latex_expression(rng, rem - 5 - len(a), depth + 1)
+            item = ['\\frac', '{', *a, '}', '{', *b, '}']
+        elif r < 0.25 and rem >= 4 and depth < 3:
+            item = ['\\sqrt', '{', *_latex_expression(rng, rem - 3, depth + 1), '}']
+        else:
+            item = [rng.choice('xyn2')]
+            if rng.random() < 0.4 and rem >= 3:
+                script = rng.choice('^_')
+                if rng.random() < 0.5 and rem >= 5 and depth < 3:
+                    item += [script, '{', *_latex_expression(rng, rem - 4, depth + 1), '}']
+                else:
+                    item += [script, rng.choice('xyn2')]
+        out += item
+        if budget - len(out) < 2 or rng.random() < 0.3:
+            return out
+        out.append(rng.choice('+-='))
+
+
+def _latex_batches(num_batches, batch_size, max_tokens=16, glyph=8, height=16, seed=0):
+    # _glyph_batches with variable-length well-formed LaTeX token strings instead of random tokens
+    import random
+    g = torch.Generator().manual_seed(0)
+    glyphs = (torch.rand(len(LATEX_VOCAB), glyph, glyph, generator=g) > 0.5).float()
+    rng = random.Random(seed)
+    ids = {tok: i for i, tok in enumerate(LATEX_VOCAB)}
+    top = (height - glyph) // 2
+    for _ in range(num_batches):
+        input_ids = torch.zeros(batch_size, max_tokens + 2, dtype=torch.long)
+        images = torch.ones(batch_size, 1, height, max_tokens * glyph)
+        for i in range(batch_size):
+            tokens = torch.tensor([ids[tok] for tok in _latex_expression(rng, max_tokens)])
+            input_ids[i, :len(tokens) + 2] = torch.cat((torch.tensor([1]), tokens, torch.tensor([2])))
+            images[i, 0, top:top + glyph, :len(tokens) * glyph] = 1 - rearrange(glyphs[tokens], 'n h w -> h (n w)')
+        yield {'input_ids': input_ids, 'attention_mask': (input_ids != 0).long()}, images
+
+
+def bench_grammar(steps=(100, 400), max_tokens=16, images=64, temperature=1.):
+    """Invalid-output rate and mean decoded length with and without the LaTeX grammar masks,
+    sampling from a decoder trained for `steps` batches on well-formed synthetic LaTeX."""
+    from train import train_epoch
+    from grammar import LatexGrammar
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=16, max_width=8 * max_tokens, patch_size=1, conv_stem_stride=8, dim=128,
+                          num_tokens=len(LATEX_VOCAB), max_seq_len=max_tokens + 2, attn_impl='sdpa', emb_dropout=0., patch_dropout=0.)
+    grammar = LatexGrammar(LATEX_VOCAB, args.eos_token, banned_tokens={args.pad_token, args.bos_token})
+    model = get_model(args)
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=args.pad_token)
+    toks, batch = next(_latex_batches(1, images, max_tokens, seed=1))
+    targets = [y[1:int(m.sum()) - 1] for y, m in zip(toks['input_ids'], toks['attention_mask'])]
+
+    results, trained = [], 0
+    for num_steps in steps:
+        train_epoch(model, _latex_batches(num_steps - trained, 16, max_tokens, seed=2 + trained), optimizer, criterion, torch.device('cpu'))
+        trained = num_steps
+        model.eval()
+        for constrained in (False, True):
+            torch.manual_seed(0)
+            t0 = time.perf_counter()
+            preds = model.generate(batch, temperature=temperature, grammar=grammar if constrained else None)
+            ms = (time.perf_counter() - t0) / images * 1e3
+            lengths = [next((i for i, t in enumerate(p.tolist()) if t == args.eos_token), len(p)) for p in preds]
+            row = {'train steps': num_steps, 'constrained': constrained, 'grammar states': len(grammar.states),
+                   'invalid rate': sum(not grammar.is_valid(p) for p in preds) / images,
+                   'mean len': sum(lengths) / images, 'target mean len': sum(len(y) for y in targets) / images,
+                   'EM': sum(n == len(y) and torch.equal(p[:n], y) for p, n, y in zip(preds, lengths, targets)) / images,
+                   'ms / image': ms}
+            results.append(row)
+            logging.info(row)
+    return results
+
+
+def bench_mask_predict(iterations=(1, 2, 4, 8), steps=800, max_tokens=16, images=64, batch_sizes=(1, 16)):
+    """Autoregressive greedy vs mask-predict decoding (latency, EM) after jointly training both
+    decoders through train.train_epoch on the synthetic LaTeX reading task."""
+    from train import train_epoch
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=16, max_width=8 * max_tokens, patch_size=1, conv_stem_stride=8, dim=128,
+                          num_tokens=len(LATEX_VOCAB), max_seq_len=max_tokens + 2, nar_layers=4, attn_impl='sdpa', emb_dropout=0., patch_dropout=0.)
+    model = get_model(args)
+    train_epoch(model, _latex_batches(steps, 16, max_tokens, seed=2), torch.optim.Adam(model.parameters(), lr=3e-4),
+                torch.nn.CrossEntropyLoss(ignore_index=args.pad_token), torch.device('cpu'))
+    model.eval()
+    toks, batch = next(_latex_batches(1, images, max_tokens, seed=1))
+    targets = [y[1:int(m.sum())] for y, m in zip(toks['input_ids'], toks['attention_mask'])]
+
+    def run(batch_size, **kwargs):
+        t0 = time.perf_counter()
+        preds = [p for i in range(0, images, batch_size) for p in model.generate(batch[i:i + batch_size], temperature=0, **kwargs)]
+        ms = (time.perf_counter() - t0) / images * 1e3
+        return ms, sum(torch.equal(p[:len(y)], y) for p, y in zip(preds, targets)) / images
+
+    results = []
+    for batch_size in batch_sizes:
+        ar_ms, ar_em = run(batch_size)
+        for its in iterations:
+            ms, em = run(batch_size, mode='mask_predict', iterations=its)
+            row = {'batch': batch_size, 'iterations': its, 'mask-predict ms / image': ms, 'mask-predict EM': em,
+                   'autoregressive ms / image': ar_ms, 'autoregressive EM': ar_em, 'speedup': ar_ms / ms}
+            results.append(row)
+            logging.info(row)
+    return results
+
+
+def bench_ctc(steps=800, max_tokens=16, images=64, batch_sizes=(1, 16)):
+    """Autoregressive greedy vs single-pass CTC decoding (latency, EM) after training the decoder
+    with the auxiliary CTC loss through train.train_epoch; a stride-4 stem gives two CTC frames per glyph."""
+    from train import train_epoch
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=16, max_width=8 * max_tokens, patch_size=1, conv_stem_stride=4, dim=128,
+                          num_tokens=len(LATEX_VOCAB), max_seq_len=max_tokens + 2, ctc_head=True, attn_impl='sdpa', emb_dropout=0., patch_dropout=0.)
+    model = get_model(args)
+    train_epoch(model, _latex_batches(steps, 16, max_tokens, seed=2), torch.optim.Adam(model.parameters(), lr=3e-4),
+                torch.nn.CrossEntropyLoss(ignore_index=args.pad_token), torch.device('cpu'))
+    model.eval()
+    toks, batch = next(_latex_batches(1, images, max_tokens, seed=1))
+    targets = [y[1:int(m.sum())] for y, m in zip(toks['input_ids'], toks['attention_mask'])]
+
+    def run(batch_size, **kwargs):
+        t0 = time.perf_counter()
+        preds = [p for i in range(0, images, batch_size) for p in model.generate(batch[i:i + batch_size], temperature=0, **kwargs)]
+        ms = (time.perf_counter() - t0) / images * 1e3
+        return ms, sum(len(p) >= len(y) and torch.equal(p[:len(y)], y) for p, y in zip(preds, targets)) / images
+
+    results = []
+    for batch_size in batch_sizes:
+        ar_ms, ar_em = run(batch_size)
+        ms, em = run(batch_size, mode='ctc')
+        row = {'batch': batch_size, 'ctc ms / image': ms, 'ctc EM': em, 'autoregressive ms / image': ar_ms,
+               'autoregressive EM': ar_em, 'speedup': ar_ms / ms}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_quantization(steps=600, max_tokens=16, images=64, batch_sizes=(1, 16)):
+    """fp32 vs bf16 autocast vs dynamic int8 Linear weights: EM, CPU latency and weight size of a decoder
+    trained on the synthetic LaTeX task, plus a save / load round trip of the int8 artifact."""
+    import os
+    import tempfile
+    from train import train_epoch
+    from quantization import PRECISIONS, quantized_copy, state_dict_bytes, save_artifact, load_artifact, bf16_supported
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=16, max_width=8 * max_tokens, patch_size=1, conv_stem_stride=8,
+                          num_tokens=len(LATEX_VOCAB), max_seq_len=max_tokens + 2, attn_impl='sdpa', emb_dropout=0., patch_dropout=0.)
+    model = get_model(args)
+    train_epoch(model, _latex_batches(steps, 16, max_tokens, seed=2), torch.optim.Adam(model.parameters(), lr=3e-4),
+                torch.nn.CrossEntropyLoss(ignore_index=args.pad_token), torch.device('cpu'))
+    model.eval()
+    toks, batch = next(_latex_batches(1, images, max_tokens, seed=1))
+    targets = [y[1:int(m.sum())] for y, m in zip(toks['input_ids'], toks['attention_mask'])]
+
+    def run(m, batch_size):
+        t0 = time.perf_counter()
+        preds = [p for i in range(0, images, batch_size) for p in m.generate(batch[i:i + batch_size], temperature=0)]
+        ms = (time.perf_counter() - t0) / images * 1e3
+        return ms, sum(len(p) >= len(y) and torch.equal(p[:len(y)], y) for p, y in zip(preds, targets)) / images, preds
+
+    results = []
+    for precision in PRECISIONS:
+        served = quantized_copy(model, precision)
+        for batch_size in batch_sizes:
+            ms, em, preds = run(served, batch_size)
+            row = {'precision': precision, 'batch': batch_size, 'ms / image': ms, 'EM': em,
+                   'weights MB': state_dict_bytes(served) / 2 ** 20, 'native bf16': bf16_supported()}
+            results.append(row)
+            logging.info(row)
+        if precision == 'int8':
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'int8.pt')
+                save_artifact(served, path)
+                loaded = load_artifact(path)
+                same = all(torch.equal(a, b) for a, b in zip(preds, run(loaded, batch_sizes[-1])[2]))
+            logging.info({'int8 artifact reloads with identical outputs': same})
+    return results
+
+
+def bench_onnx(batch_sizes=(1, 16), threads=None, seq_len=64, repeats=3):
+    """PyTorch Model.generate vs OnnxModel (ONNX Runtime) greedy decoding: parity and images/s at
+    matched thread counts; random weights, every row decodes seq_len tokens."""
+    import os
+    import tempfile
+    from onnx_export import export_onnx, check_parity
+    from onnx_model import OnnxModel
+
+    torch.manual_seed(0)
+    args = get_bench_args(max_height=32, max_width=128, patch_size=1, conv_stem_stride=8, max_seq_len=seq_len, attn_impl='sdpa')
+    model = get_model(args).eval()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        export_onnx(model, tmp)
+        parity = check_parity(model, tmp, torch.rand(4, 1, 32, 128))
+        logging.info({'parity': parity})
+        for num_threads in threads or sorted({1, os.cpu_count()}):
+            torch.set_num_threads(num_threads)
+            onnx_model = OnnxModel(tmp, intra_op_num_threads=num_threads, inter_op_num_threads=1)
+            for batch_size in batch_sizes:
+                images = torch.rand(batch_size, 1, 32, 128)
+                timings = {}
+                for name, run in (('torch', lambda: model.generate(images, temperature=0)), ('onnxruntime', lambda: onnx_model.generate(images.numpy(), temperature=0))):
+                    run()
+                    best = float('inf')
+                    for _ in range(repeats):
+                        t0 = time.perf_counter()
+                        run()
+                        best = min(best, time.perf_counter() - t0)
+                    timings[name] = batch_size / best
+                row = {'threads': num_threads, 'batch': batch_size, 'torch images/s': timings['torch'],
+                       'onnxruntime images/s': timings['onnxruntime'], 'speedup': timings['onnxruntime'] / timings['torch'], 'parity': parity['passed']}
+                results.append(row)
+                logging.info(row)
+    return results
+
+
+def bench_manifest(num_images=4000, changed=0.01, workers=16):
+    """Legacy serial imagesize scan vs the cached manifest (cold build, warm load with and without
+    rescan, incremental rescan after `changed` of the images were rewritten) on synthetic PNGs."""
+    import os
+    import random
+    import tempfile
+    import cv2
+    import imagesize
+    import numpy as np
+    import pandas as pd
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    from manifest import build_manifest, image_path
+
+    rng = random.Random(0)
+    chars = sorted(set(''.join(LATEX_VOCAB[3:])))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer(models.WordLevel({c: i for i, c in enumerate(['[UNK]'] + chars)}, unk_token='[UNK]')))
+    tokenizer.backend_tokenizer.pre_tokenizer = pre_tokenizers.Split('', 'isolated')
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        names = ['expr_%06d.inkml' % i for i in range(num_images)]
+        for name in names:
+            h, w = rng.choice((32, 48, 64)), rng.choice((64, 128, 192, 256))
+            cv2.imwrite(image_path(root, name), np.full((h, w), 255, dtype=np.uint8))
+        df = pd.DataFrame({'name': names, 'Latex': [' '.join(_latex_expression(rng, 16)) for _ in names],
+                           'data_source': 'synthetic', 'tags': ['train' if i % 10 else 'test' for i in range(num_images)]})
+        path = os.path.join(root, 'manifest.parquet')
+
+        def timed(label, fn):
+            t0 = time.perf_counter()
+            out = fn()
+            row = {'step': label, 'seconds': time.perf_counter() - t0, 'images': num_images}
+            results.append(row)
+            logging.info(row)
+            return out
+
+        def legacy():
+            # the former per-run CustomDataset loop
+            buckets = {}
+            for i, name in enumerate(df['name']):
+                width, height = imagesize.get(image_path(root, name))
+                buckets.setdefault((width, height), []).append((df['Latex'][i], image_path(root, name)))
+            return buckets
+
+        timed('legacy serial imagesize scan', legacy)
+        timed('manifest cold build', lambda: build_manifest(df, root, tokenizer, path=path, workers=workers))
+        timed('manifest warm load + rescan', lambda: build_manifest(df, root, tokenizer, path=path, workers=workers))
+        timed('manifest warm load, no rescan', lambda: build_manifest(df, root, tokenizer, path=path, workers=workers, rescan=False))
+        for name in rng.sample(names, int(num_images * changed)):
+            cv2.imwrite(image_path(root, name), np.full((80, 320), 255, dtype=np.uint8))
+        manifest = timed('manifest incremental rescan', lambda: build_manifest(df, root, tokenizer, path=path, workers=workers))
+        logging.info({'rows with 80x320 after rescan': int(((manifest['height'] == 80) & (manifest['width'] == 320)).sum()),
+                      'mean label tokens': float(manifest['num_tokens'].mean())})
+    return results
+
+
+def _evict(paths):
+    # drop the files from the page cache so the next read is cold
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _stroke_pngs(root, num_images, rng):
+    # handwriting-like strokes on white at sizes of typical CROHME renders; returns the CSV names
+    import cv2
+    import numpy as np
+    from manifest import image_path
+
+    names = ['expr_%06d.inkml' % i for i in range(num_images)]
+    for name in names:
+        h, w = int(rng.choice((64, 96, 128, 192))), int(rng.choice((256, 384, 512, 768)))
+        im = np.full((h, w, 3), 255, dtype=np.uint8)
+        for _ in range(w // 16):
+            p0, p1 = rng.integers(0, (w, h), size=2), rng.integers(0, (w, h), size=2)
+            cv2.line(im, tuple(map(int, p0)), tuple(map(int, p1)), (0, 0, 0), int(rng.integers(1, 4)), cv2.LINE_AA)
+        cv2.imwrite(image_path(root, name), im)
+    return names
+
+
+def bench_shards(num_images=2000, batch_size=16, seed=0):
+    """Samples/s of get_batch-style PNG decoding (cv2.imread + cvtColor) vs memory-mapped
+    shards (shards.py), raw loads and full get_batch, with cold (evicted) and warm page cache."""
+    import glob
+    import tempfile
+    import cv2
+    import numpy as np
+    import pandas as pd
+    import albumentations as A
+    from albumentations.pytorch import ToTensorV2
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    from Dataset import CustomDataset
+    from manifest import image_path
+    from shards import pack_shards, ShardReader
+
+    rng = np.random.default_rng(seed)
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        names = _stroke_pngs(root, num_images, rng)
+        paths = [image_path(root, name) for name in names]
+        t0 = time.perf_counter()
+        pack_shards(paths, os.path.join(root, 'shards'), shard_bytes=64 << 20)
+        shard_files = glob.glob(os.path.join(root, 'shards', 'shard_*.bin'))
+        logging.info({'pack seconds': time.perf_counter() - t0, 'png MB': sum(map(os.path.getsize, paths)) / 2 ** 20,
+                      'shard MB': sum(map(os.path.getsize, shard_files)) / 2 ** 20})
+
+        def png(path):
+            return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+        reader = ShardReader(os.path.join(root, 'shards'))
+
+        def shard(path):
+            # materialize the view, as a consumer touching every pixel would
+            return np.array(reader[path])
+
+        def run(label, files, fn):
+            for cache in ('cold', 'warm'):
+                if cache == 'cold':
+                    _evict(files)
+                t0 = time.perf_counter()
+                fn()
+                row = {'reader': label, 'cache': cache, 'samples/s': num_images / (time.perf_counter() - t0)}
+                results.append(row)
+                logging.info(row)
+
+        run('png imread', paths, lambda: [png(p) for p in paths])
+        run('shard memmap', shard_files, lambda: [shard(p) for p in paths])
+
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer(models.WordLevel({'[PAD]': 0, '[UNK]': 1}, unk_token='[UNK]')))
+        tokenizer.backend_tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        df = pd.DataFrame({'name': names, 'Latex': 'x'})
+        transform = A.Compose([A.Normalize(mean=0.0, std=1.0), ToTensorV2()])
+        for label, shard_dir, files in (('get_batch png', None, paths), ('get_batch shards', os.path.join(root, 'shards'), shard_files)):
+            dataset = CustomDataset(df, tokenizer, 150, test=True, transform=transform, data_root=root, shard_dir=shard_dir)
+            run(label, files, lambda: [b for b in dataset.get_batch(batch_size)])
+    return results
+
+
+def bench_prefetch(num_images=1024, batch_size=16, step_ms=(10, 40), workers=(1, 2, 4), seed=0):
+    """Epoch time and data-wait share of a training loop fed by the in-process get_batch
+    generator vs prefetch.batch_loader workers. The train step is simulated as `step_ms` of
+    accelerator time (a sleep), so the host CPU is free for the loader as on a GPU trainer."""
+    import random
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    import albumentations as A
+    from albumentations.pytorch import ToTensorV2
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    from Dataset import CustomDataset
+    from prefetch import batch_loader, DataWaitTimer
+
+    rng = np.random.default_rng(seed)
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        names = _stroke_pngs(root, num_images, rng)
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer(models.WordLevel({'[PAD]': 0, '[UNK]': 1}, unk_token='[UNK]')))
+        tokenizer.backend_tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        labels = random.Random(seed)
+        df = pd.DataFrame({'name': names, 'Latex': [' '.join(_latex_expression(labels, 24)) for _ in names]})
+        # train.py's transform
+        transform = A.Compose([A.LongestMaxSize(max_size=512), A.PadIfNeeded(min_height=400, min_width=528, border_mode=0, value=1.0),
+                               A.Normalize(mean=0.0, std=1.0), ToTensorV2()])
+        dataset = CustomDataset(df, tokenizer, 150, transform=transform, data_root=root)
+        loaders = [('get_batch', lambda: dataset.get_batch(batch_size))]
+        for w in workers:
+            loader = batch_loader(dataset, batch_size, num_workers=w, prefetch=4)
+            loaders.append(('%d workers' % w, lambda loader=loader: loader))
+        for ms in step_ms:
+            for label, make in loaders:
+                data = DataWaitTimer(make())
+                t0 = time.perf_counter()
+                for tok, images in data:
+                    time.sleep(ms / 1000)
+                seconds = time.perf_counter() - t0
+                row = {'loader': label, 'step ms': ms, 'samples/s': num_images / seconds, 'data wait %': 100 * data.wait_seconds / seconds}
+                results.append(row)
+                logging.info(row)
+    return results
+
+
+def bench_bucketing(num_images=20000, batch_size=16, bucket_counts=(4, 8, 16, 32), max_size=512, stride=16, seed=0):
+    """Padding waste and batch fill of the exact (width, height) grouping padded to 400x528 vs
+    aspect-ratio buckets with pixel-budget batches (bucketing.py), on a handwriting-like size /
+    label-length distribution."""
+    import numpy as np
+    from bucketing import scaled_sizes, aspect_buckets, budget_batches, padding_stats
+
+    rng = np.random.default_rng(seed)
+    raw_h = np.clip(rng.lognormal(np.log(90), 0.45, num_images), 16, 1200).astype(np.int64)
+    raw_w = np.clip(raw_h * rng.lognormal(np.log(3.5), 0.6, num_images), 16, 4000).astype(np.int64)
+    num_tokens = np.clip((raw_w / raw_h * 6 * rng.lognormal(0, 0.3, num_images)).astype(np.int64), 3, 150) + 2
+    heights, widths = scaled_sizes(raw_h, raw_w, max_size)
+    max_pixels = batch_size * 400 * 528
+
+    # before: batch_size images of one exact raw size, PadIfNeeded(400, 528) on every image
+    # (rounded up to the patch stride like the buckets)
+    groups = {}
+    for i, key in enumerate(zip(raw_w.tolist(), raw_h.tolist())):
+        groups.setdefault(key, []).append(i)
+    before = [(idx[j:j + batch_size], tuple(-(-max(int(v), m) // stride) * stride for v, m in ((heights[idx[0]], 400), (widths[idx[0]], 528))))
+              for idx in groups.values() for j in range(0, len(idx), batch_size)]
+    plans = [('exact size, pad 400x528', before)]
+    for k in bucket_counts:
+        buckets, bounds = aspect_buckets(heights, widths, k, stride)
+        plans.append(('%d buckets' % k, [(idx, tuple(bounds[b])) for idx, b in budget_batches(buckets, bounds, num_tokens, max_pixels)]))
+
+    results = []
+    for label, plan in plans:
+        row = {'plan': label, **padding_stats(plan, heights, widths, max_pixels)}
+        results.append(row)
+        logging.info(row)
+    return results
+
+
+def bench_resume(num_images=2000, batch_size=16, seed=0):
+    """Time to the first unseen batch when resuming mid-epoch with ResumableBatchSampler state
+    (plan rebuilt from metadata) vs replaying the data pipeline up to that batch, and a check
+    that the resumed order continues the uninterrupted one."""
+    import random
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    import albumentations as A
+    from albumentations.pytorch import ToTensorV2
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    from Dataset import CustomDataset
+    from batch_sampler import ResumableBatchSampler
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        names = _stroke_pngs(root, num_images, np.random.default_rng(seed))
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=Tokenizer(models.WordLevel({'[PAD]': 0, '[UNK]': 1}, unk_token='[UNK]')))
+        tokenizer.backend_tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        labels = random.Random(seed)
+        df = pd.DataFrame({'name': names, 'Latex': [' '.join(_latex_expression(labels, 24)) for _ in names]})
+        transform = A.Compose([A.LongestMaxSize(max_size=512), A.Normalize(mean=0.0, std=1.0), ToTensorV2()])
+        dataset = CustomDataset(df, tokenizer, 150, transform=transform, data_root=root)
+
+        def make_plan(rng):
+            return dataset.bucket_batches(8, batch_size * 400 * 528, max_size=512, multiple=16, rng=rng)
+
+        sampler = ResumableBatchSampler(make_plan, seed=seed)
+        order = [[p for _, p in items] for items, _ in sampler]
+        for frac in (0.25, 0.5, 0.9):
+            k = int(frac * len(order))
+            t0 = time.perf_counter()
+            replay = dataset.get_batch(None, ResumableBatchSampler(make_plan, seed=seed))
+            for _ in range(k):
+                next(replay)
+            next(replay)
+            replay_s = time.perf_counter() - t0
+
+            resumed = ResumableBatchSampler(make_plan, seed=123)
+            t0 = time.perf_counter()
+            resumed.load_state_dict({**sampler.state_dict(), 'position': k})
+            batches = dataset.get_batch(None, resumed)
+            next(batches)
+            resume_s = time.perf_counter() - t0
+            same = [[p for _, p in items] for items, _ in resumed] == order[k:]
+            row = {'resume at': f'{k}/{len(order)}', 'replay s': replay_s, 'resume s': resume_s, 'order continues': same}
+            results.append(row)
+            logging.info(row)
+    return results
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'compaction': bench_compaction,
+    'sampling': bench_sampling,
+    'allocations': bench_allocations,
+    'prune': bench_prune,
+    'posemb': bench_posemb,
+    'attention': bench_attention,
+    'window': bench_window,
+    'stem': bench_stem,
+    'checkpoint': bench_checkpoint,
+    'patch_dropout': bench_patch_dropout,
+    'cross_attention': bench_cross_attention,
+    'speculative': bench_speculative,
+    'grammar': bench_grammar,
+    'mask_predict': bench_mask_predict,
+    'ctc': bench_ctc,
+    'quantization': bench_quantization,
+    'onnx': bench_onnx,
+    'manifest': bench_manifest,
+    'shards': bench_shards,
+    'prefetch': bench_prefetch,
+    'bucketing': bench_bucketing,
+    'resume': bench_resume,
+}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', default=list(BENCHMARKS), help='benchmarks to run: %s' % ', '.join(BENCHMARKS))
+    for name in parser.parse_args().names:
+        BENCHMARKS[name]()
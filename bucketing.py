@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def scaled_sizes(heights, widths, max_size=None):
+    # (heights, widths) after A.LongestMaxSize(max_size), which also upscales; None leaves them as is
+    h, w = np.asarray(heights, dtype=np.float64), np.asarray(widths, dtype=np.float64)
+    if max_size:
+        scale = max_size / np.maximum(h, w)
+        h, w = np.maximum(1, np.round(h * scale)), np.maximum(1, np.round(w * scale))
+    return h.astype(np.int64), w.astype(np.int64)
+
+
+def aspect_buckets(heights, widths, num_buckets, multiple=1):
+    """Splits images into `num_buckets` groups of about equal size by aspect ratio.
+
+    Returns the bucket of every image and the (num_buckets, 2) (height, width) every bucket
+    pads to: the largest image of the bucket, rounded up to `multiple` (the encoder's patch
+    stride). After LongestMaxSize one side is always max_size, so the aspect ratio alone
+    decides the padded shape.
+    """
+    heights, widths = np.asarray(heights, dtype=np.int64), np.asarray(widths, dtype=np.int64)
+    n = len(heights)
+    num_buckets = max(1, min(num_buckets, n))
+    order = np.argsort(np.log(widths) - np.log(heights), kind='stable')
+    buckets = np.empty(n, dtype=np.int64)
+    buckets[order] = np.arange(n) * num_buckets // max(n, 1)
+    bounds = np.zeros((num_buckets, 2), dtype=np.int64)
+    np.maximum.at(bounds, buckets, np.stack([heights, widths], axis=1))
+    return buckets, -(-bounds // multiple) * multiple
+
+
+def budget_batches(buckets, bounds, num_tokens, max_pixels, max_tokens=None, max_batch=None, rng=None):
+    """Index batches of every bucket, filled up to `max_pixels` padded pixels (images x bucket
+    height x width) and `max_tokens` padded label tokens (images x longest label), instead of a
+    fixed count. Within a bucket images are ordered by label length, so labels pad little too;
+    with `rng` (a numpy Generator) they are shuffled instead. Returns a list of (image indices, bucket).
+    """
+    num_tokens = np.asarray(num_tokens)
+    batches = []
+    for bucket, (height, width) in enumerate(bounds):
+        members = np.flatnonzero(buckets == bucket)
+        members = rng.permutation(members) if rng is not None else members[np.argsort(num_tokens[members], kind='stable')]
+        cap = max(1, max_pixels // max(height * width, 1))
+        if max_batch:
+            cap = min(cap, max_batch)
+        batch, longest = [], 0
+        for i in members:
+            grown = max(longest, num_tokens[i])
+            if batch and (len(batch) >= cap or (max_tokens and (len(batch) + 1) * grown > max_tokens)):
+                batches.append((batch, bucket))
+                batch, grown = [], num_tokens[i]
+            batch.append(int(i))
+            longest = grown
+        if batch:
+            batches.append((batch, bucket))
+    return batches
+
+
+def padding_stats(batches, heights, widths, max_pixels):
+    """Padding waste (share of padded batch pixels that are padding) and mean batch fill
+    (padded batch pixels / max_pixels) of (image indices, (padded height, padded width)) batches."""
+    heights, widths = np.asarray(heights, dtype=np.int64), np.asarray(widths, dtype=np.int64)
+    real = np.array([(heights[idx] * widths[idx]).sum() for idx, _ in batches], dtype=np.float64)
+    padded = np.array([len(idx) * size[0] * size[1] for idx, size in batches], dtype=np.float64)
+    return {'batches': len(batches), 'mean images / batch': float(np.mean([len(idx) for idx, _ in batches])),
+            'padding waste %': float(100 * (1 - real.sum() / padded.sum())), 'mean batch fill %': float(100 * np.mean(padded / max_pixels))}
@@ -0,0 +1,71 @@
+import contextlib
+import functools
+import torch
+from torch.utils.checkpoint import checkpoint
+
+from x_transformers.x_transformers import AttentionLayers
+from timm.models.vision_transformer import VisionTransformer
+
+from swin import WindowedViTransformerWrapper
+
+
+class CheckpointMixin:
+    """Recomputes the wrapped module's activations in backward instead of storing them.
+
+    `checkpoint` selects recomputation, `offload` keeps whatever is saved for backward in
+    CPU memory. Both only apply while training with grad enabled.
+    """
+    checkpoint = False
+    offload = False
+
+    def forward(self, *args, **kwargs):
+        forward = super().forward
+        if not (self.training and torch.is_grad_enabled()):
+            return forward(*args, **kwargs)
+        offload = torch.autograd.graph.save_on_cpu(pin_memory=torch.cuda.is_available()) if self.offload else contextlib.nullcontext()
+        with offload:
+            if self.checkpoint:
+                return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+            return forward(*args, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def checkpointed_class(cls):
+    # swapping in a subclass keeps parameters and state_dict keys unchanged
+    return type('Checkpointed' + cls.__name__, (CheckpointMixin, cls), {})
+
+
+def transformer_blocks(module):
+    """Transformer blocks of `module` as lists of the modules that make up each block."""
+    if isinstance(module, AttentionLayers):
+        # x_transformers keeps one (norm, block, residual) entry per attention / cross-attention /
+        # feedforward sublayer; a transformer block is len_default_block consecutive entries
+        block_len = getattr(module, 'len_default_block', None) or len(module.layer_types) // max(1, module.layer_types.count('a'))
+        blocks = [[] for _ in range(-(-len(module.layers) // block_len))]
+        for ind, (_, block, _) in enumerate(module.layers):
+            blocks[ind // block_len].append(block)
+        return blocks
+    if isinstance(module, VisionTransformer):
+        return [[block] for block in module.blocks]
+    if isinstance(module, WindowedViTransformerWrapper):
+        return [[block] for block in module.local_layers]
+    return []
+
+
+def set_checkpointing(module, every=0, offload=False):
+    """Activation checkpointing for every `every`-th transformer block in `module` (0 = none).
+
+    Covers x_transformers Encoder/Decoder layers, timm ViT blocks and the local layers of the
+    'swin' encoder. With `offload` the activations the remaining blocks keep for backward
+    live in (pinned) CPU memory instead of on the accelerator.
+    """
+    if not every and not offload:
+        return module
+    for m in list(module.modules()):
+        for i, block in enumerate(transformer_blocks(m)):
+            for sub in block:
+                if not isinstance(sub, CheckpointMixin):
+                    sub.__class__ = checkpointed_class(sub.__class__)
+                sub.checkpoint = bool(every) and i % every == 0
+                sub.offload = offload
+    return module
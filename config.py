@@ -1,8 +1,11 @@
+import os
+
+
 def get_args():
     return ModelConfig()
 
 class ModelConfig:
-    encoder_structure: str = 'vit'  # Options: 'vit', 'hybrid'
+    encoder_structure: str = 'vit'  # Options: 'vit', 'hybrid', 'swin' (shifted-window local attention)
     decoder_structure: str = 'transformer'  # Currently only 'transformer' is supported
     device: str = 'cuda'  # Device to run the model on (use 'cuda' if CUDA is available)
     num_tokens: int = 512  # Vocabulary size
@@ -15,9 +18,47 @@ class ModelConfig:
     dropout: float = 0.1  # Dropout rate
     attn_dropout: float = 0.1  # Attention dropout rate
     ff_dropout: float = 0.1  # Feedforward dropout rate
+    attn_impl: str = None  # Attention kernel for encoder and decoder: 'math', 'sdpa', 'chunked' (None = library default)
+    attn_chunk_size: int = 1024  # Queries per chunk when attn_impl = 'chunked'
+    encoder_checkpoint_every: int = 0  # Recompute every k-th encoder block's activations in backward (0 = off)
+    decoder_checkpoint_every: int = 0  # Recompute every k-th decoder block's activations in backward (0 = off)
+    checkpoint_offload: bool = False  # Keep saved activations of encoder/decoder blocks in CPU memory during training
     bos_token: int = 1  # Beginning of sequence token ID
     eos_token: int = 2  # End of sequence token ID
     pad_token: int = 0  # Padding token ID
+    beam_width: int = 1  # Beam width for Model.generate (1 = temperature sampling)
+    length_penalty: float = 1.0  # Beam scores are divided by length ** length_penalty
+    draft_layers: int = 0  # Layers of the draft decoder for speculative decoding (0 = no draft decoder)
+    num_draft_tokens: int = 4  # Tokens the draft decoder proposes per verification step
+    train_draft: bool = False  # train.py: train only the draft decoder on the frozen model loaded from `checkpoint`
+    nar_layers: int = 0  # Layers of the non-autoregressive mask-predict decoder trained next to the main decoder (0 = none)
+    nar_iterations: int = 4  # Mask-predict refinement passes at inference
+    nar_length_beam: int = 3  # Candidate lengths decoded in parallel by mask-predict
+    nar_loss_weight: float = 1.0  # Weight of the mask-predict loss added in train.train_epoch
+    ctc_head: bool = False  # ViT encoder: CTC head over patch-grid columns for Model.generate(mode='ctc'), trained as an auxiliary loss
+    ctc_loss_weight: float = 0.5  # Weight of the CTC loss added in train.train_epoch
+    inference_precision: str = 'fp32'  # quantization.build_inference_model: 'fp32', 'bf16' (autocast) or 'int8' (dynamic Linear quantization, CPU)
+    precision_report: bool = False  # evaluate.py: also compare EM / latency of fp32, bf16 and int8 on CPU
+    constrained_decoding: bool = False  # evaluate.py: also decode with the LaTeX grammar masks (grammar.py) and report invalid rate / length
+    grammar_max_depth: int = 8  # Deepest brace nesting the decoding grammar allows
+    checkpoint: str = None  # Model checkpoint loaded by train.py (draft training) and evaluate.py
+    data_root: str = os.environ.get('DATA_ROOT', 'D:/projectDAT/image-computer/new_process/Data/')  # Folder with tokenizer.json, the CSV and the images (env DATA_ROOT overrides)
+    data_csv: str = 'dataCombined_with_crohme.csv'  # Label CSV inside data_root
+    manifest_path: str = None  # Cached image manifest (Parquet); None = <data_root>/manifest.parquet
+    manifest_workers: int = 16  # Threads scanning new / changed images for the manifest
+    manifest_rescan: bool = True  # Stat every image to pick up changed files (False trusts the cached manifest as is)
+    shard_dir: str = None  # Packed pre-decoded images from shards.py, read instead of the PNGs (None = decode PNGs)
+    loader_workers: int = 0  # Worker processes building get_batch batches ahead of training (prefetch.py); 0 = in the training loop
+    prefetch_batches: int = 4  # Batches each loader worker keeps ready
+    pin_memory: bool = False  # Pin prefetched batches for asynchronous host-to-GPU copies (CUDA only)
+    image_max_size: int = 512  # Training transform scales the longest image side to this
+    bucket_count: int = 0  # Aspect-ratio buckets batched to a pixel / token budget and padded per bucket (bucketing.py); 0 = exact (width, height) groups of batch_size
+    batch_max_pixels: int = None  # Padded pixels per bucketed batch; None = batch_size * max_height * max_width
+    batch_max_tokens: int = None  # Padded label tokens per bucketed batch (None = no token limit)
+    shuffle_batches: bool = True  # Seeded shuffle of get_batch batches, within and across buckets (batch_sampler.py)
+    data_seed: int = 0  # Seed of the batch order; epoch e uses (data_seed, e)
+    checkpoint_every: int = 0  # Also save model_checkpoint_latest.pt (with the sampler position) every N batches; 0 = epoch ends only
+    resume: str = None  # train.py checkpoint to resume from: model, optimizer, epoch and the next unseen batch
     wandb: bool = False  # Whether to use Weights & Biases for logging
     decoder_args: dict = {}  # Additional arguments for the decoder
     encoder_args: dict = {}  # Additional arguments for the encoder
@@ -27,11 +68,19 @@ class ModelConfig:
     max_height: int = 400  # Maximum height of input images
     max_width: int = 528  # Maximum width of input images
     patch_size: int = 1  # Patch size for the ViT encoder
+    conv_stem_stride: int = 0  # ViT encoder: strided conv stem (4, 8 or 16) before patching; tokens cover conv_stem_stride * patch_size pixels (0 = off)
+    backbone_layers: list = [2, 3, 7]  # ResNetV2 stage depths of the hybrid encoder; patch_size must be a multiple of 2 ** (len + 1)
+    pos_embedding_type: str = 'full'  # ViT positional embedding: 'full', 'factorized' (row + column) or 'sinusoidal'
     emb_dropout: float = 0.1  # Embedding dropout rate for the encoder
     encoder_depth: int = 4  # Depth of the encoder (number of layers)
+    window_size: int = 8  # 'swin' encoder: patches per side of each local attention window
+    global_depth: int = 2  # 'swin' encoder: global attention layers after the local layers
     heads: int = 4  # Number of attention heads in the encoder
     dim_head: int = 32  # Dimension of each attention head in the encoder
     ff_dropout: float = 0.1  # Feedforward dropout rate in the encoder
     ff_mult: int = 4  # Feedforward network multiplier in the encoder
-    patch_dropout: float = 0.1  # Dropout rate for patches in the encoder
+    patch_dropout: float = 0.1  # Share of patch tokens the ViT / hybrid encoder drops while training (off at eval)
+    patch_dropout_ink_bias: float = 0.  # Added to the keep score of ink-bearing patches (>= 1 drops blank patches first)
+    prune_blank_patches: bool = False  # Drop all-background patches before the ViT encoder layers
+    blank_threshold: float = 0.99  # Patches whose pixels are all >= this value count as background
     gc_args: dict = None  # Additional arguments for the gc encoder (if used)
\ No newline at end of file
@@ -0,0 +1,49 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class CTCHead(nn.Module):
+    """Column-wise CTC classifier over encoder tokens.
+
+    Patch tokens are mean-pooled per patch-grid column (respecting pruning / dropout masks),
+    giving one frame per column left to right, and each frame is classified over the
+    vocabulary. The pad token doubles as the CTC blank, so no extra class is needed.
+    """
+    def __init__(self, dim, num_classes):
+        super().__init__()
+        self.norm = nn.LayerNorm(dim)
+        self.to_logits = nn.Linear(dim, num_classes)
+
+    def forward(self, x, columns, width, mask=None):
+        # x: (b, n, d) patch tokens, columns: (n,) or (b, n) grid column of each token; returns (b, width, classes)
+        b, n, d = x.shape
+        columns = columns.expand(b, n) if columns.dim() == 1 else columns
+        weight = torch.ones((b, n), dtype=x.dtype, device=x.device) if mask is None else mask.to(x.dtype)
+        pooled = x.new_zeros((b, width, d)).scatter_add_(1, columns[..., None].expand(b, n, d), x * weight[..., None])
+        counts = x.new_zeros((b, width)).scatter_add_(1, columns, weight)
+        return self.to_logits(self.norm(pooled / counts.clamp(min=1)[..., None]))
+
+
+def ctc_loss(logits, tgt_seq, pad_token, bos_token, eos_token):
+    """CTC loss of (b, T, V) frame logits against (bos, tokens..., eos, pad...) targets, blank = pad."""
+    targets = tgt_seq[:, 1:]
+    is_token = (targets != pad_token) & (targets != eos_token) & (targets != bos_token)
+    target_lengths = is_token.long().cumprod(dim=-1).sum(dim=-1)
+    log_probs = F.log_softmax(logits.float(), dim=-1).transpose(0, 1)
+    input_lengths = torch.full((logits.shape[0],), logits.shape[1], dtype=torch.long, device=logits.device)
+    return F.ctc_loss(log_probs, targets, input_lengths, target_lengths, blank=pad_token, zero_infinity=True)
+
+
+def ctc_greedy_decode(logits, pad_token, eos_token):
+    """Best-path decoding: argmax per frame, merge repeats, drop blanks. Returns (b, T + 1)
+    tokens followed by eos and padding, the layout CustomARWrapper.generate returns."""
+    pred = logits.argmax(dim=-1)
+    b, t = pred.shape
+    keep = (pred != pad_token) & F.pad(pred[:, 1:] != pred[:, :-1], (1, 0), value=True)
+    position = keep.long().cumsum(dim=-1) - 1
+    # dropped frames are written to a spare last column that is cut off again
+    out = pred.new_full((b, t + 2), pad_token)
+    out.scatter_(1, torch.where(keep, position, t + 1), pred)
+    out[torch.arange(b, device=pred.device), keep.sum(dim=-1)] = eos_token
+    return out[:, :t + 1]
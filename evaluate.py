@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 from typing import List
 import numpy as np
@@ -12,9 +13,11 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 from difflib import SequenceMatcher
 
-from Dataset import CustomDataset
+from Dataset import CustomDataset, manifest_kwargs
 from model import get_model
 from config import get_args
+from grammar import LatexGrammar
+from quantization import PRECISIONS, quantized_copy, state_dict_bytes
 
 
 def decode_tokens(tokenizer: PreTrainedTokenizerFast, token_ids: List[int]) -> str:
@@ -27,7 +30,7 @@ def similarity(a: str, b: str) -> float:
     return SequenceMatcher(None, a, b).ratio()
 
 
-def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast, device: torch.device, ckpt_path: str = None, batch_size: int = 8, args=None):
+def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast, device: torch.device, ckpt_path: str = None, batch_size: int = 8, args=None, beam_width: int = None, speculative: bool = None, grammar: LatexGrammar = None, constrained: bool = False, mode: str = 'ar', iterations: int = None):
     model = model.to(device)
     if ckpt_path:
         ck = torch.load(ckpt_path, map_location=device)
@@ -74,6 +77,26 @@ def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast,
     exact = 0
     total = 0
     sim_sum = 0.0
+    # generate() wall time, and draft proposal / acceptance counts when decoding speculatively
+    gen_time = 0.0
+    spec_stats = {}
+    speculative = getattr(model, 'draft', None) is not None and speculative is not False and mode == 'ar'
+    gen_kwargs = dict(speculative=True, stats=spec_stats) if speculative else dict(speculative=False)
+    # with a grammar, count predictions it rejects and their decoded lengths; `constrained` also decodes under it
+    invalid = 0
+    length_sum = 0
+    if constrained:
+        gen_kwargs['grammar'] = grammar
+    if mode != 'ar':
+        gen_kwargs.update(mode=mode, iterations=iterations)
+
+    def check(token_ids):
+        nonlocal invalid, length_sum
+        if grammar is None:
+            return
+        invalid += not grammar.is_valid(token_ids)
+        eos = getattr(args, 'eos_token', grammar.eos_token)
+        length_sum += next((i for i, t in enumerate(token_ids) if t == eos), len(token_ids))
 
     # If dataset provides get_batch generator, use it for images/token pairs
     if hasattr(dataset, 'get_batch'):
@@ -104,7 +127,7 @@ def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast,
                 # get patch size from args or model.encoder
                 ps = None
                 if args is not None and hasattr(args, 'patch_size'):
-                    ps = args.patch_size
+                    ps = args.patch_size * (getattr(args, 'conv_stem_stride', 0) or 1)
                 else:
                     enc = getattr(model, 'encoder', None)
                     ps = getattr(enc, 'patch_size', 16) if enc is not None else 16
@@ -136,10 +159,13 @@ def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast,
             images = images.to(device)
             # generate predictions (use model.generate if available)
             with torch.no_grad():
-                preds = model.generate(images)
+                t0 = time.perf_counter()
+                preds = model.generate(images, beam_width=beam_width, **gen_kwargs)
+                gen_time += time.perf_counter() - t0
 
             # preds: tensor BxL
             for i in range(preds.shape[0]):
+                check(preds[i].tolist())
                 pred = decode_tokens(tokenizer, preds[i].tolist())
                 target = tokenizer.decode(toks['input_ids'][i].tolist(), skip_special_tokens=True)
                 total += 1
@@ -157,7 +183,10 @@ def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast,
             except Exception:
                 continue
             with torch.no_grad():
-                preds = model.generate(images)
+                t0 = time.perf_counter()
+                preds = model.generate(images, beam_width=beam_width, **gen_kwargs)
+                gen_time += time.perf_counter() - t0
+            check(preds[0].tolist())
             pred = decode_tokens(tokenizer, preds[0].tolist())
             target = tokenizer.decode(item['input_ids'].tolist(), skip_special_tokens=True)
             total += 1
@@ -167,19 +196,60 @@ def evaluate(model, dataset: CustomDataset, tokenizer: PreTrainedTokenizerFast,
 
     avg_sim = sim_sum / total if total > 0 else 0.0
     em = exact / total if total > 0 else 0.0
-    logging.info(f'Evaluation finished: total={total}, EM={em:.4f}, avg_sim={avg_sim:.4f}')
-    return {'total': total, 'EM': em, 'avg_sim': avg_sim}
+    latency = gen_time / total * 1e3 if total > 0 else 0.0
+    logging.info(f'Evaluation finished: total={total}, EM={em:.4f}, avg_sim={avg_sim:.4f}, latency={latency:.1f} ms/image')
+    results = {'total': total, 'EM': em, 'avg_sim': avg_sim, 'latency_ms': latency}
+    # beam search and grammar-constrained decoding fall back to the plain decoder (no stats)
+    if speculative and spec_stats:
+        results['accept_rate'] = spec_stats.get('accepted', 0) / max(1, spec_stats.get('proposed', 0))
+        logging.info(f'Speculative decoding: accept_rate={results["accept_rate"]:.4f}, decoder steps={spec_stats.get("steps", 0)}')
+    if grammar is not None:
+        results['invalid_rate'] = invalid / total if total > 0 else 0.0
+        results['mean_len'] = length_sum / total if total > 0 else 0.0
+        logging.info(f'Grammar check ({"constrained" if constrained else "unconstrained"}): invalid_rate={results["invalid_rate"]:.4f}, mean_len={results["mean_len"]:.1f} tokens')
+    return results
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     args = get_args()
     device = torch.device(args.device if hasattr(args, 'device') else ('cuda' if torch.cuda.is_available() else 'cpu'))
-    tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(args.data_root if hasattr(args, 'data_root') else 'D:/projectDAT/image-computer/new_process/Data', 'tokenizer.json'), unk_token='[UNK]', pad_token='[PAD]', cls_token='[CLS]', sep_token='[SEP]', mask_token='[MASK]')
-    df_path = os.path.join(args.data_root if hasattr(args, 'data_root') else 'D:/projectDAT/image-computer/new_process/Data', 'dataCombined_with_crohme.csv')
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(args.data_root, 'tokenizer.json'), unk_token='[UNK]', pad_token='[PAD]', cls_token='[CLS]', sep_token='[SEP]', mask_token='[MASK]')
+    df_path = os.path.join(args.data_root, args.data_csv)
     df = pd.read_csv(df_path)
     df = df[df['data_source'] == 'CROHME'].reset_index(drop=True)
     df = df[df['tags'] == 'test'].reset_index(drop=True)
-    dataset = CustomDataset(data=df, tokenizer=tokenizer, max_seq_len=getattr(args, 'max_seq_len', 150), test=True)
+    dataset = CustomDataset(data=df, tokenizer=tokenizer, max_seq_len=getattr(args, 'max_seq_len', 150), test=True, **manifest_kwargs(args))
     model = get_model(args)
-    evaluate(model, dataset, tokenizer, device, ckpt_path=None, batch_size=8)
+    grammar = None
+    if getattr(args, 'constrained_decoding', False):
+        grammar = LatexGrammar.from_tokenizer(tokenizer, args.eos_token, banned_tokens={args.pad_token, args.bos_token},
+                                              max_depth=getattr(args, 'grammar_max_depth', 8), num_tokens=args.num_tokens)
+    results = evaluate(model, dataset, tokenizer, device, ckpt_path=getattr(args, 'checkpoint', None), batch_size=8, beam_width=getattr(args, 'beam_width', 1), speculative=False, grammar=grammar)
+    if model.mask_predict is not None:
+        # latency vs exact match of non-autoregressive decoding at a few refinement budgets
+        for iterations in sorted({1, 2, getattr(args, 'nar_iterations', 4)}):
+            nar = evaluate(model, dataset, tokenizer, device, batch_size=8, mode='mask_predict', iterations=iterations)
+            logging.info(f'Mask-predict ({iterations} iterations) vs autoregressive: EM {nar["EM"]:.4f} / {results["EM"]:.4f}, '
+                         f'latency {nar["latency_ms"]:.1f} / {results["latency_ms"]:.1f} ms/image, speedup {results["latency_ms"] / max(nar["latency_ms"], 1e-9):.2f}x')
+    if model.has_ctc:
+        ctc = evaluate(model, dataset, tokenizer, device, batch_size=8, mode='ctc')
+        logging.info(f'CTC vs autoregressive: EM {ctc["EM"]:.4f} / {results["EM"]:.4f}, '
+                     f'latency {ctc["latency_ms"]:.1f} / {results["latency_ms"]:.1f} ms/image, speedup {results["latency_ms"] / max(ctc["latency_ms"], 1e-9):.2f}x')
+    if getattr(args, 'precision_report', False):
+        # CPU serving report: the same split with fp32, bf16 autocast and dynamic int8 weights
+        for precision in PRECISIONS:
+            served = quantized_copy(model, precision)
+            r = evaluate(served, dataset, tokenizer, torch.device('cpu'), batch_size=8, beam_width=getattr(args, 'beam_width', 1), speculative=False)
+            logging.info(f'{precision}: EM {r["EM"]:.4f}, avg_sim {r["avg_sim"]:.4f}, latency {r["latency_ms"]:.1f} ms/image, '
+                         f'weights {state_dict_bytes(served) / 2 ** 20:.1f} MB')
+    if grammar is not None:
+        # same split decoded under the grammar masks
+        cons = evaluate(model, dataset, tokenizer, device, batch_size=8, beam_width=getattr(args, 'beam_width', 1), speculative=False, grammar=grammar, constrained=True)
+        logging.info(f'Constrained vs plain: invalid_rate {cons["invalid_rate"]:.4f} / {results["invalid_rate"]:.4f}, mean_len {cons["mean_len"]:.1f} / {results["mean_len"]:.1f}, '
+                     f'EM {cons["EM"]:.4f} / {results["EM"]:.4f}, latency {cons["latency_ms"]:.1f} / {results["latency_ms"]:.1f} ms/image')
+    if model.draft is not None and getattr(args, 'beam_width', 1) == 1:
+        # speculative decoding report against the plain decoder on the same split (beam search never uses the draft)
+        spec = evaluate(model, dataset, tokenizer, device, batch_size=8, beam_width=getattr(args, 'beam_width', 1), speculative=True)
+        logging.info(f'Speculative vs plain: EM {spec["EM"]:.4f} / {results["EM"]:.4f}, latency {spec["latency_ms"]:.1f} / {results["latency_ms"]:.1f} ms/image, '
+                     f'speedup {results["latency_ms"] / max(spec["latency_ms"], 1e-9):.2f}x, accept_rate {spec.get("accept_rate", float("nan")):.4f}')
@@ -1,9 +1,49 @@
+import math
+import functools
 import torch
 import torch.nn as nn
 
 from x_transformers import Encoder
 from einops import rearrange, repeat
 
+from attention import set_attn_impl, attn_layer_kwargs
+from ctc import CTCHead
+
+
+@functools.lru_cache(maxsize=64)
+def patch_indices(n, device):
+    """arange(n) on `device`, cached so every batch of the same shape reuses it."""
+    return torch.arange(n, device=device, dtype=torch.long)
+
+
+@functools.lru_cache(maxsize=64)
+def _axis_embedding(n, quarter, device):
+    # (n, 2 * quarter) sin / cos of positions 0..n-1 along one grid axis; small, so cached
+    omega = torch.exp(torch.arange(quarter, device=device, dtype=torch.float) * (-math.log(10000.) / max(1, quarter)))
+    pos = torch.arange(n, device=device, dtype=torch.float)[:, None] * omega
+    return torch.cat((pos.sin(), pos.cos()), dim=-1)
+
+
+def sinusoidal_pos_embedding(h, w, dim, device):
+    """Fixed 2D sin/cos table (h * w, dim) for an h x w patch grid. Only the per-axis tables are
+    cached: a full table is (h * w, dim) floats, hundreds of MB for large grids."""
+    quarter = dim // 4
+    rows, cols = _axis_embedding(h, quarter, device), _axis_embedding(w, quarter, device)
+    emb = torch.cat((rows[:, None].expand(h, w, -1), cols[None].expand(h, w, -1)), dim=-1).reshape(h * w, 4 * quarter)
+    return nn.functional.pad(emb, (0, dim - 4 * quarter))
+
+
+def conv_stem(channels, dim, stride):
+    """3x3 stride-2 conv + BN + ReLU stages down to 1/stride resolution, then a 1x1 projection to dim."""
+    assert stride >= 2 and stride & (stride - 1) == 0, 'conv stem stride must be a power of 2'
+    stages = int(math.log2(stride))
+    widths = [channels] + [max(16, dim >> (stages - 1 - i)) for i in range(stages)]
+    layers = []
+    for c_in, c_out in zip(widths[:-1], widths[1:]):
+        layers += [nn.Conv2d(c_in, c_out, 3, stride=2, padding=1, bias=False), nn.BatchNorm2d(c_out), nn.ReLU(inplace=True)]
+    layers.append(nn.Conv2d(widths[-1], dim, 1))
+    return nn.Sequential(*layers)
+
 
 class ViTransformerWrapper(nn.Module):
     def __init__(
@@ -16,64 +56,188 @@ class ViTransformerWrapper(nn.Module):
         channels=1,
         num_classes=None,
         dropout=0.,
-        emb_dropout=0.
+        emb_dropout=0.,
+        prune_blank=False,
+        blank_threshold=0.99,
+        pos_embedding_type='full',
+        stem_stride=0,
+        patch_dropout=0.,
+        patch_dropout_ink_bias=0.,
+        ctc_classes=None
     ):
         super().__init__()
         assert isinstance(attn_layers, Encoder), 'attention layers must be an Encoder'
-        assert max_width % patch_size == 0 and max_height % patch_size == 0, 'image dimensions must be divisible by the patch size'
         dim = attn_layers.dim
+        # with a conv stem, patch_size patches are cut from the stem's feature map, so one token
+        # covers stem_stride * patch_size pixels; self.patch_size is that total stride
+        self.stem = conv_stem(channels, dim, stem_stride) if stem_stride else None
+        self.feature_patch_size = patch_size
+        patch_dim = (dim if self.stem is not None else channels) * patch_size ** 2
+        patch_size = patch_size * (stem_stride or 1)
+        assert max_width % patch_size == 0 and max_height % patch_size == 0, 'image dimensions must be divisible by the patch size'
         num_patches = (max_width // patch_size)*(max_height // patch_size)
-        patch_dim = channels * patch_size ** 2
 
         self.patch_size = patch_size
         self.max_width = max_width
         self.max_height = max_height
+        # drop patches whose pixels are all >= blank_threshold (white background) before attn_layers
+        self.prune_blank = prune_blank
+        self.blank_threshold = blank_threshold
+        # training only: keep a random (1 - patch_dropout) share of the patch tokens; ink-bearing
+        # patches get patch_dropout_ink_bias added to their random keep score (>= 1 drops blanks first)
+        self.patch_dropout = patch_dropout
+        self.patch_dropout_ink_bias = patch_dropout_ink_bias
 
-        self.pos_embedding = nn.Parameter(torch.randn(1, num_patches + 1, dim))
+        # 'full': one learned vector per patch position (num_patches + 1, dim)
+        # 'factorized': learned row + column tables, up to max_height x max_width
+        # 'sinusoidal': fixed 2D sin/cos encoding, no size limit and no parameters
+        assert pos_embedding_type in ('full', 'factorized', 'sinusoidal'), 'unknown pos_embedding_type %s' % pos_embedding_type
+        self.pos_embedding_type = pos_embedding_type
+        if pos_embedding_type == 'full':
+            self.pos_embedding = nn.Parameter(torch.randn(1, num_patches + 1, dim))
+        else:
+            self.cls_pos_embedding = nn.Parameter(torch.randn(1, 1, dim))
+        if pos_embedding_type == 'factorized':
+            self.row_embedding = nn.Parameter(torch.randn(max_height // patch_size, dim))
+            self.col_embedding = nn.Parameter(torch.randn(max_width // patch_size, dim))
         self.patch_to_embedding = nn.Linear(patch_dim, dim)
         self.cls_token = nn.Parameter(torch.randn(1, 1, dim))
         self.dropout = nn.Dropout(emb_dropout)
 
         self.attn_layers = attn_layers
         self.norm = nn.LayerNorm(dim)
+        # optional single-pass recognition head: one CTC frame per patch-grid column
+        self.ctc_head = CTCHead(dim, ctc_classes) if ctc_classes else None
         #self.mlp_head = FeedForward(dim, dim_out = num_classes, dropout = dropout) if exists(num_classes) else None
 
-    def forward(self, img, **kwargs):
+    def patch_pos_embedding(self, pos_indices, h, w):
+        """Positional embedding of the patches at flat indices `pos_indices` of an h x w patch grid."""
+        if self.pos_embedding_type == 'full':
+            return self.pos_embedding[0, 1:][pos_indices]
+        if self.pos_embedding_type == 'factorized':
+            return self.row_embedding[pos_indices // w] + self.col_embedding[pos_indices % w]
+        table = sinusoidal_pos_embedding(h, w, self.cls_token.shape[-1], pos_indices.device)
+        return table.to(self.cls_token.dtype)[pos_indices]
+
+    def forward(self, img, return_mask=False, return_ctc=False, **kwargs):
+        """Encoded tokens (b, 1 + n, dim); with `return_ctc` returns (x, mask, ctc_logits) where
+        ctc_logits (b, grid width, classes) come from the CTC head."""
         p = self.patch_size
 
         x = rearrange(img, 'b c (h p1) (w p2) -> b (h w) (p1 p2 c)', p1=p, p2=p)
-        x = self.patch_to_embedding(x)
         b, n, _ = x.shape
+        h, w = img.shape[2] // p, img.shape[3] // p
+        # raw pixel patches decide blank pruning; the stem's features are what gets embedded
+        pixels = x
+        if self.stem is not None:
+            fp = self.feature_patch_size
+            x = rearrange(self.stem(img), 'b c (h p1) (w p2) -> b (h w) (p1 p2 c)', p1=fp, p2=fp)
+        if self.pos_embedding_type == 'factorized':
+            assert h <= self.row_embedding.shape[0] and w <= self.col_embedding.shape[0], 'image larger than max_height x max_width'
+        # Flat patch index in the image grid; the cls token gets its own position in front.
+        # Ensure indices are on the same device as the embeddings and are long dtype.
+        device = self.cls_token.device
+        pos_indices = patch_indices(n, device)
+        mask = None
+
+        drop = self.training and self.patch_dropout > 0
+        if self.prune_blank or (drop and self.patch_dropout_ink_bias):
+            ink = (pixels < self.blank_threshold).any(dim=-1)
+
+        if self.prune_blank:
+            # keep ink-bearing patches (in image order) at the front of each row and cut the
+            # batch to the row with the most ink; shorter rows are masked out for attention
+            num_ink = ink.sum(dim=1)
+            order = torch.sort((~ink).to(torch.uint8), dim=1, stable=True).indices[:, :max(1, int(num_ink.max()))]
+            x = x.gather(1, repeat(order, 'b n -> b n d', d=x.shape[-1]))
+            ink = ink.gather(1, order)
+            pos_indices = pos_indices[order.to(device)]
+            mask = torch.arange(order.shape[1], device=x.device)[None, :] < num_ink[:, None]
+            mask = torch.cat((torch.ones_like(mask[:, :1]), mask), dim=1)
+
+        if drop:
+            # subsample the same number of tokens per row (in image order) so the encoder
+            # runs on a shorter sequence; masked-out rows of pruning are dropped first
+            scores = torch.rand(x.shape[:2], device=x.device)
+            if self.patch_dropout_ink_bias:
+                scores = scores + ink * self.patch_dropout_ink_bias
+            if mask is not None:
+                scores = scores.masked_fill(~mask[:, 1:], -1)
+            keep = max(1, int(x.shape[1] * (1 - self.patch_dropout)))
+            order = scores.topk(keep, dim=1).indices.sort(dim=1).values
+            x = x.gather(1, repeat(order, 'b n -> b n d', d=x.shape[-1]))
+            pos_indices = pos_indices[order.to(device)] if pos_indices.dim() == 1 else pos_indices.gather(1, order.to(device))
+            if mask is not None:
+                mask = torch.cat((mask[:, :1], mask[:, 1:].gather(1, order)), dim=1)
+
+        if mask is not None:
+            kwargs['mask'] = mask
+
+        x = self.patch_to_embedding(x) + self.patch_pos_embedding(pos_indices, h, w)
 
-        cls_tokens = repeat(self.cls_token, '() n d -> b n d', b=b)
+        cls_pos = self.pos_embedding[:, :1] if self.pos_embedding_type == 'full' else self.cls_pos_embedding
+        cls_tokens = repeat(self.cls_token + cls_pos, '() n d -> b n d', b=b)
         x = torch.cat((cls_tokens, x), dim=1)
-        # number of patches in image along H and W
-        h = img.shape[2] // p
-        w = img.shape[3] // p
-        # Use the first (h*w) positional indices after the cls token.
-        # Ensure indices are on the same device as pos_embedding and are long dtype.
-        device = self.pos_embedding.device
-        pos_indices = torch.arange(1, h * w + 1, device=device, dtype=torch.long)
-        pos_emb_ind = torch.cat((torch.zeros(1, device=device, dtype=torch.long), pos_indices), dim=0)
-        x = x + self.pos_embedding[:, pos_emb_ind]
         x = self.dropout(x)
 
         x = self.attn_layers(x, **kwargs)
         x = self.norm(x)
 
+        if return_ctc:
+            assert self.ctc_head is not None, 'encoder was built without a CTC head'
+            ctc_logits = self.ctc_head(x[:, 1:], pos_indices % w, w, None if mask is None else mask[:, 1:])
+            return x, mask, ctc_logits
+        if return_mask:
+            return x, mask
         return x
 
 
 def get_encoder(args):
-    return ViTransformerWrapper(
+    encoder = ViTransformerWrapper(
         max_width=args.max_width,
         max_height=args.max_height,
         channels=args.channels,
         patch_size=args.patch_size,
         emb_dropout=getattr(args, 'emb_dropout', 0),
+        prune_blank=getattr(args, 'prune_blank_patches', False),
+        blank_threshold=getattr(args, 'blank_threshold', 0.99),
+        pos_embedding_type=getattr(args, 'pos_embedding_type', 'full'),
+        stem_stride=getattr(args, 'conv_stem_stride', 0),
+        patch_dropout=getattr(args, 'patch_dropout', 0),
+        patch_dropout_ink_bias=getattr(args, 'patch_dropout_ink_bias', 0),
+        ctc_classes=args.num_tokens if getattr(args, 'ctc_head', False) else None,
         attn_layers=Encoder(
             dim=args.dim,
             depth=args.encoder_depth,
             heads=args.heads,
+            **attn_layer_kwargs(getattr(args, 'attn_impl', None))
         )
-    )
\ No newline at end of file
+    )
+    return set_attn_impl(encoder, getattr(args, 'attn_impl', None), getattr(args, 'attn_chunk_size', 1024))
+
+
+def convert_pos_embedding(state_dict, grid_height, grid_width, pos_embedding_type='factorized', prefix='encoder.'):
+    """Converts a 'full' pos_embedding in `state_dict` to `pos_embedding_type` in place.
+
+    Training pads every image to the max canvas, so row r / column c of the grid used
+    table entry 1 + r * grid_width + c. The factorized tables are the least-squares
+    row + column fit of that grid; 'sinusoidal' only keeps the cls position.
+    """
+    full = state_dict.pop(prefix + 'pos_embedding')[0]
+    state_dict[prefix + 'cls_pos_embedding'] = full[None, :1].clone()
+    if pos_embedding_type == 'factorized':
+        grid = full[1:grid_height * grid_width + 1].reshape(grid_height, grid_width, -1)
+        state_dict[prefix + 'row_embedding'] = grid.mean(dim=1)
+        state_dict[prefix + 'col_embedding'] = grid.mean(dim=0) - grid.mean(dim=(0, 1))
+    return state_dict
+
+
+if __name__ == '__main__':
+    import sys
+    from config import get_args
+    # python gc_module.py <checkpoint.pt> <converted.pt> [factorized|sinusoidal]
+    args = get_args()
+    ck = torch.load(sys.argv[1], map_location='cpu')
+    convert_pos_embedding(ck['model_state_dict'], args.max_height // args.patch_size, args.max_width // args.patch_size,
+                          pos_embedding_type=sys.argv[3] if len(sys.argv) > 3 else 'factorized')
+    torch.save(ck, sys.argv[2])
@@ -0,0 +1,179 @@
+import re
+import torch
+
+# structural events a token can contain, in order
+ATOM, OPEN, CLOSE, SCRIPT, FRAC, ARG_COMMAND = range(6)
+# what the next event must provide: nothing, any argument (after ^ _ \sqrt ...), the first / second \frac group
+NONE, ARG, FRAC1, FRAC2 = range(4)
+
+FRAC_COMMANDS = {'frac', 'dfrac', 'tfrac', 'cfrac', 'binom'}
+ARG_COMMANDS = {'sqrt', 'hat', 'bar', 'vec', 'dot', 'ddot', 'tilde', 'widehat', 'overline', 'underline',
+                'mathrm', 'mathbf', 'mathit', 'mathbb', 'mathcal', 'text', 'operatorname'}
+TOKEN_RE = re.compile(r'\\[A-Za-z]+|\\.|\\$|[{}^_]|[^\\{}^_\s]+')
+
+
+def token_events(token):
+    """Structural events of one vocabulary string, e.g. '}^{' -> [CLOSE, SCRIPT, OPEN]."""
+    events = []
+    for piece in TOKEN_RE.findall(token.replace('Ġ', ' ').replace('▁', ' ').replace('##', '')):
+        if piece == '{':
+            event = OPEN
+        elif piece == '}':
+            event = CLOSE
+        elif piece in ('^', '_'):
+            event = SCRIPT
+        elif piece[1:] in FRAC_COMMANDS and piece[0] == '\\':
+            event = FRAC
+        elif piece[1:] in ARG_COMMANDS and piece[0] == '\\':
+            event = ARG_COMMAND
+        else:
+            event = ATOM
+        if not (event == ATOM and events and events[-1] == ATOM):
+            events.append(event)
+    return tuple(events)
+
+
+def step(state, event, max_depth):
+    """Next (stack, need) state after `event`, or None if the event is not allowed.
+
+    `stack` holds one flag per open brace group: True if it is the numerator of a \\frac.
+    """
+    stack, need = state
+    if event == ATOM:
+        return None if need in (FRAC1, FRAC2) else (stack, NONE)
+    if event == OPEN:
+        return None if len(stack) == max_depth else (stack + (need == FRAC1,), NONE)
+    if event == CLOSE:
+        if not stack or need != NONE:
+            return None
+        return stack[:-1], FRAC2 if stack[-1] else NONE
+    if event == SCRIPT:
+        return None if need != NONE else (stack, ARG)
+    if event == FRAC:
+        return None if need in (FRAC1, FRAC2) else (stack, FRAC1)
+    # \sqrt, accents, font commands take the next atom or group as their argument
+    return None if need in (FRAC1, FRAC2) else (stack, ARG)
+
+
+class LatexGrammar:
+    """Small LaTeX grammar compiled into per-state vocabulary masks.
+
+    Tracks brace balance (up to max_depth open groups), requires an argument after ^, _
+    and argument-taking commands and exactly two groups after \\frac; eos is only allowed
+    once everything is closed. `masks[state]` is 0 for allowed tokens and -inf otherwise,
+    `next_state[state, token]` the transition and `finish[state]` the fewest tokens (eos
+    included) that complete the expression. Constraining a decode step is one gather + add.
+    """
+    def __init__(self, vocab, eos_token, banned_tokens=(), max_depth=8, num_tokens=None):
+        num_tokens = num_tokens or len(vocab)
+        events = [token_events(tok) if i < len(vocab) and i not in banned_tokens and i != eos_token else None
+                  for i, tok in enumerate(list(vocab) + [''] * (num_tokens - len(vocab)))]
+        # empty tokens ('' or whitespace) have no effect on the structure
+        start = ((), NONE)
+        states, index, queue = [start], {start: 0}, [start]
+        transitions = []
+        signatures = {sig for sig in events if sig is not None}
+        while queue:
+            state = queue.pop()
+            row = {}
+            for sig in signatures:
+                nxt = state
+                for event in sig:
+                    nxt = step(nxt, event, max_depth)
+                    if nxt is None:
+                        break
+                if nxt is not None:
+                    if nxt not in index:
+                        index[nxt] = len(states)
+                        states.append(nxt)
+                        queue.append(nxt)
+                    row[sig] = index[nxt]
+            transitions.append((index[state], row))
+
+        # the extra last state is `done`, reached by eos from any complete state; nothing after
+        # eos is constrained (finished beams keep extending with padding)
+        done = len(states)
+        self.states = states + ['done']
+        self.eos_token = eos_token
+        next_state = torch.full((len(self.states), num_tokens), done, dtype=torch.long)
+        allowed = torch.zeros((len(self.states), num_tokens), dtype=torch.bool)
+        for s, row in transitions:
+            for tok, sig in enumerate(events):
+                if sig in row:
+                    next_state[s, tok] = row[sig]
+                    allowed[s, tok] = True
+            if states[s] == start:
+                allowed[s, eos_token] = True
+        allowed[done] = True
+
+        finish = torch.full((len(self.states),), 1 << 30, dtype=torch.long)
+        finish[done] = 0
+        finish[index[start]] = 1
+        while True:
+            cand = finish[next_state].masked_fill(~allowed, 1 << 30).min(dim=1).values + 1
+            updated = torch.minimum(finish, cand)
+            if torch.equal(updated, finish):
+                break
+            finish = updated
+        # never enter a state that cannot be completed (e.g. \frac with every brace level in use):
+        # then every reachable state keeps at least the tokens of its shortest completion
+        allowed &= finish[next_state] < 1 << 30
+        reachable = torch.zeros(len(self.states), dtype=torch.bool)
+        reachable[index[start]] = True
+        while True:
+            updated = reachable.clone()
+            updated[next_state[reachable][allowed[reachable]]] = True
+            if torch.equal(updated, reachable):
+                break
+            reachable = updated
+        assert allowed[reachable].any(dim=1).all(), 'grammar has a reachable state without any allowed token'
+        self.next_state = next_state
+        self.masks = torch.zeros(allowed.shape).masked_fill_(~allowed, float('-inf'))
+        self.finish = finish
+        # longest shortest-completion of any completable state: with more steps left than this
+        # every allowed token (all completable, see above) still finishes in time
+        self.max_finish = int(finish[finish < 1 << 30].max())
+        self._device_cache = {}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, eos_token, banned_tokens=(), **kwargs):
+        """Grammar over a (PreTrainedTokenizerFast) vocabulary; its special tokens except eos are never allowed."""
+        vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        banned = set(banned_tokens) | (set(getattr(tokenizer, 'all_special_ids', ())) - {eos_token})
+        return cls(vocab, eos_token, banned_tokens=banned, **kwargs)
+
+    def to(self, device):
+        """(masks, next_state, finish) on `device`, moved once and cached."""
+        device = torch.device(device)
+        if device not in self._device_cache:
+            self._device_cache[device] = tuple(t.to(device) for t in (self.masks, self.next_state, self.finish))
+        return self._device_cache[device]
+
+    def initial_state(self, batch, device):
+        return torch.zeros(batch, dtype=torch.long, device=device)
+
+    def constrain(self, logits, state, remaining=None):
+        """Mask logits (B, V) of rows in `state`; with `remaining` decode steps left, also rule out
+        tokens after which the expression could no longer be closed in time. Only the last
+        max_finish steps need that check, so earlier steps are one masked add."""
+        masks, next_state, finish = self.to(logits.device)
+        logits = logits + masks[state].to(logits.dtype)
+        if remaining is not None and remaining - 1 < self.max_finish:
+            logits = logits.masked_fill(finish[next_state[state]] > remaining - 1, float('-inf'))
+        return logits
+
+    def advance(self, state, tokens):
+        return self.to(state.device)[1][state, tokens.view(-1)]
+
+    def is_valid(self, tokens):
+        """True if the token ids form a complete expression (anything after eos is ignored, eos optional)."""
+        state = 0
+        allowed = self.masks == 0
+        for tok in tokens:
+            tok = int(tok)
+            if tok == self.eos_token:
+                return bool(allowed[state, tok])
+            if not allowed[state, tok]:
+                return False
+            state = int(self.next_state[state, tok])
+        return bool(allowed[state, self.eos_token])
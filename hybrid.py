@@ -1,3 +1,4 @@
+import functools
 import torch
 import torch.nn as nn
 
@@ -7,6 +8,15 @@ from timm.models.resnetv2 import ResNetV2
 from timm.models.layers import StdConv2dSame
 from einops import repeat
 
+from attention import set_attn_impl
+
+@functools.lru_cache(maxsize=64)
+def pos_emb_index(h, w, grid_width, device):
+    """Indices into pos_embed for an h x w patch grid, cached per shape on the encoder's device."""
+    pos_emb_ind = repeat(torch.arange(h, device=device)*(grid_width-w), 'h -> (h w)', w=w)+torch.arange(h*w, device=device)
+    return torch.cat((torch.zeros(1, device=device, dtype=torch.long), pos_emb_ind+1), dim=0)
+
+
 class CustomVisionTransformer(VisionTransformer):
     def __init__(self, img_size=224, patch_size=16, *args, **kwargs):
         super(CustomVisionTransformer, self).__init__(img_size=img_size, patch_size=patch_size, *args, **kwargs)
@@ -20,11 +30,13 @@ class CustomVisionTransformer(VisionTransformer):
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
         h, w = h//self.patch_size, w//self.patch_size
-        pos_emb_ind = repeat(torch.arange(h)*(self.width//self.patch_size-w), 'h -> (h w)', w=w)+torch.arange(h*w)
-        pos_emb_ind = torch.cat((torch.zeros(1), pos_emb_ind+1), dim=0).long()
+        # shape-bucketed batches reuse the same device-resident indices
+        pos_emb_ind = pos_emb_index(h, w, self.width//self.patch_size, self.pos_embed.device)
         x += self.pos_embed[:, pos_emb_ind]
         #x = x + self.pos_embed
         x = self.pos_drop(x)
+        # timm PatchDropout: random patch-token subset while training, identity at eval
+        x = self.patch_drop(x)
 
         for blk in self.blocks:
             x = blk(x)
@@ -32,6 +44,10 @@ class CustomVisionTransformer(VisionTransformer):
         x = self.norm(x)
         return x
 
+    def forward(self, x, **kwargs):
+        # the decoder cross-attends to every token; newer timm releases pool in forward_head
+        return self.forward_features(x)
+
 
 def get_encoder(args):
     backbone = ResNetV2(
@@ -51,6 +67,7 @@ def get_encoder(args):
                                       embed_dim=args.dim,
                                       depth=args.encoder_depth,
                                       num_heads=args.heads,
+                                      patch_drop_rate=getattr(args, 'patch_dropout', 0.),
                                       embed_layer=embed_layer
                                       )
-    return encoder
\ No newline at end of file
+    return set_attn_impl(encoder, getattr(args, 'attn_impl', None), getattr(args, 'attn_chunk_size', 1024))
\ No newline at end of file
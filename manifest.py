@@ -0,0 +1,121 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import imagesize
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['name', 'path', 'latex', 'width', 'height', 'size', 'mtime', 'num_tokens', 'data_source', 'tags']
+# nullable while merging: ns mtimes do not survive a round trip through float NaN columns
+INT_COLUMNS = ['width', 'height', 'size', 'mtime', 'num_tokens']
+
+
+def image_path(data_root, name):
+    # same file naming as the original CustomDataset scan
+    return os.path.join(data_root, name.strip('.inkml') + '.png')
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except FileNotFoundError:
+        return -1, -1
+
+
+def _dimensions(path):
+    try:
+        return imagesize.get(path)
+    except (FileNotFoundError, ValueError, OSError):
+        return -1, -1
+
+
+def _chunked_map(pool, fn, paths, chunk=256):
+    # ThreadPoolExecutor.map ignores chunksize; one future per file costs more than a local stat
+    paths = list(paths)
+    chunks = pool.map(lambda part: [fn(p) for p in part], [paths[i:i + chunk] for i in range(0, len(paths), chunk)])
+    return np.array([r for part in chunks for r in part], dtype=np.int64).reshape(-1, 2)
+
+
+def read_manifest(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def write_manifest(manifest, path):
+    # write next to the target and rename, so a crashed or concurrent run never leaves a torn file
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    manifest.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def build_manifest(data, data_root, tokenizer=None, path=None, workers=16, rescan=True):
+    """Per-image metadata of the CSV rows in `data` (columns 'name', 'Latex', optionally
+    'data_source' / 'tags'), cached as a Parquet file at `path`.
+
+    Columns: name, path, latex, width, height, file size, mtime (ns), tokenized label length
+    (-1 without a tokenizer), data_source, tags; missing images have width = height = -1.
+    Rows already in the cache are reused unless their file's size / mtime or their label
+    changed (checked with a parallel stat when `rescan`; without it the cache is trusted as
+    is). Only new or changed files are opened, by `workers` threads. The cache keeps rows of
+    other CSV subsets, so train and test splits share one file.
+    """
+    rows = pd.DataFrame({
+        'name': data['name'].astype(str).to_numpy(),
+        'latex': data['Latex'].astype(str).to_numpy(),
+        'data_source': data['data_source'].astype(str).to_numpy() if 'data_source' in data else '',
+        'tags': data['tags'].astype(str).to_numpy() if 'tags' in data else '',
+    })
+    rows['path'] = [image_path(data_root, name) for name in rows['name']]
+    cached = read_manifest(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if cached is not None:
+            cached = cached.astype({c: 'Int64' for c in INT_COLUMNS})
+            rows = rows.merge(cached.drop(columns=['data_source', 'tags']).drop_duplicates(['name', 'path']).rename(columns={'latex': 'cached_latex'}),
+                              on=['name', 'path'], how='left')
+            stale = rows['width'].isna().to_numpy() | (rows['latex'] != rows['cached_latex']).to_numpy()
+            if rescan:
+                stats = _chunked_map(pool, _stat, rows['path'])
+                stale |= (stats[:, 0] != rows['size'].fillna(-2).to_numpy(np.int64)) | (stats[:, 1] != rows['mtime'].fillna(-2).to_numpy(np.int64))
+            rows = rows.drop(columns=['cached_latex'])
+        else:
+            rows = rows.assign(**{c: pd.array([pd.NA] * len(rows), dtype='Int64') for c in INT_COLUMNS})
+            stale = np.ones(len(rows), dtype=bool)
+
+        todo = np.flatnonzero(stale)
+        if len(todo):
+            logging.info(f'Manifest: scanning {len(todo)} of {len(rows)} images')
+            paths = rows['path'].to_numpy()[todo]
+            dims = _chunked_map(pool, _dimensions, paths, chunk=64)
+            stats = _chunked_map(pool, _stat, paths)
+            rows.loc[todo, ['width', 'height']] = dims
+            rows.loc[todo, ['size', 'mtime']] = stats
+            if tokenizer is not None:
+                labels = rows['latex'].to_numpy()[todo].tolist()
+                rows.loc[todo, 'num_tokens'] = [len(ids) for ids in tokenizer(labels, return_token_type_ids=False, return_attention_mask=False)['input_ids']]
+            else:
+                rows.loc[todo, 'num_tokens'] = -1
+
+    rows = rows[COLUMNS].astype({'width': np.int32, 'height': np.int32, 'size': np.int64, 'mtime': np.int64, 'num_tokens': np.int32})
+    cached = cached if cached is None else cached.astype({'width': np.int32, 'height': np.int32, 'size': np.int64, 'mtime': np.int64, 'num_tokens': np.int32})
+    if path is not None and len(todo):
+        merged = rows if cached is None else pd.concat([cached, rows], ignore_index=True)
+        write_manifest(merged.drop_duplicates(['name', 'path'], keep='last'), path)
+    return rows.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    import time
+    from transformers import PreTrainedTokenizerFast
+    from config import get_args
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # python manifest.py: (re)build the manifest of the whole CSV under args.data_root
+    args = get_args()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file=os.path.join(args.data_root, 'tokenizer.json'))
+    t0 = time.perf_counter()
+    manifest = build_manifest(pd.read_csv(os.path.join(args.data_root, args.data_csv)), args.data_root, tokenizer,
+                              path=args.manifest_path or os.path.join(args.data_root, 'manifest.parquet'), workers=args.manifest_workers)
+    logging.info(f'{len(manifest)} rows, {(manifest["width"] < 0).sum()} missing images, {time.perf_counter() - t0:.2f} s')
@@ -0,0 +1,122 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from x_transformers import TransformerWrapper, Encoder
+
+from attention import set_attn_impl, attn_layer_kwargs
+
+
+class MaskPredictDecoder(nn.Module):
+    """Non-autoregressive decoder (conditional masked LM, mask-predict decoding).
+
+    The target length is classified from the pooled encoder output; all tokens are then
+    predicted in parallel with bidirectional self-attention plus cross-attention to the
+    image, and over a fixed number of iterations the least confident ones are re-masked
+    and predicted again. Decode latency depends on `iterations`, not on the length.
+    """
+    def __init__(self, net, pad_token, bos_token, eos_token, length_loss_weight=0.1):
+        super().__init__()
+        self.net = net
+        self.max_seq_len = net.max_seq_len
+        # one embedding row past the vocabulary is the [MASK] input token; it is never predicted
+        self.mask_token = net.token_emb.emb.num_embeddings - 1
+        self.pad_token = pad_token
+        self.special_tokens = [pad_token, bos_token, eos_token]
+        self.eos_token = eos_token
+        self.length_loss_weight = length_loss_weight
+        dim = net.attn_layers.dim
+        self.length_head = nn.Sequential(nn.LayerNorm(dim), nn.Linear(dim, self.max_seq_len))
+
+    def length_logits(self, context, context_mask=None):
+        # (B, max_seq_len) scores of the number of tokens between bos and eos
+        if context_mask is None:
+            pooled = context.mean(dim=1)
+        else:
+            weight = context_mask.unsqueeze(-1).to(context.dtype)
+            pooled = (context * weight).sum(dim=1) / weight.sum(dim=1).clamp(min=1)
+        return self.length_head(pooled)
+
+    def loss(self, tgt_seq, context, context_mask=None):
+        """Masked-token + length loss for (bos, tokens..., eos, pad...) targets."""
+        tokens = tgt_seq[:, 1:self.max_seq_len + 1]
+        is_token = (tokens != self.pad_token) & (tokens != self.eos_token)
+        lengths = is_token.long().cumprod(dim=-1).sum(dim=-1)
+        valid = torch.arange(tokens.shape[1], device=tokens.device) < lengths[:, None]
+
+        # mask a uniformly drawn number (1..length) of random positions per row
+        num_mask = (torch.rand(lengths.shape, device=tokens.device) * lengths).long() + 1
+        scores = torch.rand(tokens.shape, device=tokens.device).masked_fill(~valid, 2.)
+        masked = (scores.argsort(dim=-1).argsort(dim=-1) < num_mask[:, None]) & valid
+        inp = tokens.masked_fill(masked, self.mask_token).masked_fill(~valid, self.pad_token)
+
+        loss = self.length_loss_weight * F.cross_entropy(self.length_logits(context, context_mask), lengths.clamp(max=self.max_seq_len - 1))
+        if masked.any():
+            logits = self.net(inp, mask=valid, context=context, context_mask=context_mask)
+            loss = loss + F.cross_entropy(logits[masked], tokens[masked])
+        return loss
+
+    @torch.no_grad()
+    def generate(self, context, context_mask=None, iterations=4, length_beam=3):
+        """Returns (B, max_len + 1) tokens followed by eos and padding, like CustomARWrapper.generate.
+
+        The `length_beam` most likely non-zero lengths are decoded side by side and the
+        candidate with the best mean token log-probability is kept.
+        """
+        was_training = self.training
+        self.eval()
+        b, device = context.shape[0], context.device
+        length_beam = min(length_beam, self.max_seq_len - 1)
+        # an empty candidate would score 0 and beat every real one (mean log-probs are negative)
+        length_logits = self.length_logits(context, context_mask)
+        length_logits[:, 0] = float('-inf')
+        lengths = length_logits.topk(length_beam, dim=-1).indices.view(-1)
+        context = context.repeat_interleave(length_beam, dim=0)
+        if context_mask is not None:
+            context_mask = context_mask.repeat_interleave(length_beam, dim=0)
+
+        n = max(1, int(lengths.max()))
+        valid = torch.arange(n, device=device) < lengths[:, None]
+        tokens = torch.full((b * length_beam, n), self.mask_token, dtype=torch.long, device=device).masked_fill(~valid, self.pad_token)
+        probs = torch.zeros(tokens.shape, device=device)
+        for it in range(iterations):
+            logits = self.net(tokens, mask=valid, context=context, context_mask=context_mask).float()
+            logits[..., self.special_tokens] = float('-inf')
+            p, pred = logits.softmax(dim=-1).max(dim=-1)
+            masked = tokens == self.mask_token
+            tokens = torch.where(masked, pred, tokens)
+            probs = torch.where(masked, p, probs)
+            if it == iterations - 1:
+                break
+            # re-mask the least confident tokens, linearly fewer every iteration
+            num_mask = (lengths * (iterations - 1 - it)) // iterations
+            rank = probs.masked_fill(~valid, float('inf')).argsort(dim=-1).argsort(dim=-1)
+            tokens = tokens.masked_fill(rank < num_mask[:, None], self.mask_token)
+
+        score = (probs.clamp(min=1e-9).log() * valid).sum(dim=-1) / lengths.clamp(min=1)
+        best = torch.arange(b, device=device) * length_beam + score.view(b, length_beam).argmax(dim=-1)
+        tokens, lengths = tokens[best], lengths[best]
+        out = F.pad(tokens.masked_fill(~valid[best], self.pad_token), (0, 1), value=self.pad_token)
+        out[torch.arange(b, device=device), lengths] = self.eos_token
+
+        self.train(was_training)
+        return out
+
+
+def get_decoder(args):
+    """Mask-predict decoder with args.nar_layers bidirectional layers cross-attending to the encoder."""
+    decoder = MaskPredictDecoder(
+        TransformerWrapper(
+            num_tokens=args.num_tokens + 1,
+            logits_dim=args.num_tokens,
+            max_seq_len=args.max_seq_len,
+            attn_layers=Encoder(
+                dim=args.dim,
+                depth=args.nar_layers,
+                heads=args.heads,
+                **{**attn_layer_kwargs(getattr(args, 'attn_impl', None)), **args.decoder_args, 'cross_attend': True}
+            )),
+        pad_token=args.pad_token,
+        bos_token=args.bos_token,
+        eos_token=args.eos_token)
+    return set_attn_impl(decoder, getattr(args, 'attn_impl', None), getattr(args, 'attn_chunk_size', 1024))
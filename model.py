@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import os
+import functools
 import sys
 import logging
 
@@ -8,15 +9,26 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
 import hybrid
+import swin
 import gc_module  # Rename the local gc.py to avoid conflict with built-in gc
 import transformer
+import mask_predict
+from ctc import ctc_loss, ctc_greedy_decode
+from checkpointing import set_checkpointing
 
 
 class Model(nn.Module):
-    def __init__(self, encoder, decoder, args):
+    # set by quantization.set_precision: generate runs under autocast to this dtype (None = off)
+    inference_dtype = None
+
+    def __init__(self, encoder, decoder, args, draft=None, mask_predict=None):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
+        # optional shallow decoder proposing tokens for speculative decoding
+        self.draft = draft
+        # optional non-autoregressive decoder, trained next to `decoder` on the same encoder output
+        self.mask_predict = mask_predict
         self.args = args
 
     def data_parallel(self, x: torch.Tensor, device_ids, output_device=None, **kwargs):
@@ -32,8 +44,41 @@ class Model(nn.Module):
         outputs = nn.parallel.parallel_apply(replicas, inputs, kwargs)
         return nn.parallel.gather(outputs, output_device).mean()
 
-    def forward(self, x: torch.Tensor, tgt_seq: torch.Tensor,  return_logits: bool = False, **kwargs):
-        encoded = self.encoder(x)
+    def encode(self, x: torch.Tensor, return_ctc: bool = False):
+        """Returns (context, context_mask); the mask is None unless the encoder prunes tokens.
+        With `return_ctc` also the encoder's CTC frame logits."""
+        if return_ctc:
+            return self.encoder(x, return_mask=True, return_ctc=True)
+        if getattr(self.encoder, 'prune_blank', False):
+            return self.encoder(x, return_mask=True)
+        return self.encoder(x), None
+
+    @property
+    def has_ctc(self):
+        return getattr(self.encoder, 'ctc_head', None) is not None
+
+    @property
+    def has_aux_loss(self):
+        return self.mask_predict is not None or self.has_ctc
+
+    def aux_loss(self, tgt_seq, context, context_mask=None, ctc_logits=None):
+        """Weighted losses of the auxiliary decoding heads on an encoder output (0 if there are none)."""
+        loss = 0.
+        if self.mask_predict is not None:
+            loss = loss + getattr(self.args, 'nar_loss_weight', 1.) * self.mask_predict.loss(tgt_seq, context, context_mask)
+        if ctc_logits is not None:
+            args = self.args
+            loss = loss + getattr(args, 'ctc_loss_weight', 0.5) * ctc_loss(ctc_logits, tgt_seq, args.pad_token, args.bos_token, args.eos_token)
+        return loss
+
+    def forward(self, x: torch.Tensor, tgt_seq: torch.Tensor,  return_logits: bool = False, return_context: bool = False, **kwargs):
+        """Decoder output for `tgt_seq`; with `return_context` also a dict of the encoder outputs
+        (context, context_mask, ctc_logits) for `aux_loss`."""
+        ctc_logits = None
+        if return_context and self.has_ctc:
+            encoded, context_mask, ctc_logits = self.encode(x, return_ctc=True)
+        else:
+            encoded, context_mask = self.encode(x)
         # Some decoder configurations (x_transformers.Decoder) expect cross-attention
         # to be enabled/disabled consistently. If decoder was created without
         # cross_attend, passing `context` raises an assertion inside x_transformers.
@@ -49,6 +94,8 @@ class Model(nn.Module):
                 cross_attend = bool(getattr(self.decoder, 'cross_attend', False))
         except Exception:
             cross_attend = False
+        if cross_attend and context_mask is not None:
+            kwargs['context_mask'] = context_mask
 
         # Immediate diagnostics (stdout) to help trace unexpected decoder outputs
         # try:
@@ -121,17 +168,59 @@ class Model(nn.Module):
                     info = f'failed to extract tensor info, raw_out_repr={repr(out)[:500]}'
                 raise RuntimeError(f'Unexpected decoder output shape: {getattr(out0, "shape", None)}. encoded.shape={encoded.shape}, tgt_seq.shape={tgt_seq.shape}. DETAILS: {info}')
 
+        if return_context:
+            return out, dict(context=encoded, context_mask=context_mask, ctc_logits=ctc_logits)
         return out
 
     @torch.no_grad()
-    def generate(self, x: torch.Tensor, temperature: float = 0.25):
+    def generate(self, x: torch.Tensor, temperature: float = 0.25, beam_width: int = None, length_penalty: float = None, speculative: bool = None, grammar=None, mode: str = 'ar', iterations: int = None, **kwargs):
+        """Decodes images `x` to (B, L) token ids ending in eos.
+
+        mode='ar' uses the autoregressive decoder (beam search, speculative or sampling);
+        mode='mask_predict' the non-autoregressive decoder with `iterations` refinement passes
+        (default args.nar_iterations); mode='ctc' decodes the encoder's CTC head in one pass.
+        """
+        if self.inference_dtype is not None:
+            with torch.autocast(x.device.type, dtype=self.inference_dtype):
+                return self._generate(x, temperature, beam_width, length_penalty, speculative, grammar, mode, iterations, **kwargs)
+        return self._generate(x, temperature, beam_width, length_penalty, speculative, grammar, mode, iterations, **kwargs)
+
+    def _generate(self, x, temperature, beam_width, length_penalty, speculative, grammar, mode, iterations, **kwargs):
+        # acceptance statistics only exist for speculative decoding; the other decoders pass kwargs on to the net
+        stats = kwargs.pop('stats', None)
         start = (torch.LongTensor([self.args.bos_token] * len(x))[:, None]).to(x.device)
-        ctx = self.encoder(x)
+        if mode == 'ctc':
+            if not self.has_ctc:
+                raise ValueError("mode='ctc' needs a ViT encoder built with ctc_head = True")
+            return ctc_greedy_decode(self.encode(x, return_ctc=True)[2], self.args.pad_token, self.args.eos_token)
+        ctx, ctx_mask = self.encode(x)
+        if mode == 'mask_predict':
+            if self.mask_predict is None:
+                raise ValueError("mode='mask_predict' needs a model built with nar_layers > 0")
+            return self.mask_predict.generate(ctx, ctx_mask, iterations=iterations or getattr(self.args, 'nar_iterations', 4),
+                                              length_beam=getattr(self.args, 'nar_length_beam', 3))
+        if mode != 'ar':
+            raise ValueError('Unknown decoding mode "%s".' % mode)
+        context = dict(context=ctx) if ctx_mask is None else dict(context=ctx, context_mask=ctx_mask)
+        beam_width = beam_width if beam_width is not None else getattr(self.args, 'beam_width', 1)
+        if beam_width > 1:
+            # beam search is deterministic, temperature does not apply
+            length_penalty = length_penalty if length_penalty is not None else getattr(self.args, 'length_penalty', 1.0)
+            decode = functools.partial(self.decoder.beam_search, beam_width=beam_width, length_penalty=length_penalty)
+        elif self.draft is not None and speculative is not False and grammar is None:
+            # grammar-constrained decoding runs token by token, without the draft
+            decode = functools.partial(self.decoder.speculative_generate, draft=self.draft, temperature=temperature,
+                                       num_draft=getattr(self.args, 'num_draft_tokens', 4), stats=stats)
+        else:
+            # temperature <= 0 decodes greedily (argmax)
+            decode = functools.partial(self.decoder.generate, temperature=temperature)
+        if grammar is not None:
+            decode = functools.partial(decode, grammar=grammar)
         # Try with context, else without (see forward fallback)
         try:
-            return self.decoder.generate(start, self.args.max_seq_len, eos_token=self.args.eos_token, context=ctx, temperature=temperature)
+            return decode(start, self.args.max_seq_len, eos_token=self.args.eos_token, **context, **kwargs)
         except AssertionError:
-            return self.decoder.generate(start, self.args.max_seq_len, eos_token=self.args.eos_token, temperature=temperature)
+            return decode(start, self.args.max_seq_len, eos_token=self.args.eos_token, **kwargs)
 
 
 def get_model(args):
@@ -139,12 +228,24 @@ def get_model(args):
         encoder = gc_module.get_encoder(args)
     elif args.encoder_structure.lower() == 'hybrid':
         encoder = hybrid.get_encoder(args)
+    elif args.encoder_structure.lower() == 'swin':
+        encoder = swin.get_encoder(args)
     else:
         raise NotImplementedError('Encoder structure "%s" not supported.' % args.encoder_structure)
     decoder = transformer.get_decoder(args)
+    draft = transformer.get_draft_decoder(args) if getattr(args, 'draft_layers', 0) else None
+    nar = mask_predict.get_decoder(args) if getattr(args, 'nar_layers', 0) else None
+    offload = getattr(args, 'checkpoint_offload', False)
+    set_checkpointing(encoder, getattr(args, 'encoder_checkpoint_every', 0), offload)
+    set_checkpointing(decoder, getattr(args, 'decoder_checkpoint_every', 0), offload)
     encoder.to(args.device)
     decoder.to(args.device)
-    model = Model(encoder, decoder, args)
+    if draft is not None:
+        draft.to(args.device)
+    if nar is not None:
+        set_checkpointing(nar, getattr(args, 'decoder_checkpoint_every', 0), offload)
+        nar.to(args.device)
+    model = Model(encoder, decoder, args, draft=draft, mask_predict=nar)
     if args.wandb:
         import wandb
         wandb.watch(model)
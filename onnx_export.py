@@ -0,0 +1,177 @@
+import os
+import json
+import logging
+import torch
+import torch.nn as nn
+
+from x_transformers.x_transformers import Intermediates
+
+from model import get_model
+from config import get_args
+
+ENCODER_FILE = 'encoder.onnx'
+DECODER_FILE = 'decoder_step.onnx'
+CONFIG_FILE = 'onnx_config.json'
+
+
+def decoder_layers(net):
+    """(layer_type, norms, block, residual) of the TransformerWrapper `net`, checked for export support."""
+    attn_layers = net.attn_layers
+    assert not (attn_layers.add_value_residual or attn_layers.residual_attn or attn_layers.cross_residual_attn or attn_layers.need_condition), \
+        'value / attention residuals and conditioning are not supported by the ONNX decoder step'
+    assert all(s is None for s in attn_layers.skip_combines) and all(i is None for i in attn_layers.layer_integrators), \
+        'skip connections are not supported by the ONNX decoder step'
+    assert attn_layers.num_residual_streams == 1 and not (attn_layers.reinject_input or attn_layers.softclamp_output) \
+        and attn_layers.layers_execute_order == tuple(range(len(attn_layers.layers))), 'unsupported decoder layout for the ONNX decoder step'
+    assert attn_layers.rel_pos is None and attn_layers.rotary_pos_emb is None and attn_layers.polar_pos_emb is None, \
+        'only absolute positions are supported by the ONNX decoder step'
+    return [(t, *layer) for t, layer in zip(attn_layers.layer_types, attn_layers.layers)]
+
+
+class EncoderExport(nn.Module):
+    """Image -> (context, cross-attention keys / values of every decoder layer).
+
+    The cross-attention projections only depend on the image, so they are computed once
+    here instead of in every decode step.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.encoder
+        self.cross_blocks = nn.ModuleList([block for t, _, block, _ in decoder_layers(model.decoder.net) if t == 'c'])
+
+    def forward(self, img):
+        context = self.encoder(img)
+        kvs = []
+        query = context[:, :1]
+        for block in self.cross_blocks:
+            _, inter = block(query, context=context, return_intermediates=True)
+            kvs.extend(inter.cached_kv)
+        return (context, *kvs)
+
+
+class DecoderStep(nn.Module):
+    """One incremental decode step of the autoregressive decoder with explicit KV cache I/O.
+
+    Inputs: token (b, 1), its position (1,), the self-attention keys / values of the prefix
+    per layer (b, heads, n, dim_head) and the cross-attention keys / values from
+    EncoderExport. Outputs: next-token logits (b, num_tokens) and the self-attention
+    keys / values extended by this token. Runs the same x_transformers blocks as
+    CustomARWrapper's cached decoding.
+    """
+    def __init__(self, model):
+        super().__init__()
+        net = model.decoder.net
+        self.token_emb = net.token_emb
+        self.pos_emb = net.pos_emb
+        self.post_emb_norm = net.post_emb_norm
+        self.project_emb = net.project_emb
+        self.attn_layers = net.attn_layers
+        self.layers = decoder_layers(net)
+        self.final_norm = net.attn_layers.final_norm
+        self.to_logits = net.to_logits
+
+    def forward(self, token, pos, *kvs):
+        num_self = sum(t == 'a' for t, *_ in self.layers)
+        self_kvs, cross_kvs = iter(zip(kvs[:2 * num_self:2], kvs[1:2 * num_self:2])), iter(zip(kvs[2 * num_self::2], kvs[2 * num_self + 1::2]))
+        x = self.token_emb(token) + self.pos_emb(token, pos=pos)
+        x = self.project_emb(self.post_emb_norm(x))
+        present = []
+        for layer_type, (pre_norm, post_branch_norm, post_main_norm), block, residual_fn in self.layers:
+            x, inner_residual, residual_kwargs = residual_fn.prepare(x)
+            if pre_norm is not None:
+                x = pre_norm(x)
+            if layer_type == 'a':
+                # a single query sees the whole prefix, so no causal mask is needed
+                out, inter = block(x, cache=Intermediates(cached_kv=next(self_kvs)), return_intermediates=True, causal=False)
+                present.extend(inter.cached_kv)
+            elif layer_type == 'c':
+                # zero-length context: the cached projections are the whole key / value set
+                out, _ = block(x, context=x[:, :0], cache=Intermediates(cached_kv=next(cross_kvs)), return_intermediates=True)
+            else:
+                out = block(x)
+            if post_branch_norm is not None:
+                out = post_branch_norm(out)
+            x = residual_fn(out, inner_residual, **residual_kwargs)
+            if post_main_norm is not None:
+                x = post_main_norm(x)
+        logits = self.to_logits(self.final_norm(x))[:, -1]
+        return (logits, *present)
+
+
+def export_onnx(model, out_dir, sample=None, opset=18):
+    """Writes encoder.onnx, decoder_step.onnx and onnx_config.json (token ids, I/O names) to `out_dir`.
+
+    Batch, image height / width, context length and prefix length are dynamic axes.
+    Blank-patch pruning (data-dependent shapes) is not exportable.
+    """
+    assert not getattr(model.encoder, 'prune_blank', False), 'prune_blank_patches cannot be exported'
+    model = model.cpu().eval()
+    args = model.args
+    # the ONNX graph optimizer logs every node it touches at INFO
+    logging.getLogger('onnxscript').setLevel(logging.WARNING)
+    os.makedirs(out_dir, exist_ok=True)
+    ps = getattr(model.encoder, 'patch_size', args.patch_size)
+    sample = sample if sample is not None else torch.rand(2, args.channels, 2 * ps, 4 * ps)
+
+    encoder = EncoderExport(model).eval()
+    num_cross = len(encoder.cross_blocks)
+    cross_names = [f'cross_{kv}_{i}' for i in range(num_cross) for kv in ('k', 'v')]
+    b, h, w = torch.export.Dim('batch', min=1, max=1024), torch.export.Dim('h', min=1, max=args.max_height // ps), torch.export.Dim('w', min=1, max=args.max_width // ps)
+    with torch.no_grad():
+        outputs = encoder(sample)
+        torch.onnx.export(encoder, (sample,), os.path.join(out_dir, ENCODER_FILE), input_names=['image'], output_names=['context'] + cross_names,
+                          dynamic_shapes=({0: b, 2: ps * h, 3: ps * w},), opset_version=opset, dynamo=True, verbose=False)
+
+    step = DecoderStep(model).eval()
+    num_self = sum(t == 'a' for t, *_ in step.layers)
+    past_names = [f'past_{kv}_{i}' for i in range(num_self) for kv in ('k', 'v')]
+    present_names = [f'present_{kv}_{i}' for i in range(num_self) for kv in ('k', 'v')]
+    token = torch.full((sample.shape[0], 1), args.bos_token, dtype=torch.long)
+    pos = torch.ones(1, dtype=torch.long)
+    with torch.no_grad():
+        # the decoder's own cache after the bos token is the (non-empty) prefix the exporter traces with
+        _, cache = model.decoder.net(token, context=outputs[0] if num_cross else None, return_intermediates=True)
+        past = [kv for inter in cache.attn_intermediates if inter.layer_type == 'a' for kv in inter.cached_kv]
+        n, ctx = torch.export.Dim('prefix', min=1, max=args.max_seq_len), torch.export.Dim('context', min=1)
+        kv_shapes = [{0: b, 2: n}] * (2 * num_self) + [{0: b, 2: ctx}] * (2 * num_cross)
+        torch.onnx.export(step, (token, pos, *past, *outputs[1:]), os.path.join(out_dir, DECODER_FILE),
+                          input_names=['token', 'pos'] + past_names + cross_names, output_names=['logits'] + present_names,
+                          dynamic_shapes=({0: b}, None, tuple(kv_shapes)), opset_version=opset, dynamo=True, verbose=False)
+
+    config = {'bos_token': args.bos_token, 'eos_token': args.eos_token, 'pad_token': args.pad_token, 'max_seq_len': args.max_seq_len,
+              'patch_size': ps, 'channels': args.channels, 'past_names': past_names, 'present_names': present_names, 'cross_names': cross_names,
+              'kv_shape': list(past[0].shape[1:2]) + [past[0].shape[-1]]}
+    with open(os.path.join(out_dir, CONFIG_FILE), 'w') as f:
+        json.dump(config, f, indent=2)
+    return out_dir
+
+
+def check_parity(model, out_dir, images, atol=1e-4):
+    """Compares the ONNX Runtime path with the PyTorch path on `images`: greedy token ids must match
+    and encoder outputs agree within `atol`. Returns a dict of the checks."""
+    from onnx_model import OnnxModel
+
+    model = model.cpu().eval()
+    onnx_model = OnnxModel(out_dir)
+    with torch.no_grad():
+        context = model.encoder(images)
+        preds = model.generate(images, temperature=0)
+    ort_context = onnx_model.encode(images.numpy())[0]
+    ort_preds = onnx_model.generate(images.numpy(), temperature=0)
+    same = preds.shape == ort_preds.shape and bool((preds.numpy() == ort_preds).all())
+    result = {'context max abs diff': float(abs(context.numpy() - ort_context).max()), 'greedy tokens identical': same}
+    result['passed'] = same and result['context max abs diff'] <= atol
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # python onnx_export.py <checkpoint.pt> <out_dir>
+    args = get_args()
+    args.device = 'cpu'
+    model = get_model(args)
+    model.load_state_dict(torch.load(sys.argv[1], map_location='cpu')['model_state_dict'])
+    export_onnx(model, sys.argv[2])
+    ps = model.encoder.patch_size
+    logging.info(f'Exported to {sys.argv[2]}; parity: {check_parity(model, sys.argv[2], torch.rand(2, args.channels, 4 * ps, 8 * ps))}')
@@ -0,0 +1,76 @@
+import os
+import json
+import numpy as np
+import onnxruntime as ort
+
+# no torch import: this module only needs numpy and onnxruntime
+ENCODER_FILE = 'encoder.onnx'
+DECODER_FILE = 'decoder_step.onnx'
+CONFIG_FILE = 'onnx_config.json'
+
+
+def top_k_sample(logits, rng, temperature=1., thres=0.9):
+    # numpy version of transformer.top_k + temperature sampling; temperature <= 0 is argmax
+    if temperature <= 0:
+        return logits.argmax(axis=-1)
+    k = max(1, int((1 - thres) * logits.shape[-1]))
+    kth = np.partition(logits, -k, axis=-1)[:, -k:].min(axis=-1, keepdims=True)
+    logits = np.where(logits >= kth, logits / temperature, -np.inf)
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+    return np.array([rng.choice(len(p), p=p) for p in probs])
+
+
+class OnnxModel:
+    """Model.generate on ONNX Runtime sessions of the encoder and one decoder step (onnx_export.py).
+
+    The encoder returns the context and the cross-attention keys / values once per image;
+    every step feeds the last token plus the self-attention cache and gets the extended
+    cache back. Rows that emit eos leave the batch, as in CustomARWrapper.generate.
+    `intra_op_num_threads` / `inter_op_num_threads` = 0 leave the choice to ONNX Runtime.
+    """
+    def __init__(self, model_dir, intra_op_num_threads=0, inter_op_num_threads=0, providers=('CPUExecutionProvider',)):
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.encoder = ort.InferenceSession(os.path.join(model_dir, ENCODER_FILE), options, providers=list(providers))
+        self.decoder = ort.InferenceSession(os.path.join(model_dir, DECODER_FILE), options, providers=list(providers))
+
+    def encode(self, images):
+        """(context, cross-attention keys / values) for float32 images (b, c, h, w)."""
+        return self.encoder.run(None, {'image': np.ascontiguousarray(images, dtype=np.float32)})
+
+    def generate(self, images, temperature=0.25, filter_thres=0.9, seq_len=None, seed=None):
+        """(b, L) int64 token ids ending in eos and padded with the pad token."""
+        cfg = self.config
+        seq_len = seq_len or cfg['max_seq_len']
+        cross = dict(zip(cfg['cross_names'], self.encode(images)[1:]))
+        b = images.shape[0]
+        heads, dim_head = cfg['kv_shape']
+        past = {name: np.zeros((b, heads, 0, dim_head), dtype=np.float32) for name in cfg['past_names']}
+        token = np.full((b, 1), cfg['bos_token'], dtype=np.int64)
+        rng = np.random.default_rng(seed)
+
+        active = np.arange(b)
+        result = np.full((b, seq_len), cfg['pad_token'], dtype=np.int64)
+        length = 0
+        for pos in range(seq_len):
+            logits, *present = self.decoder.run(None, {'token': token, 'pos': np.array([pos], dtype=np.int64), **past, **cross})
+            sample = top_k_sample(logits, rng, temperature, filter_thres)
+            result[active, pos] = sample
+            length = pos + 1
+            past = dict(zip(cfg['past_names'], present))
+            token = sample[:, None].astype(np.int64)
+
+            keep = sample != cfg['eos_token']
+            if not keep.all():
+                active = active[keep]
+                if active.size == 0:
+                    break
+                token = token[keep]
+                past = {k: v[keep] for k, v in past.items()}
+                cross = {k: v[keep] for k, v in cross.items()}
+        return result[:, :length]
@@ -0,0 +1,70 @@
+import os
+import time
+from torch.utils.data import Dataset, DataLoader
+
+# forked workers inherit the main process' fast tokenizer; its internal thread pool must stay off there
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+
+class PlannedBatches(Dataset):
+    """Map-style view of a batch plan: item i is dataset.make_batch(*plan[i]), so every batch
+    still comes from a single bucket. Without a plan the index is the (items, size) entry itself,
+    as a ResumableBatchSampler yields them."""
+    def __init__(self, dataset, plan=None):
+        self.dataset = dataset
+        self.plan = plan
+
+    def __len__(self):
+        return len(self.plan)
+
+    def __getitem__(self, idx):
+        items, size = self.plan[idx] if self.plan is not None else idx
+        return self.dataset.make_batch(items, size)
+
+
+def _as_built(batch):
+    # batches are complete when they leave the worker; nothing to collate
+    return batch
+
+
+def batch_loader(dataset, batch_size=None, plan=None, sampler=None, num_workers=4, prefetch=4, pin_memory=False):
+    """Builds the batches of CustomDataset.get_batch (or of `plan`, a list of (items, size)
+    as from CustomDataset.batches / bucket_batches, or in the order of a ResumableBatchSampler
+    `sampler`) in `num_workers` worker processes.
+
+    This is a DataLoader over whole batches: workers send the finished tensors back through
+    shared memory, at most `prefetch` batches per worker are in flight, and `pin_memory` copies
+    them to page-locked memory on a background thread for non-blocking host-to-device copies.
+    Workers stay alive across epochs. With num_workers=0 batches are built in-process.
+    """
+    if sampler is None:
+        dataset = PlannedBatches(dataset, plan if plan is not None else dataset.batches(batch_size))
+    else:
+        dataset = PlannedBatches(dataset)
+    return DataLoader(dataset, batch_size=None, sampler=sampler, shuffle=False, collate_fn=_as_built, num_workers=num_workers,
+                      prefetch_factor=prefetch if num_workers else None, persistent_workers=num_workers > 0, pin_memory=pin_memory)
+
+
+class DataWaitTimer:
+    """Iterates `loader` and accumulates the time the consumer is blocked waiting for the next
+    batch (`wait_seconds` over `batches`); a starved training loop shows up as a large share
+    of the epoch."""
+    def __init__(self, loader):
+        self.loader = loader
+        self.wait_seconds = 0.
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self.wait_seconds += time.perf_counter() - t0
+            self.batches += 1
+            yield batch
@@ -0,0 +1,87 @@
+import copy
+import logging
+import torch
+import torch.nn as nn
+
+from model import get_model
+from config import get_args
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+def bf16_supported():
+    # native bf16 matmuls (AVX512-BF16 / AMX); elsewhere bf16 autocast works but is emulated and slow
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def set_precision(model, precision='fp32'):
+    """Inference precision of a (trained, eval) Model, in place.
+
+    'bf16' runs Model.generate under bf16 autocast on unchanged fp32 weights; 'int8'
+    replaces every nn.Linear of the encoder and decoders by a dynamically quantized one
+    (int8 weights, activations quantized per batch, CPU only).
+    """
+    assert precision in PRECISIONS, 'unknown precision %s' % precision
+    model.inference_dtype = torch.bfloat16 if precision == 'bf16' else None
+    if precision == 'bf16' and not bf16_supported():
+        logging.warning('CPU has no native bf16 support; bf16 autocast will be slow')
+    if precision == 'int8':
+        model.cpu()
+        for name in ('encoder', 'decoder', 'draft', 'mask_predict'):
+            module = getattr(model, name, None)
+            if module is not None:
+                setattr(model, name, torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8))
+    model.precision = precision
+    return model.eval()
+
+
+def build_inference_model(args, checkpoint=None, precision=None):
+    """get_model + checkpoint weights + set_precision(args.inference_precision)."""
+    model = get_model(args)
+    if checkpoint:
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu')['model_state_dict'])
+    return set_precision(model.eval(), precision or getattr(args, 'inference_precision', 'fp32'))
+
+
+def save_artifact(model, path):
+    """Saves a set_precision'ed model as its config + state_dict; load_artifact rebuilds it."""
+    args = {k: getattr(model.args, k) for k in dir(model.args) if not k.startswith('_') and not callable(getattr(model.args, k))}
+    torch.save({'args': args, 'precision': getattr(model, 'precision', 'fp32'), 'model_state_dict': model.state_dict()}, path)
+
+
+def load_artifact(path, device='cpu'):
+    """Model from a save_artifact file; only needs the model definition (no train.py / dataset code)."""
+    ck = torch.load(path, map_location='cpu', weights_only=False)
+    args = get_args()
+    for k, v in ck['args'].items():
+        setattr(args, k, v)
+    args.device = 'cpu'
+    model = set_precision(get_model(args).eval(), ck['precision'])
+    model.load_state_dict(ck['model_state_dict'])
+    return model if ck['precision'] == 'int8' else model.to(device)
+
+
+def state_dict_bytes(model):
+    # serialized size, packed int8 weights included
+    import io
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def quantized_copy(model, precision):
+    return set_precision(copy.deepcopy(model), precision)
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # python quantization.py <checkpoint.pt> <artifact.pt> [fp32|bf16|int8]
+    args = get_args()
+    args.device = 'cpu'
+    model = build_inference_model(args, sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else 'int8')
+    save_artifact(model, sys.argv[2])
+    logging.info(f'Saved {model.precision} artifact {sys.argv[2]} ({state_dict_bytes(model) / 2 ** 20:.1f} MB)')
@@ -0,0 +1,106 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+INDEX_FILE = 'index.parquet'
+SHARD_FILE = 'shard_%05d.bin'
+ALIGN = 64
+
+
+def _decode(path):
+    # same pixels get_batch feeds the model: the first channel of the decoded PNG
+    im = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if im is None:
+        return None
+    if im.ndim == 3:
+        im = cv2.cvtColor(im, cv2.COLOR_BGRA2RGBA if im.shape[2] == 4 else cv2.COLOR_BGR2RGB)[..., 0]
+    if im.dtype != np.uint8:
+        im = cv2.convertScaleAbs(im, alpha=255. / 65535)
+    return np.ascontiguousarray(im)
+
+
+def pack_shards(paths, out_dir, shard_bytes=1 << 30, workers=16):
+    """Decodes the images at `paths` once and stores them as raw uint8 grayscale pixels in
+    shard files of about `shard_bytes` each, plus index.parquet (path, shard, offset, height,
+    width). Images that cannot be read are skipped. PNGs are decoded by `workers` threads
+    (cv2 releases the GIL) and written in order; the index is written last, so a reader
+    never sees a partial pack.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = list(dict.fromkeys(paths))
+    index = {'path': [], 'shard': [], 'offset': [], 'height': [], 'width': []}
+    shard, offset, f = 0, 0, None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, im in zip(paths, pool.map(_decode, paths)):
+            if im is None:
+                logging.warning('Cannot read %s, not packed' % path)
+                continue
+            if f is None or (offset and offset + im.nbytes > shard_bytes):
+                if f is not None:
+                    f.close()
+                    shard += 1
+                f, offset = open(os.path.join(out_dir, SHARD_FILE % shard), 'wb'), 0
+            f.write(im.tobytes())
+            index['path'].append(path)
+            index['shard'].append(shard)
+            index['offset'].append(offset)
+            index['height'].append(im.shape[0])
+            index['width'].append(im.shape[1])
+            # aligned starts keep every image view cache-line aligned
+            pad = -im.nbytes % ALIGN
+            f.write(b'\0' * pad)
+            offset += im.nbytes + pad
+    if f is not None:
+        f.close()
+    index = pd.DataFrame(index).astype({'shard': np.int32, 'offset': np.int64, 'height': np.int32, 'width': np.int32})
+    tmp = os.path.join(out_dir, '%s.%d.tmp' % (INDEX_FILE, os.getpid()))
+    index.to_parquet(tmp, index=False)
+    os.replace(tmp, os.path.join(out_dir, INDEX_FILE))
+    logging.info(f'Packed {len(index)} images into {shard + (f is not None)} shards in {out_dir}')
+    return index
+
+
+class ShardReader:
+    """Read-only access to a pack_shards directory: reader[path] is a zero-copy (height, width)
+    uint8 view into the memory-mapped shard. Shards are mapped lazily and re-mapped after
+    pickling, so a reader can be handed to DataLoader worker processes. Views are read-only;
+    copy before modifying pixels in place.
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        index = pd.read_parquet(os.path.join(shard_dir, INDEX_FILE))
+        self.index = dict(zip(index['path'], zip(index['shard'].tolist(), index['offset'].tolist(), index['height'].tolist(), index['width'].tolist())))
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __getitem__(self, path):
+        shard, offset, height, width = self.index[path]
+        mm = self._maps.get(shard)
+        if mm is None:
+            mm = self._maps[shard] = np.memmap(os.path.join(self.shard_dir, SHARD_FILE % shard), dtype=np.uint8, mode='r')
+        return mm[offset:offset + height * width].reshape(height, width)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+
+if __name__ == '__main__':
+    from config import get_args
+    from manifest import build_manifest
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # python shards.py: pack every image of the CSV under args.data_root into args.shard_dir
+    args = get_args()
+    manifest = build_manifest(pd.read_csv(os.path.join(args.data_root, args.data_csv)), args.data_root,
+                              path=args.manifest_path or os.path.join(args.data_root, 'manifest.parquet'), workers=args.manifest_workers)
+    pack_shards(manifest.loc[manifest['width'] >= 0, 'path'], args.shard_dir or os.path.join(args.data_root, 'shards'), workers=args.manifest_workers)
@@ -0,0 +1,148 @@
+import functools
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from x_transformers import Encoder
+from einops import rearrange, repeat
+
+from gc_module import sinusoidal_pos_embedding
+from attention import set_attn_impl, attn_layer_kwargs
+
+
+@functools.lru_cache(maxsize=64)
+def window_attn_mask(h, w, window_size, shift, device):
+    """(num_windows, ws*ws, ws*ws) mask of which tokens may attend inside each window.
+
+    The grid is padded to a multiple of window_size and rolled by `shift`. Tokens only
+    attend to tokens that were neighbours before the roll (no wrap-around) and real
+    tokens never attend to padding.
+    """
+    hp, wp = -(-h // window_size) * window_size, -(-w // window_size) * window_size
+    rows = (torch.arange(hp, device=device) + shift)
+    cols = (torch.arange(wp, device=device) + shift)
+    label = 2 * (rows >= hp).long()[:, None] + (cols >= wp).long()[None, :]
+    padded = ((rows % hp) >= h)[:, None] | ((cols % wp) >= w)[None, :]
+    label = label.masked_fill(padded, -1)
+    label = rearrange(label, '(nh ws1) (nw ws2) -> (nh nw) (ws1 ws2)', ws1=window_size, ws2=window_size)
+    return label[:, :, None] == label[:, None, :]
+
+
+class WindowBlock(nn.Module):
+    """Pre-norm transformer block with (optionally shifted) window self-attention."""
+    def __init__(self, dim, heads, window_size, shift=0, ff_mult=4, dropout=0.):
+        super().__init__()
+        self.heads = heads
+        self.window_size = window_size
+        self.shift = shift
+        self.dropout = dropout
+        self.norm1 = nn.LayerNorm(dim)
+        self.to_qkv = nn.Linear(dim, dim * 3, bias=False)
+        self.to_out = nn.Linear(dim, dim)
+        self.norm2 = nn.LayerNorm(dim)
+        self.ff = nn.Sequential(nn.Linear(dim, dim * ff_mult), nn.GELU(), nn.Dropout(dropout), nn.Linear(dim * ff_mult, dim))
+
+    def attend(self, x, h, w):
+        ws, s = self.window_size, self.shift
+        x = rearrange(x, 'b (h w) d -> b h w d', h=h, w=w)
+        x = F.pad(x, (0, 0, 0, -w % ws, 0, -h % ws))
+        if s:
+            x = torch.roll(x, shifts=(-s, -s), dims=(1, 2))
+        hp, wp = x.shape[1:3]
+        x = rearrange(x, 'b (nh ws1) (nw ws2) d -> b (nh nw) (ws1 ws2) d', ws1=ws, ws2=ws)
+        q, k, v = rearrange(self.to_qkv(x), 'b n t (qkv h d) -> qkv b n h t d', qkv=3, h=self.heads)
+        mask = window_attn_mask(h, w, ws, s, x.device)[:, None]
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=self.dropout if self.training else 0.)
+        x = self.to_out(rearrange(x, 'b n h t d -> b n t (h d)'))
+        x = rearrange(x, 'b (nh nw) (ws1 ws2) d -> b (nh ws1) (nw ws2) d', nh=hp // ws, ws1=ws)
+        if s:
+            x = torch.roll(x, shifts=(s, s), dims=(1, 2))
+        return rearrange(x[:, :h, :w], 'b h w d -> b (h w) d')
+
+    def forward(self, x, h, w):
+        x = x + self.attend(self.norm1(x), h, w)
+        return x + self.ff(self.norm2(x))
+
+
+class WindowedViTransformerWrapper(nn.Module):
+    """ViT encoder whose early layers attend inside (shifted) local windows.
+
+    After the local layers, 2x2 neighbouring tokens are merged (Swin patch merging)
+    and a few global x_transformers layers run over the cls token plus the merged
+    grid. Positions use the fixed 2D sinusoidal table, so the canvas size is not capped
+    by a parameter table. The output is (b, 1 + ceil(h/2) * ceil(w/2), dim), with the
+    same contract for the decoder context as ViTransformerWrapper.
+    """
+    def __init__(
+        self,
+        *,
+        patch_size,
+        attn_layers,
+        local_depth,
+        window_size=8,
+        heads=4,
+        channels=1,
+        ff_mult=4,
+        dropout=0.,
+        emb_dropout=0.
+    ):
+        super().__init__()
+        assert isinstance(attn_layers, Encoder), 'attention layers must be an Encoder'
+        dim = attn_layers.dim
+        self.patch_size = patch_size
+        self.window_size = window_size
+
+        self.patch_to_embedding = nn.Linear(channels * patch_size ** 2, dim)
+        self.cls_token = nn.Parameter(torch.randn(1, 1, dim))
+        self.dropout = nn.Dropout(emb_dropout)
+        # alternate plain and half-window-shifted layers as in Swin
+        self.local_layers = nn.ModuleList([
+            WindowBlock(dim, heads, window_size, shift=(window_size // 2) * (i % 2), ff_mult=ff_mult, dropout=dropout)
+            for i in range(local_depth)])
+        self.merge_norm = nn.LayerNorm(4 * dim)
+        self.merge = nn.Linear(4 * dim, dim, bias=False)
+
+        self.attn_layers = attn_layers
+        self.norm = nn.LayerNorm(dim)
+
+    def forward(self, img, **kwargs):
+        p = self.patch_size
+        h, w = img.shape[2] // p, img.shape[3] // p
+
+        x = rearrange(img, 'b c (h p1) (w p2) -> b (h w) (p1 p2 c)', p1=p, p2=p)
+        x = self.patch_to_embedding(x)
+        x = x + sinusoidal_pos_embedding(h, w, x.shape[-1], x.device).to(x.dtype)
+        x = self.dropout(x)
+
+        for layer in self.local_layers:
+            x = layer(x, h, w)
+
+        # 2x2 patch merging, padding odd grids
+        x = rearrange(x, 'b (h w) d -> b h w d', h=h, w=w)
+        x = F.pad(x, (0, 0, 0, w % 2, 0, h % 2))
+        x = rearrange(x, 'b (h p1) (w p2) d -> b (h w) (p1 p2 d)', p1=2, p2=2)
+        x = self.merge(self.merge_norm(x))
+
+        cls_tokens = repeat(self.cls_token, '() n d -> b n d', b=x.shape[0])
+        x = torch.cat((cls_tokens, x), dim=1)
+        x = self.attn_layers(x, **kwargs)
+        return self.norm(x)
+
+
+def get_encoder(args):
+    encoder = WindowedViTransformerWrapper(
+        patch_size=args.patch_size,
+        channels=args.channels,
+        local_depth=args.encoder_depth,
+        window_size=getattr(args, 'window_size', 8),
+        heads=args.heads,
+        ff_mult=getattr(args, 'ff_mult', 4),
+        emb_dropout=getattr(args, 'emb_dropout', 0),
+        attn_layers=Encoder(
+            dim=args.dim,
+            depth=getattr(args, 'global_depth', 2),
+            heads=args.heads,
+            **attn_layer_kwargs(getattr(args, 'attn_impl', None))
+        )
+    )
+    return set_attn_impl(encoder, getattr(args, 'attn_impl', None), getattr(args, 'attn_chunk_size', 1024))
@@ -1,6 +1,7 @@
 import os
 import sys
 import logging
+import time
 from typing import List, Tuple, Optional
 import torch
 from torch import nn
@@ -14,7 +15,9 @@ from torch.optim import Adam
 from torch.nn import CrossEntropyLoss
 from torch.cuda.amp import autocast, GradScaler
 import tqdm
-from Dataset import CustomDataset
+from Dataset import CustomDataset, manifest_kwargs
+from prefetch import batch_loader, DataWaitTimer
+from batch_sampler import ResumableBatchSampler
 from model import get_model
 from config import get_args
 
@@ -55,13 +58,18 @@ def train_epoch(model: nn.Module, dataloader, optimizer, criterion, device: torc
             continue
 
         try:
-            images = images.to(device)
-            input_ids = toks['input_ids'].to(device)
-            attention_mask = toks['attention_mask'].to(device)
+            # non_blocking only overlaps the copy when the loader pinned the batch
+            images = images.to(device, non_blocking=True)
+            input_ids = toks['input_ids'].to(device, non_blocking=True)
+            attention_mask = toks['attention_mask'].to(device, non_blocking=True)
 
             # mixed precision forward
             with autocast(enabled=(scaler is not None and device.type == 'cuda')):
-                outputs = model(images, input_ids, return_logits=True)
+                # auxiliary decoding heads (mask-predict, CTC) train on the same encoder output
+                aux = getattr(model, 'has_aux_loss', False)
+                outputs = model(images, input_ids, return_logits=True, return_context=aux)
+                if aux:
+                    outputs, encoded = outputs
 
                 # outputs can be either full-length logits (B, seq_len, V) or
                 # already-shifted logits (B, seq_len-1, V) depending on decoder wrapper.
@@ -84,6 +92,8 @@ def train_epoch(model: nn.Module, dataloader, optimizer, criterion, device: torc
 
                 outputs_flat = logits.view(-1, V)
                 loss = criterion(outputs_flat, targets)
+                if aux:
+                    loss = loss + model.aux_loss(input_ids, **encoded)
 
             # gradient accumulation: scale loss for backward
             loss_value = loss.item()
@@ -110,7 +120,10 @@ def train_epoch(model: nn.Module, dataloader, optimizer, criterion, device: torc
 
             total_loss += loss_value
             num_batches += 1
-            pbar.set_postfix({'loss': total_loss / (num_batches + 1e-12)})
+            postfix = {'loss': total_loss / (num_batches + 1e-12)}
+            if hasattr(dataloader, 'wait_seconds'):
+                postfix['data_wait'] = f'{dataloader.wait_seconds:.1f}s'
+            pbar.set_postfix(postfix)
 
         except RuntimeError as e:
             # catch CUDA OOM and try to recover gracefully
@@ -129,6 +142,58 @@ def train_epoch(model: nn.Module, dataloader, optimizer, criterion, device: torc
     return total_loss / max(1, num_batches)
 
 
+def train_draft_epoch(model: nn.Module, dataloader, optimizer, criterion, device: torch.device, scaler: GradScaler = None, accumulate_steps: int = 1):
+    """Teacher-forced training of the speculative-decoding draft decoder (`model.draft`).
+
+    The encoder is frozen and kept in eval mode, so the draft learns on the same context
+    it will see at inference; the main decoder is not run.
+    """
+    model.eval()
+    model.draft.train()
+    total_loss = 0.0
+    num_batches = 0
+
+    pbar = tqdm.tqdm(dataloader, desc='train draft')
+    optimizer.zero_grad()
+    for batch in pbar:
+        toks, images = batch
+        if toks is None or images is None:
+            continue
+        images = images.to(device)
+        input_ids = toks['input_ids'].to(device)
+
+        with autocast(enabled=(scaler is not None and device.type == 'cuda')):
+            with torch.no_grad():
+                context, context_mask = model.encode(images)
+            kwargs = {} if context_mask is None else {'context_mask': context_mask}
+            logits = model.draft.net(input_ids[:, :-1], context=context, **kwargs)
+            loss = criterion(logits.reshape(-1, logits.shape[-1]), input_ids[:, 1:].reshape(-1))
+
+        if scaler is not None and device.type == 'cuda':
+            scaler.scale(loss / accumulate_steps).backward()
+        else:
+            (loss / accumulate_steps).backward()
+        num_batches += 1
+        if num_batches % accumulate_steps == 0:
+            if scaler is not None and device.type == 'cuda':
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
+
+        total_loss += loss.item()
+        pbar.set_postfix({'loss': total_loss / num_batches})
+
+    return total_loss / max(1, num_batches)
+
+
+def log_data_wait(data, epoch_seconds):
+    # share of the epoch the training loop sat waiting for batches
+    logging.info(f'Data wait {data.wait_seconds:.1f}s over {data.batches} batches '
+                 f'({100 * data.wait_seconds / max(epoch_seconds, 1e-9):.1f}% of {epoch_seconds:.1f}s)')
+
+
 def main(smoke_test: bool = False):
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -136,25 +201,28 @@ def main(smoke_test: bool = False):
     device = torch.device(args.device if hasattr(args, 'device') else ('cuda' if torch.cuda.is_available() else 'cpu'))
 
     tokenizer = PreTrainedTokenizerFast(
-        tokenizer_file=os.path.join(args.data_root if hasattr(args, 'data_root') else 'D:/projectDAT/image-computer/new_process/Data', 'tokenizer.json'),
+        tokenizer_file=os.path.join(args.data_root, 'tokenizer.json'),
         unk_token='[UNK]', pad_token='[PAD]', cls_token='[CLS]', sep_token='[SEP]', mask_token='[MASK]'
     )
 
-    df_path = os.path.join(args.data_root if hasattr(args, 'data_root') else 'D:/projectDAT/image-computer/new_process/Data', 'dataCombined_with_crohme.csv')
+    df_path = os.path.join(args.data_root, args.data_csv)
     df = pd.read_csv(df_path)
     df = df[df['data_source'] == 'CROHME'].reset_index(drop=True)
     df = df[df['tags'] == 'train'].reset_index(drop=True)
 
+    image_max_size = getattr(args, 'image_max_size', 512)
+    bucket_count = getattr(args, 'bucket_count', 0)
     transform = A.Compose([
         # First scale down to fit within max size while preserving aspect ratio
-        A.LongestMaxSize(max_size=512),
-        # Then pad smaller dimension to reach target size (pad with white=1.0)
-        A.PadIfNeeded(min_height=400, min_width=528, border_mode=0, value=1.0),
+        A.LongestMaxSize(max_size=image_max_size),
+        # Then pad smaller dimension to reach target size (pad with white=1.0);
+        # bucketed batches are padded to their bucket's bounds in make_batch instead
+        *([] if bucket_count else [A.PadIfNeeded(min_height=400, min_width=528, border_mode=0, value=1.0)]),
         A.Normalize(mean=0.0, std=1.0),
         ToTensorV2()
     ])
 
-    dataset = CustomDataset(data=df, tokenizer=tokenizer, max_seq_len=getattr(args, 'max_seq_len', 150))
+    dataset = CustomDataset(data=df, tokenizer=tokenizer, max_seq_len=getattr(args, 'max_seq_len', 150), **manifest_kwargs(args))
     dataset.transform = transform
 
     pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
@@ -165,7 +233,20 @@ def main(smoke_test: bool = False):
     model = get_model(args)
     model = model.to(device)
 
-    optimizer = Adam(model.parameters(), lr=getattr(args, 'lr', 1e-4))
+    # draft training starts from a trained model; its draft weights may not exist yet
+    train_draft = getattr(args, 'train_draft', False)
+    if getattr(args, 'checkpoint', None):
+        ck = torch.load(args.checkpoint, map_location=device)
+        model.load_state_dict(ck['model_state_dict'], strict=not train_draft)
+        logging.info(f'Loaded checkpoint {args.checkpoint}')
+    if train_draft:
+        assert model.draft is not None, 'train_draft needs draft_layers > 0'
+        model.requires_grad_(False)
+        model.draft.requires_grad_(True)
+        optimizer = Adam(model.draft.parameters(), lr=getattr(args, 'lr', 1e-4))
+    else:
+        optimizer = Adam(model.parameters(), lr=getattr(args, 'lr', 1e-4))
+    run_epoch = train_draft_epoch if train_draft else train_epoch
     criterion = CrossEntropyLoss(ignore_index=pad_token_id)
 
     # setup mixed precision scaler when using CUDA
@@ -175,7 +256,9 @@ def main(smoke_test: bool = False):
     batch_size = getattr(args, 'batch_size', 32)
 
     # Heuristic: reduce batch size automatically for small GPUs to avoid OOM
-    if device.type == 'cuda':
+    # (skipped when activation checkpointing / offload is configured to save the memory instead)
+    checkpointing = getattr(args, 'encoder_checkpoint_every', 0) or getattr(args, 'decoder_checkpoint_every', 0) or getattr(args, 'checkpoint_offload', False)
+    if device.type == 'cuda' and not checkpointing:
         try:
             props = torch.cuda.get_device_properties(device)
             total_gb = props.total_memory / (1024 ** 3)
@@ -200,38 +283,93 @@ def main(smoke_test: bool = False):
         num_epochs = 1
         batch_size = 1
 
+    # resume: model, optimizer and (generator path) the batch sampler's position from a train.py checkpoint
+    resume = getattr(args, 'resume', None)
+    resume_ck = torch.load(resume, map_location=device) if resume else None
+    start_epoch = 0
+    if resume_ck is not None:
+        model.load_state_dict(resume_ck['model_state_dict'])
+        optimizer.load_state_dict(resume_ck['optimizer_state_dict'])
+        start_epoch = resume_ck['epoch'] + 1
+        logging.info(f'Resumed from {resume}')
+
+    def save_checkpoint(path, epoch, loss, sampler=None):
+        ck = {'epoch': epoch, 'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'loss': loss}
+        if sampler is not None:
+            ck['sampler_state_dict'] = sampler.state_dict()
+        torch.save(ck, path)
+        logging.info(f'Saved {path}')
+
     if use_generator:
-        # dataset.get_batch yields (tok, images) already batched
-        def gen_loader(batch_limit: Optional[int] = None):
+        # dataset.get_batch yields (tok, images) already batched; with loader_workers the same
+        # batches are built ahead of time in worker processes (prefetch.py)
+        if bucket_count:
+            # batches sized to a pixel / token budget per aspect-ratio bucket rather than batch_size images
+            stride = getattr(args, 'patch_size', 1) * (getattr(args, 'conv_stem_stride', 0) or 1)
+            max_pixels = getattr(args, 'batch_max_pixels', None) or batch_size * args.max_height * args.max_width
+
+            def make_plan(rng):
+                return dataset.bucket_batches(bucket_count, max_pixels, max_tokens=getattr(args, 'batch_max_tokens', None),
+                                              max_size=image_max_size, multiple=stride, rng=rng)
+        else:
+            def make_plan(rng):
+                return dataset.batches(batch_size, rng)
+        # seeded shuffle within and across buckets, sharded over torchrun ranks, resumable mid-epoch
+        sampler = ResumableBatchSampler(make_plan, seed=getattr(args, 'data_seed', 0), shuffle=getattr(args, 'shuffle_batches', True),
+                                        rank=int(os.environ.get('RANK', 0)), world_size=int(os.environ.get('WORLD_SIZE', 1)))
+        if resume_ck is not None and 'sampler_state_dict' in resume_ck:
+            sampler.load_state_dict(resume_ck['sampler_state_dict'])
+            if len(sampler) == 0:
+                # saved after the last batch of an epoch: nothing left of it
+                sampler.set_epoch(sampler.epoch + 1)
+            start_epoch = sampler.epoch
+            logging.info(f'Resuming epoch {sampler.epoch + 1} at batch {sampler.position}/{len(sampler.batches())}')
+        else:
+            sampler.set_epoch(start_epoch)
+        logging.info(f'{len(sampler.batches())} batches per epoch' + (f' in {bucket_count} buckets' if bucket_count else ''))
+        loader_workers = getattr(args, 'loader_workers', 0)
+        if loader_workers > 0:
+            loader = batch_loader(dataset, sampler=sampler, num_workers=loader_workers, prefetch=getattr(args, 'prefetch_batches', 4),
+                                  pin_memory=getattr(args, 'pin_memory', False) and device.type == 'cuda')
+        checkpoint_every = getattr(args, 'checkpoint_every', 0)
+
+        def gen_loader(epoch, batch_limit: Optional[int] = None):
             count = 0
-            for tok, images in dataset.get_batch(batch_size):
+            for tok, images in (loader if loader_workers > 0 else dataset.get_batch(batch_size, sampler)):
+                sampler.advance()
                 if tok is None:
                     continue
                 yield (tok, images)
+                # back here once the training step on this batch is done
                 count += 1
+                if checkpoint_every and count % checkpoint_every == 0:
+                    save_checkpoint('model_checkpoint_latest.pt', epoch, None, sampler)
                 if batch_limit is not None and count >= batch_limit:
                     break
 
-        for epoch in range(num_epochs):
+        for epoch in range(start_epoch, num_epochs):
             logging.info(f'Starting epoch {epoch+1}/{num_epochs}')
             batch_limit = 2 if smoke_test else None
             accum_steps = getattr(args, 'accumulate_steps', 4) if batch_size == 1 else getattr(args, 'accumulate_steps', 1)
-            avg_loss = train_epoch(model, gen_loader(batch_limit), optimizer, criterion, device, scaler=scaler, accumulate_steps=accum_steps)
+            data = DataWaitTimer(gen_loader(epoch, batch_limit))
+            t0 = time.perf_counter()
+            avg_loss = run_epoch(model, data, optimizer, criterion, device, scaler=scaler, accumulate_steps=accum_steps)
+            log_data_wait(data, time.perf_counter() - t0)
             logging.info(f'Epoch {epoch+1} done. avg_loss={avg_loss:.4f}')
-            ck = f'model_checkpoint_epoch_{epoch+1}.pt'
-            torch.save({'epoch': epoch, 'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'loss': avg_loss}, ck)
-            logging.info(f'Saved {ck}')
+            sampler.set_epoch(epoch + 1)
+            save_checkpoint(f'model_checkpoint_epoch_{epoch+1}.pt', epoch, avg_loss, sampler)
     else:
         # fall back to PyTorch DataLoader with collate_fn
         dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=lambda b: collate_fn(b, pad_token_id=pad_token_id))
-        for epoch in range(num_epochs):
+        for epoch in range(start_epoch, num_epochs):
             logging.info(f'Starting epoch {epoch+1}/{num_epochs}')
             accum_steps = getattr(args, 'accumulate_steps', 4) if batch_size == 1 else getattr(args, 'accumulate_steps', 1)
-            avg_loss = train_epoch(model, dataloader, optimizer, criterion, device, scaler=scaler, accumulate_steps=accum_steps)
+            data = DataWaitTimer(dataloader)
+            t0 = time.perf_counter()
+            avg_loss = run_epoch(model, data, optimizer, criterion, device, scaler=scaler, accumulate_steps=accum_steps)
+            log_data_wait(data, time.perf_counter() - t0)
             logging.info(f'Epoch {epoch+1} done. avg_loss={avg_loss:.4f}')
-            ck = f'model_checkpoint_epoch_{epoch+1}.pt'
-            torch.save({'epoch': epoch, 'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'loss': avg_loss}, ck)
-            logging.info(f'Saved {ck}')
+            save_checkpoint(f'model_checkpoint_epoch_{epoch+1}.pt', epoch, avg_loss)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,13 @@
+import time
+import functools
 import torch
 import torch.nn.functional as F
 from x_transformers import AutoregressiveWrapper, TransformerWrapper, Decoder
 
+from attention import set_attn_impl, attn_layer_kwargs
+
 def top_k(logits, thres = 0.9):
-    k = int((1 - thres) * logits.shape[-1])
+    k = max(1, int((1 - thres) * logits.shape[-1]))
     val, ind = torch.topk(logits, k)
     probs = torch.full_like(logits, float('-inf'))
     probs.scatter_(1, ind, val)
@@ -20,46 +24,491 @@ def top_p(logits, thres = 0.9):
     return logits
 
 
+class LogitSampler:
+    """Draws the next token (B, 1) from the last-step logits (B, V).
+
+    `temperature <= 0` decodes greedily with an argmax. For `top_k` and `top_p` the
+    filtering is fused with the sampling: candidates are selected into buffers that are
+    reused across steps and sampled directly, without scattering back to a `-inf`
+    vocabulary tensor. Any other `filter_logits_fn(logits, thres=...)` (or None for no
+    filtering) goes through the generic softmax path.
+    """
+    def __init__(self, filter_logits_fn=top_k, filter_thres=0.9, temperature=1.):
+        self.filter_logits_fn = filter_logits_fn
+        self.filter_thres = filter_thres
+        self.temperature = temperature
+        self._buffers = {}
+
+    def _buffer(self, name, shape, like, dtype=None):
+        dtype = dtype or like.dtype
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape[1:] != shape[1:] or buf.shape[0] < shape[0] or buf.dtype != dtype or buf.device != like.device:
+            buf = self._buffers[name] = torch.empty(shape, dtype=dtype, device=like.device)
+        # rows only ever shrink while decoding, so a leading slice stays contiguous
+        return buf[:shape[0]]
+
+    def __call__(self, logits):
+        if self.temperature <= 0:
+            return logits.argmax(dim=-1, keepdim=True)
+
+        b, v = logits.shape
+        candidates = None
+        if self.filter_logits_fn is top_k:
+            k = max(1, int((1 - self.filter_thres) * v))
+            weights, candidates = self._buffer('val', (b, k), logits), self._buffer('ind', (b, k), logits, torch.long)
+            torch.topk(logits, k, out=(weights, candidates))
+        elif self.filter_logits_fn is top_p:
+            weights, candidates = self._buffer('val', (b, v), logits), self._buffer('ind', (b, v), logits, torch.long)
+            torch.sort(logits, descending=True, out=(weights, candidates))
+            probs = torch.softmax(weights, dim=-1, out=self._buffer('probs', (b, v), logits))
+            cum_probs = torch.cumsum(probs, dim=-1, out=self._buffer('cum', (b, v), logits))
+            # drop a candidate once the mass before it exceeds thres (the first one always stays)
+            weights.masked_fill_(cum_probs.sub_(probs) > self.filter_thres, float('-inf'))
+        else:
+            weights = logits.clone() if self.filter_logits_fn is None else self.filter_logits_fn(logits, thres=self.filter_thres)
+
+        # unnormalised softmax: multinomial does not need the weights to sum to one
+        weights.div_(self.temperature)
+        weights.sub_(weights.amax(dim=-1, keepdim=True)).exp_()
+        sample = torch.multinomial(weights, 1)
+        return sample if candidates is None else candidates.gather(-1, sample)
+
+
+def filtered_probs(logits, filter_logits_fn=top_k, filter_thres=0.9, temperature=1.):
+    """Sampling distribution of `generate` for logits (B, V): filtered, tempered softmax."""
+    if filter_logits_fn is not None:
+        logits = filter_logits_fn(logits.clone(), thres=filter_thres)
+    return F.softmax(logits / temperature, dim=-1)
+
+
+def truncate_cache(cache, length):
+    """Keep the first `length` positions of every cached self-attention key/value."""
+    for inter in cache.attn_intermediates:
+        if inter.layer_type == 'a' and inter.cached_kv is not None:
+            inter.cached_kv = tuple(t[..., :length, :] for t in inter.cached_kv)
+    cache.cache_length = length
+    return cache
+
+
+def select_cache(cache, index, layer_types=('a', 'c')):
+    """Gather the rows `index` of every cached key/value tensor (batch is dim 0)."""
+    for inter in cache.attn_intermediates:
+        if inter.layer_type in layer_types and inter.cached_kv is not None:
+            inter.cached_kv = tuple(t.index_select(0, index) for t in inter.cached_kv)
+    return cache
+
+
+class MaxNewTokens:
+    """Stop a row after `max_new_tokens` tokens; an int or a LongTensor with one limit per
+    prompt (shared by its samples) or per output row."""
+    def __init__(self, max_new_tokens):
+        self.max_new_tokens = max_new_tokens
+        self.limit = max_new_tokens
+
+    def reset(self, prompts, num_samples):
+        # called by generate: align per-prompt limits with the prompts * num_samples rows
+        limit = self.max_new_tokens
+        if torch.is_tensor(limit):
+            limit = limit.view(-1)
+            assert limit.numel() in (prompts, prompts * num_samples), \
+                'max_new_tokens has %d limits for %d prompts x %d samples' % (limit.numel(), prompts, num_samples)
+            if limit.numel() != prompts * num_samples:
+                limit = limit.repeat_interleave(num_samples)
+        self.limit = limit
+
+    def __call__(self, tokens, active):
+        limit = self.limit
+        if torch.is_tensor(limit):
+            limit = limit.to(active.device)[active]
+        return torch.as_tensor(tokens.shape[1] >= limit, device=tokens.device).expand(tokens.shape[0])
+
+
+class RepeatedNgram:
+    """Stop a row whose last tokens are one n-gram (n <= max_n) repeated `repeats` times."""
+    def __init__(self, max_n=4, repeats=6):
+        self.max_n = max_n
+        self.repeats = repeats
+
+    def __call__(self, tokens, active):
+        looping = torch.zeros(tokens.shape[0], dtype=torch.bool, device=tokens.device)
+        for n in range(1, self.max_n + 1):
+            span = n * self.repeats
+            if tokens.shape[1] < span:
+                break
+            tail = tokens[:, -span:]
+            looping |= (tail[:, n:] == tail[:, :-n]).all(dim=-1)
+        return looping
+
+
+class TimeBudget:
+    """Stop every row `seconds` after the first check of a generate call."""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start = None
+
+    def reset(self, prompts, num_samples):
+        # called by generate, so one instance can be reused across calls
+        self.start = None
+
+    def __call__(self, tokens, active):
+        if self.start is None:
+            self.start = time.perf_counter()
+        expired = time.perf_counter() - self.start > self.seconds
+        return torch.full((tokens.shape[0],), expired, dtype=torch.bool, device=tokens.device)
+
+
 class CustomARWrapper(AutoregressiveWrapper):
     def __init__(self, *args, **kwargs):
         super(CustomARWrapper, self).__init__(*args, **kwargs)
 
+    def _next_logits(self, out, mask, cache, use_cache, **kwargs):
+        x = out[:, -self.max_seq_len:]
+        mask = mask[:, -self.max_seq_len:]
+        if use_cache and out.shape[1] > self.max_seq_len:
+            # absolute positions cannot slide a cached window, recompute like before
+            use_cache, cache = False, None
+        if use_cache:
+            logits, cache = self.net(x, mask=mask, cache=cache, return_intermediates=True, **kwargs)
+        else:
+            logits = self.net(x, mask=mask, **kwargs)
+        return logits[:, -1, :], cache, use_cache
+
+    def _prefill(self, start_tokens, mask, repeats, **kwargs):
+        """First cached step for prompts that are decoded `repeats` times (beams / samples).
+
+        The prompt and its `context` run once, so every decoder layer projects the image's
+        cross-attention keys/values a single time; the cache and logits are then repeated
+        for the prompt's rows. Later steps only feed the newest token and reuse the cache.
+        """
+        logits, cache = self.net(start_tokens, mask=mask, cache=None, return_intermediates=True, **kwargs)
+        logits = logits[:, -1, :]
+        if repeats > 1:
+            index = torch.arange(start_tokens.shape[0], device=start_tokens.device).repeat_interleave(repeats)
+            select_cache(cache, index)
+            logits = logits.index_select(0, index)
+        return logits, cache
+
+    @staticmethod
+    def _repeat_kwargs(kwargs, batch, repeats, drop_context=False):
+        # rows of a prompt are consecutive; a cached decoder only needs the context's batch
+        # shape (it reads the projected keys/values from the cache), not its tokens
+        out = {}
+        for k, v in kwargs.items():
+            if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == batch:
+                if k == 'context' and drop_context:
+                    v = v[:, :0]
+                if repeats > 1:
+                    v = v.repeat_interleave(repeats, dim=0)
+            out[k] = v
+        return out
+
     @torch.no_grad()
-    def generate(self, start_tokens, seq_len=256, eos_token=None, temperature=1., filter_logits_fn=top_k, filter_thres=0.9, **kwargs):
+    def generate(self, start_tokens, seq_len=256, eos_token=None, temperature=1., filter_logits_fn=top_k, filter_thres=0.9, cache_kv=True, stop_criteria=(), num_samples=1, grammar=None, **kwargs):
+        """Samples `num_samples` continuations per row of `start_tokens` (rows stay grouped per
+        prompt: output row i * num_samples + j is sample j of prompt i).
+
+        With a `grammar` (grammar.LatexGrammar) every step only samples tokens the grammar
+        allows in the row's current state, and eos is reachable before `seq_len` runs out."""
         device = start_tokens.device
         was_training = self.net.training
         num_dims = len(start_tokens.shape)
 
+        if num_dims == 1:
+            start_tokens = start_tokens[None, :]
+
+        prompts, t = start_tokens.shape
+        b = prompts * num_samples
+
+        self.net.eval()
+        # Tokens and mask are written into preallocated buffers at `cursor` instead of
+        # growing with torch.cat / F.pad, so a step allocates nothing for the sequence itself.
+        out = start_tokens.new_full((b, t + seq_len), self.pad_value)
+        out[:, :t] = start_tokens.repeat_interleave(num_samples, dim=0)
+        mask = torch.ones((b, t + seq_len), dtype=torch.bool, device=device)
+        start_mask = kwargs.pop('mask', None)
+        if start_mask is not None:
+            mask[:, :t] = start_mask.repeat_interleave(num_samples, dim=0)
+        cursor = t
+
+        # Incremental decoding: the net keeps the self-attention keys/values of the
+        # prefix and the projected cross-attention keys/values of `context` in `cache`,
+        # so every step only feeds the newest token through the decoder.
+        # Older x_transformers releases have no cache support; fall back to re-running the prefix.
+        use_cache = cache_kv and getattr(self.net, 'can_cache_kv', False)
+        cache = logits = None
+        # While the cache covers the whole decode, the context is projected once per prompt
+        # (not per sample) and never passed through the decoder again.
+        prefill = use_cache and t + seq_len - 1 <= self.max_seq_len
+        if prefill:
+            logits, cache = self._prefill(start_tokens, mask[::num_samples, :t], num_samples, **kwargs)
+        kwargs = self._repeat_kwargs(kwargs, prompts, num_samples, drop_context=prefill)
+
+        # Rows that emitted eos or hit a stop criterion leave the active batch (and the cache)
+        # right away and are copied into `result` at their input position.
+        active = torch.arange(b, device=device)
+        result = start_tokens.new_full((b, seq_len), self.pad_value)
+        sampler = LogitSampler(filter_logits_fn, filter_thres, temperature)
+        state = grammar.initial_state(b, device) if grammar is not None else None
+        for criterion in stop_criteria:
+            if hasattr(criterion, 'reset'):
+                criterion.reset(prompts, num_samples)
+
+        for step in range(seq_len):
+            if logits is None:
+                logits, cache, use_cache = self._next_logits(out[:, :cursor], mask[:, :cursor], cache, use_cache, **kwargs)
+            if grammar is not None:
+                logits = grammar.constrain(logits, state, remaining=seq_len - step)
+
+            sample = sampler(logits)
+            logits = None
+            out[:, cursor] = sample.squeeze(-1)
+            cursor += 1
+            if grammar is not None:
+                state = grammar.advance(state, sample)
+
+            finished = torch.zeros_like(active, dtype=torch.bool)
+            if eos_token is not None:
+                finished |= sample.squeeze(-1) == eos_token
+            for criterion in stop_criteria:
+                finished |= criterion(out[:, t:cursor], active)
+
+            if finished.any():
+                result[active[finished]] = out[finished, t:]
+                keep = (~finished).nonzero().squeeze(-1)
+                active = active[keep]
+                if active.numel() == 0:
+                    break
+                out, mask = out[keep], mask[keep]
+                kwargs = {k: v.index_select(0, keep) if torch.is_tensor(v) and v.dim() > 0 and v.shape[0] == len(finished) else v for k, v in kwargs.items()}
+                if cache is not None:
+                    select_cache(cache, keep)
+                if state is not None:
+                    state = state[keep]
+
+        if active.numel() > 0:
+            result[active] = out[:, t:]
+        out = result[:, :cursor - t]
+
+        if num_dims == 1:
+            out = out.squeeze(0)
+
+        self.net.train(was_training)
+        return out
+
+    def _extend(self, out, fed, upto, cache, **kwargs):
+        # feed out[:, fed:upto] into a cache holding the first `fed` tokens; logits (B, upto - fed, V)
+        logits, cache = self.net(out[:, :upto], cache=cache, cache_age=upto - fed, return_intermediates=True, **kwargs)
+        return logits, cache
+
+    @torch.no_grad()
+    def speculative_generate(self, start_tokens, seq_len=256, eos_token=None, draft=None, num_draft=4, temperature=1., filter_logits_fn=top_k, filter_thres=0.9, stats=None, **kwargs):
+        """Speculative decoding with a shallow `draft` CustomARWrapper over the same context.
+
+        The draft proposes up to `num_draft` tokens, this decoder scores all of them in one
+        cached forward and keeps the accepted prefix plus one token of its own. Greedy decoding
+        (temperature <= 0) accepts a draft token iff it is this decoder's argmax, so the output
+        equals `generate`; otherwise draft tokens are accepted with probability min(1, p / q)
+        and a rejection is resampled from max(0, p - q), which keeps the output distributed as
+        `generate` samples. Rows advance together by the shortest accepted prefix in the batch.
+        `stats` (a dict) accumulates 'proposed', 'accepted' and 'steps' (decoder forwards).
+        """
+        assert draft is not None, 'speculative decoding needs a draft decoder'
+        # counters exist even when the plain decoder is used below (nothing proposed)
+        stats = stats if stats is not None else {}
+        for key in ('proposed', 'accepted', 'steps'):
+            stats.setdefault(key, 0)
+        num_dims = len(start_tokens.shape)
+        if num_dims == 1:
+            start_tokens = start_tokens[None, :]
+        b, t = start_tokens.shape
+
+        if not (getattr(self.net, 'can_cache_kv', False) and getattr(draft.net, 'can_cache_kv', False)) \
+                or t + seq_len - 1 > min(self.max_seq_len, draft.max_seq_len):
+            # verification needs both KV caches over the whole decode
+            out = self.generate(start_tokens, seq_len, eos_token=eos_token, temperature=temperature, filter_logits_fn=filter_logits_fn, filter_thres=filter_thres, **kwargs)
+            return out.squeeze(0) if num_dims == 1 else out
+
+        was_training = self.net.training, draft.net.training
+        self.net.eval()
+        draft.net.eval()
+        greedy = temperature <= 0
+        probs = functools.partial(filtered_probs, filter_logits_fn=filter_logits_fn, filter_thres=filter_thres, temperature=temperature)
+
+        out = start_tokens.new_full((b, t + seq_len), self.pad_value)
+        out[:, :t] = start_tokens
+        start_mask = kwargs.pop('mask', None)
+        if start_mask is None:
+            start_mask = torch.ones_like(start_tokens, dtype=torch.bool)
+        # both decoders run the prompt and project the context once; `pending` holds next-token
+        # logits that were already computed, `fed` counts the tokens inside each cache
+        pending, cache = self._prefill(start_tokens, start_mask, 1, **kwargs)
+        draft_pending, draft_cache = draft._prefill(start_tokens, start_mask, 1, **kwargs)
+        kwargs = self._repeat_kwargs(kwargs, b, 1, drop_context=True)
+        cursor = fed = draft_fed = t
+        finished = torch.zeros(b, dtype=torch.bool, device=out.device)
+
+        while cursor < t + seq_len:
+            # the last free slot is kept for this decoder's own token
+            k = min(num_draft, t + seq_len - cursor - 1)
+            draft_probs = []
+            for i in range(k):
+                if draft_pending is None:
+                    draft_logits, draft_cache = draft._extend(out, draft_fed, cursor + i, draft_cache, **kwargs)
+                    draft_pending, draft_fed = draft_logits[:, -1], cursor + i
+                if greedy:
+                    token = draft_pending.argmax(dim=-1)
+                else:
+                    draft_probs.append(probs(draft_pending))
+                    token = torch.multinomial(draft_probs[-1], 1).squeeze(-1)
+                out[:, cursor + i] = token
+                draft_pending = None
+
+            # scores[:, i] is this decoder's next-token distribution for position cursor + i
+            if cursor + k > fed:
+                logits, cache = self._extend(out, fed, cursor + k, cache, **kwargs)
+                scores = logits if pending is None else torch.cat((pending[:, None], logits), dim=1)
+            else:
+                scores = pending[:, None]
+            stats['steps'] += 1
+
+            drafted = out[:, cursor:cursor + k]
+            if greedy:
+                target = scores.argmax(dim=-1)
+                accepted = drafted == target[:, :k]
+            else:
+                p = probs(scores.reshape(-1, scores.shape[-1])).view(b, k + 1, -1)
+                q = torch.stack(draft_probs, dim=1) if k else p[:, :0]
+                p_draft = p[:, :k].gather(-1, drafted[..., None]).squeeze(-1)
+                q_draft = q.gather(-1, drafted[..., None]).squeeze(-1)
+                accepted = torch.rand_like(p_draft) * q_draft < p_draft
+            num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+            m = int(num_accepted[~finished].min()) if not finished.all() else k
+            stats['proposed'] += k * int((~finished).sum())
+            stats['accepted'] += int(num_accepted[~finished].sum())
+
+            # this decoder's token at cursor + m: bonus token after a fully accepted draft,
+            # otherwise the correction of the first rejected draft token
+            if greedy:
+                token = target[:, m]
+            else:
+                dist = p[:, m]
+                if m < k:
+                    residual = (p[:, m] - q[:, m]).clamp(min=0)
+                    dist = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p[:, m])
+                token = torch.multinomial(dist, 1).squeeze(-1)
+            if m < k:
+                # rows that accepted more than m tokens keep their (valid) draft token
+                token = torch.where(num_accepted > m, drafted[:, m], token)
+            out[:, cursor + m] = token
+
+            if eos_token is not None:
+                finished |= (out[:, cursor:cursor + m + 1] == eos_token).any(dim=-1)
+            cursor += m + 1
+            # drop cache entries of tokens past the accepted prefix; the new token is fed next round
+            fed, draft_fed = cursor - 1, min(draft_fed, cursor - 1)
+            truncate_cache(cache, fed)
+            truncate_cache(draft_cache, draft_fed)
+            pending = draft_pending = None
+            if finished.all():
+                break
+
+        out = out[:, t:cursor]
+        if eos_token is not None:
+            is_eos = out == eos_token
+            after_eos = (is_eos.cumsum(dim=-1) - is_eos.long()) > 0
+            out = out.masked_fill(after_eos, self.pad_value)
+            if finished.all():
+                out = out[:, :int((~after_eos).sum(dim=-1).max())]
+
+        if num_dims == 1:
+            out = out.squeeze(0)
+
+        self.net.train(was_training[0])
+        draft.net.train(was_training[1])
+        return out
+
+    @torch.no_grad()
+    def beam_search(self, start_tokens, seq_len=256, eos_token=None, beam_width=4, length_penalty=1.0, cache_kv=True, context=None, context_mask=None, grammar=None, **kwargs):
+        """Deterministic beam search with the beams folded into the batch dimension.
+
+        The cross-attention keys/values of `context` are projected once per image and
+        shared by its beams (see `_prefill`). Finished
+        hypotheses are scored by `log_prob / length ** length_penalty` and the loop
+        stops as soon as every beam has emitted `eos_token`. Returns the best
+        hypothesis per row, padded with `pad_value` after its eos token. A `grammar`
+        constrains the expansions as in `generate`.
+        """
+        was_training = self.net.training
+        num_dims = len(start_tokens.shape)
+
         if num_dims == 1:
             start_tokens = start_tokens[None, :]
 
         b, t = start_tokens.shape
+        k = beam_width
+        device = start_tokens.device
 
         self.net.eval()
-        out = start_tokens
-        mask = kwargs.pop('mask', None)
-        if mask is None:
-            mask = torch.full_like(out, True, dtype=torch.bool, device=out.device)
+        out = start_tokens.repeat_interleave(k, dim=0)
+        mask = torch.full_like(out, True, dtype=torch.bool)
+        if context is not None:
+            kwargs['context'] = context
+        if context_mask is not None:
+            kwargs['context_mask'] = context_mask
 
-        for _ in range(seq_len):
-            x = out[:, -self.max_seq_len:]
-            mask = mask[:, -self.max_seq_len:]
-            # print('arw:',out.shape)
-            logits = self.net(x, mask=mask, **kwargs)[:, -1, :]
+        # only the first beam of every row is live until the first expansion
+        scores = torch.full((b, k), float('-inf'), device=device)
+        scores[:, 0] = 0.
+        scores = scores.view(-1)
+        lengths = torch.zeros(b * k, dtype=torch.long, device=device)
+        finished = torch.zeros(b * k, dtype=torch.bool, device=device)
+        beam_offset = (torch.arange(b, device=device) * k)[:, None]
+
+        use_cache = cache_kv and getattr(self.net, 'can_cache_kv', False)
+        cache = logits = None
+        prefill = use_cache and t + seq_len - 1 <= self.max_seq_len
+        if prefill:
+            logits, cache = self._prefill(start_tokens, mask[::k], k, **kwargs)
+        kwargs = self._repeat_kwargs(kwargs, b, k, drop_context=prefill)
+        state = grammar.initial_state(b * k, device) if grammar is not None else None
 
-            if filter_logits_fn in {top_k, top_p}:
-                filtered_logits = filter_logits_fn(logits, thres=filter_thres)
-                probs = F.softmax(filtered_logits / temperature, dim=-1)
+        for step in range(seq_len):
+            mask = mask[:, -self.max_seq_len:]
+            if logits is None:
+                logits, cache, use_cache = self._next_logits(out, mask, cache, use_cache, **kwargs)
+            if grammar is not None:
+                logits = grammar.constrain(logits.float(), state, remaining=seq_len - step)
+            log_probs = F.log_softmax(logits.float(), dim=-1)
+            logits = None
+            # finished beams only extend with padding, at no cost
+            log_probs[finished] = float('-inf')
+            log_probs[finished, self.pad_value] = 0.
 
-            sample = torch.multinomial(probs, 1)
+            vocab = log_probs.shape[-1]
+            candidates = (scores[:, None] + log_probs).view(b, k * vocab)
+            scores, flat_ind = candidates.topk(k, dim=-1)
+            scores = scores.view(-1)
+            src = (beam_offset + torch.div(flat_ind, vocab, rounding_mode='floor')).view(-1)
+            sample = (flat_ind % vocab).view(-1, 1)
 
-            out = torch.cat((out, sample), dim=-1)
+            out = torch.cat((out.index_select(0, src), sample), dim=-1)
             mask = F.pad(mask, (0, 1), value=True)
+            lengths = lengths.index_select(0, src) + (~finished.index_select(0, src)).long()
+            finished = finished.index_select(0, src)
+            if state is not None:
+                state = grammar.advance(state.index_select(0, src), sample)
+            if eos_token is not None:
+                finished = finished | (sample.squeeze(-1) == eos_token)
+            if cache is not None:
+                # beams never move across images, so the cross-attention cache stays valid
+                select_cache(cache, src, layer_types=('a',))
 
-            if eos_token is not None and (torch.cumsum(out == eos_token, 1)[:, -1] >= 1).all():
+            if finished.all():
                 break
 
-        out = out[:, t:]
+        normalized = (scores / lengths.clamp(min=1).float() ** length_penalty).view(b, k)
+        best = (beam_offset.squeeze(-1) + normalized.argmax(dim=-1))
+        out = out.index_select(0, best)[:, t:]
 
         if num_dims == 1:
             out = out.squeeze(0)
@@ -68,15 +517,21 @@ class CustomARWrapper(AutoregressiveWrapper):
         return out
 
 
-def get_decoder(args):
-    return CustomARWrapper(
+def get_decoder(args, depth=None):
+    decoder = CustomARWrapper(
         TransformerWrapper(
             num_tokens=args.num_tokens,
             max_seq_len=args.max_seq_len,
             attn_layers=Decoder(
                 dim=args.dim,
-                depth=args.num_layers,
+                depth=depth or args.num_layers,
                 heads=args.heads,
-                **args.decoder_args
+                **{**attn_layer_kwargs(getattr(args, 'attn_impl', None)), **args.decoder_args}
             )),
-        pad_value=args.pad_token)
\ No newline at end of file
+        pad_value=args.pad_token)
+    return set_attn_impl(decoder, getattr(args, 'attn_impl', None), getattr(args, 'attn_chunk_size', 1024))
+
+
+def get_draft_decoder(args):
+    """Shallow decoder (args.draft_layers) over the same encoder context for speculative decoding."""
+    return get_decoder(args, depth=args.draft_layers)